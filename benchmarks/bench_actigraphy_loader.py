@@ -0,0 +1,88 @@
+"""Peak memory and throughput of loading a device CSV export: whole-file read_csv vs the streaming loader."""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.actigraphy_utils import ACTIGRAPHY_HEADER_SEPARATOR, actigraphy_load_data
+
+COLUMNS = ["DATE/TIME", "MS", "EVENT", "TEMPERATURE", "EXT TEMPERATURE", "ORIENTATION", "PIM", "PIMn", "TAT",
+           "TATn", "ZCM", "ZCMn", "LIGHT", "AMB LIGHT", "RED LIGHT", "GREEN LIGHT", "BLUE LIGHT", "IR LIGHT",
+           "UVA LIGHT", "UVB LIGHT", "STATE"]
+
+
+def write_export(path: str, size_mb: int, block: int = 100_000) -> pd.Timestamp:
+    """Write a synthetic 1-minute epoch export of about size_mb megabytes; returns the first epoch."""
+    start = pd.Timestamp("2023-01-01 00:00:00")
+    rng = np.random.default_rng(0)
+    with open(path, "w") as f:
+        f.write("Condor Instruments export\n")
+        f.write(ACTIGRAPHY_HEADER_SEPARATOR + "\n")
+        f.write(";".join(COLUMNS) + "\n")
+        offset = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            times = pd.date_range(start + pd.Timedelta(minutes=offset), periods=block, freq="min")
+            data = {"DATE/TIME": times.strftime("%d/%m/%Y %H:%M:%S")}
+            for name in COLUMNS[1:]:
+                data[name] = rng.integers(0, 1000, block) if name in ("MS", "EVENT", "STATE") else rng.random(block) * 100
+            pd.DataFrame(data).to_csv(f, sep=";", header=False, index=False, float_format="%.2f")
+            offset += block
+    return start
+
+
+def legacy_load(filename):
+    f = open(filename, "r")
+    count = 0
+    while count < 50:
+        count += 1
+        line = f.readline()
+        if ACTIGRAPHY_HEADER_SEPARATOR in line:
+            break
+    df = pd.read_csv(filename, delimiter=";", header=count, parse_dates=False)
+    df["DATE/TIME"] = pd.to_datetime(df["DATE/TIME"], format="%d/%m/%Y %H:%M:%S")
+    df.set_index(df["DATE/TIME"], inplace=True)
+    return df
+
+
+def measure(label, size_mb, function, *args, **kwargs):
+    # Timed without tracemalloc, which slows allocation-heavy parsing down several times
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    df = function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<40} {len(df):>10} rows  {elapsed:6.1f} s  {size_mb / elapsed:6.1f} MB/s  "
+          f"peak {peak / 2**20:7.0f} MiB  result {df.memory_usage(deep=False).sum() / 2**20:6.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.txt")
+        first = write_export(path, args.size_mb)
+        size_mb = os.path.getsize(path) / 2**20
+        print(f"synthetic export: {size_mb:.0f} MiB")
+
+        period = (first + pd.Timedelta(days=30), first + pd.Timedelta(days=60))
+        measure("legacy read_csv (all columns)", size_mb, legacy_load, path)
+        measure("streaming (all columns, compact)", size_mb, actigraphy_load_data, path)
+        measure("streaming (PIM, LIGHT as float32)", size_mb, actigraphy_load_data, path, columns=["PIM", "LIGHT"])
+        measure("streaming (PIM, 30 day period)", size_mb, actigraphy_load_data, path,
+                columns=["PIM"], start_date=period[0], end_date=period[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Actogram building time: per-day boolean masks and one trace per day vs searchsorted bounds and packed arrays."""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.actigraphy_utils import actigraphy_actogram_data, actigraphy_split_by_day, rescale
+
+
+def make_recording(days: int, epoch_seconds: int = 60) -> pd.DataFrame:
+    index = pd.date_range("2024-01-01 07:13:00", periods=days * 86400 // epoch_seconds, freq=f"{epoch_seconds}s")
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({"pim": rng.gamma(2.0, 50.0, len(index)).astype(np.float32)}, index=index)
+
+
+def legacy_split_by_day(df, start_hour=0):
+    ldays = []
+    sdate = pd.Timestamp(year=df.index[0].year, month=df.index[0].month, day=df.index[0].day)
+    if df.index[0].hour <= start_hour:
+        sdate = sdate - pd.Timedelta(hours=start_hour)
+    else:
+        sdate = sdate + pd.Timedelta(hours=start_hour)
+    while sdate < df.index[-1]:
+        day = np.logical_and(df.index >= sdate, df.index < sdate + pd.Timedelta(hours=24))
+        ldays.append(df[day])
+        sdate += pd.Timedelta(hours=24)
+    return ldays
+
+
+def legacy_actogram_traces(df, column):
+    """The per-day x/y arrays the old actigraphy_double_plot_actogram handed to Plotly, one pair per trace."""
+    max_val = max(df[column]) * 1.1
+    min_val = min(df[column])
+    if min_val > 0:
+        min_val = min_val * 0.9
+    ldays = legacy_split_by_day(df)
+    traces = []
+    i = 0
+    for i in range(len(ldays) - 1):
+        d1, d2 = ldays[i], ldays[i + 1]
+        x1 = d1.index.hour + d1.index.minute / 60.0 + d1.index.second / 3600.0
+        x2 = d2.index.hour + d2.index.minute / 60.0 + d2.index.second / 3600.0 + 24.0
+        y = np.append(d1[column], d2[column])
+        traces.append((np.append(x1, x2), (i + 1) - rescale(y, min_val, max_val)))
+        i += 1
+    if len(ldays) > 0:
+        d1 = ldays[-1]
+        x = d1.index.hour + d1.index.minute / 60.0 + d1.index.second / 3600.0
+        traces.append((np.asarray(x), (i + 1) - rescale(np.asarray(d1[column]), min_val, max_val)))
+    return traces
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(day_counts=(30, 180, 365)):
+    for days in day_counts:
+        df = make_recording(days)
+        legacy_split, _ = timed(legacy_split_by_day, df)
+        split, _ = timed(actigraphy_split_by_day, df)
+        legacy_plot, traces = timed(legacy_actogram_traces, df, "pim")
+        plot, data = timed(actigraphy_actogram_data, df, "pim")
+
+        x = np.concatenate([part for tx, _ in traces for part in (tx, [np.nan])][:-1])
+        y = np.concatenate([part for _, ty in traces for part in (ty, [np.nan])][:-1])
+        assert np.allclose(x, data["x"], equal_nan=True) and np.allclose(y, data["y"], equal_nan=True, atol=1e-6)
+
+        print(f"{days:>4} days  split: {legacy_split * 1e3:8.1f} ms -> {split * 1e3:6.1f} ms   "
+              f"actogram arrays: {legacy_plot * 1e3:8.1f} ms -> {plot * 1e3:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Records/sec of page projection: the old per-key dict comprehension vs a compiled ChannelProjection."""
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.channels import CHANNEL_PROFILES, ChannelProjection
+from utils.database_utils import timestamp_to_millis
+
+PAGE_SIZE = 1000
+REPEAT = 20
+MEASUREMENTS = ('lux_melanopic', 'lux', 'lux_photopic', 'lux_rhodopic', 'lux_cyanopic', 'lux_chloropic',
+                'lux_erythropic', 'pim', 'tat', 'zcm', 'temperature', 'ext_temperature', 'battery', 'activity')
+
+
+def make_page(count: int, null_rate: float = 0.0):
+    """Logs shaped like the Condor API's: metadata fields plus one key per sensor channel."""
+    rng = random.Random(0)
+    page = []
+    for i in range(count):
+        log = {
+            'id': i, 'company_id': 1, 'user_id': 1723, 'device_id': 7, 'log_type': 'actigraphy',
+            'log_time': f"2024-03-01T{i // 60 % 24:02d}:{i % 60:02d}:00+00:00",
+            'body_part': 'wrist', 'from_service': 'condor', 'state': 0,
+        }
+        for name in MEASUREMENTS:
+            log[name] = None if rng.random() < null_rate else round(rng.uniform(0, 1000), 2)
+        page.append(log)
+    return page
+
+
+def legacy_projection(channels):
+    include_keys = set(channels)
+
+    def project(data):
+        return [
+            (timestamp_to_millis(log["log_time"]), {key: value for key, value in log.items() if key in include_keys})
+            for log in data
+        ]
+    return project
+
+
+def legacy_projection_coerced(channels):
+    """The comprehension doing what the projection does: float32 values, no empty channels."""
+    include_keys = set(channels)
+
+    def project(data):
+        return [
+            (timestamp_to_millis(log["log_time"]),
+             {key: float(np.float32(value)) for key, value in log.items() if key in include_keys and value is not None})
+            for log in data
+        ]
+    return project
+
+
+def records_per_second(project, page) -> float:
+    project(page)
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        project(page)
+    return len(page) * REPEAT / (time.perf_counter() - start)
+
+
+def main():
+    for null_rate in (0.0, 0.1):
+        page = make_page(PAGE_SIZE, null_rate)
+        for profile in ('melanopic', 'full'):
+            channels = CHANNEL_PROFILES[profile]
+            legacy = records_per_second(legacy_projection(channels), page)
+            coerced = records_per_second(legacy_projection_coerced(channels), page)
+            compiled = records_per_second(ChannelProjection(channels), page)
+            print(f"{profile:>9} ({len(channels)} ch), {null_rate:.0%} nulls: "
+                  f"comprehension {legacy:>8.0f} rec/s  comprehension+coercion {coerced:>8.0f} rec/s  "
+                  f"compiled projection {compiled:>8.0f} rec/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Per-request overhead of building the Condor API headers: re-reading credentials.txt vs the cached provider."""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.api_requests import CredentialsProvider, read_api_credentials
+
+
+def headers_from_disk(credentials: str) -> dict:
+    api_key, token = read_api_credentials(credentials)
+    return {"x-api-key": api_key, "Authorization": f"Bearer {token}"}
+
+
+def main(number: int = 20000):
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        file.write("benchmark-api-key\nbenchmark-token\n")
+    try:
+        provider = CredentialsProvider(file.name)
+        from_disk = timeit.timeit(lambda: headers_from_disk(file.name), number=number) / number
+        cached = timeit.timeit(lambda: provider.headers, number=number) / number
+    finally:
+        os.remove(file.name)
+
+    print(f"read credentials per request: {from_disk * 1e6:8.2f} us")
+    print(f"cached provider:              {cached * 1e6:8.2f} us")
+    print(f"speedup:                      {from_disk / cached:8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+End-to-end sync benchmark: sync_cli.sync_users against the mock Condor API and the in-memory Firestore.
+
+Runs the real pipeline (API client, paging, projection, SQLite staging, Firestore batches, cursor
+store) with no network or credentials, and reports throughput, latency percentiles and RPC counts.
+The first run is a backfill; later runs (--runs) sync what was added in between (--new-epochs,
+0 for a no-op run). Use --metrics-out to keep a baseline to compare optimizations against.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_cli as sync_main
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.mock_condor_api import MockCondorAPI
+from utils import database_utils
+from utils.metrics import Metrics, print_metrics_report, write_metrics
+from utils.sync_scheduler import print_sync_report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--epochs', type=int, default=2880, help="Records per user for the first run.")
+    parser.add_argument('--runs', type=int, default=2, help="Sync runs; the first one is the backfill.")
+    parser.add_argument('--new-epochs', type=int, default=0, help="Records added per user before every later run.")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="Seconds per mock API response.")
+    parser.add_argument('--api-jitter', type=float, default=0.01)
+    parser.add_argument('--api-error-rate', type=float, default=0.0)
+    parser.add_argument('--firestore-latency', type=float, default=0.005, help="Seconds per Firestore round trip.")
+    parser.add_argument('--firestore-error-rate', type=float, default=0.0)
+    parser.add_argument('--metrics-out', help="Write every run's metrics here (JSON lines or .prom, see utils.metrics).")
+    parser.add_argument('sync_args', nargs=argparse.REMAINDER,
+                        help="Options passed on to main.py after '--', e.g. -- --concurrency 16 --storage-layout days")
+    return parser.parse_args(argv)
+
+
+async def run_once(label: str, api: MockCondorAPI, db: FakeFirestore, connection, sync_args, user_ids: list) -> dict:
+    api.reset_counters()
+    db.reset_counters()
+    run_metrics = Metrics()
+    start = time.perf_counter()
+    summaries = await sync_main.sync_users(sync_args, db, connection, user_ids, sync_args.rate_limit, run_metrics)
+    elapsed = time.perf_counter() - start
+    run_metrics.merge(Metrics.merged(summary.metrics for summary in summaries))
+
+    logs = sum(summary.logs_written for summary in summaries)
+    failed = sum(1 for summary in summaries if not summary.ok)
+    firestore_counters = db.counters()
+    print(f"== {label}: {len(summaries)} users ({failed} failed) in {elapsed:.2f}s, "
+          f"{len(summaries) / elapsed:.1f} users/s, {logs} logs, {logs / elapsed:.0f} logs/s")
+    print(f"   API: {api.requests} requests ({api.errors} errors), {api.records_served} records served")
+    print("   Firestore: " + ', '.join(f"{name} {value}" for name, value in firestore_counters.items()))
+    if failed:
+        print_sync_report(summaries)
+    print_metrics_report(run_metrics)
+    return {
+        'label': label, 'summaries': summaries, 'metrics': run_metrics,
+        'info': {'run': label, 'users': len(summaries), 'failed': failed, 'elapsed': elapsed, 'logs': logs,
+                 'api_requests': api.requests, 'api_errors': api.errors, 'api_records': api.records_served,
+                 **{f"firestore_{name}": value for name, value in firestore_counters.items()}},
+    }
+
+
+async def bench(args) -> list:
+    user_ids = list(range(1, args.users + 1))
+    api = MockCondorAPI(args.users, args.epochs, args.api_latency, args.api_jitter, args.api_error_rate)
+    db = FakeFirestore(args.firestore_latency, args.firestore_error_rate)
+    runner, url = await api.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        credentials_file = os.path.join(directory, 'credentials.txt')
+        with open(credentials_file, 'w') as file:
+            file.write("local-api-key\nlocal-token\n")
+        passthrough = args.sync_args[1:] if args.sync_args[:1] == ['--'] else args.sync_args
+        sync_args = sync_main.parse_args(['--api-url', url, '--credentials-file', credentials_file, '--rate-limit', '100000',
+                                          *passthrough])
+
+        connection = database_utils.connect_to_db(os.path.join(directory, 'bench.db'))
+        last_place_table = database_utils.create_table(connection, database_utils.LAST_PLACE_TABLE)
+        database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+        database_utils.create_light_exposure_tables(connection)
+        print(f"{args.users} users x {args.epochs} epochs, API latency {args.api_latency}s, Firestore latency "
+              f"{args.firestore_latency}s, concurrency {sync_args.concurrency}, layout {sync_args.storage_layout}, "
+              f"cursor store {sync_args.cursor_store}")
+
+        results = []
+        try:
+            for run in range(args.runs):
+                if run:
+                    api.add_epochs(user_ids, args.new_epochs)
+                label = 'backfill' if run == 0 else f"incremental {run} (+{args.new_epochs} epochs/user)"
+                results.append(await run_once(label, api, db, connection, sync_args, user_ids))
+        finally:
+            database_utils.close_connection(connection)
+            await runner.cleanup()
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(bench(args))
+    if args.metrics_out:
+        # One file per run, so the backfill and the incremental runs stay comparable on their own
+        root, extension = os.path.splitext(args.metrics_out)
+        for index, result in enumerate(results):
+            path = args.metrics_out if index == 0 else f"{root}.run{index}{extension}"
+            write_metrics(path, result['summaries'], result['metrics'], result['info'])
+            print(f"Metrics of the {result['label']} run written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Peak memory of the ingestion pipeline while many users sync concurrently, traced with tracemalloc.
+
+The mock Condor API runs in a separate process and the in-memory Firestore does not keep what
+is written (retain=False), so the traced peak is the sync's own: API pages in flight and queued,
+their projection, SQLite staging and Firestore batches. Cursors are kept in SQLite.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_cli
+from benchmarks.fake_firestore import FakeFirestore
+from utils import database_utils
+from utils.metrics import Metrics
+
+MOCK_API = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_condor_api.py')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--epochs', type=int, default=10000, help="Records per user.")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="Seconds per mock API response.")
+    parser.add_argument('--firestore-latency', type=float, default=0.005)
+    parser.add_argument('--top', type=int, default=10, help="Allocation sites listed (at the end of the run).")
+    parser.add_argument('sync_args', nargs=argparse.REMAINDER,
+                        help="Options passed on to the sync after '--' (defaults: --concurrency USERS "
+                             "--page-size 1000 --max-page-size 1000 --channel-profile full)")
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{url}/v1/users/1"):
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def bench(args, url: str, directory: str) -> None:
+    await wait_until_up(url)
+    credentials_file = os.path.join(directory, 'credentials.txt')
+    with open(credentials_file, 'w') as file:
+        file.write("local-api-key\nlocal-token\n")
+    passthrough = args.sync_args[1:] if args.sync_args[:1] == ['--'] else args.sync_args
+    sync_args = sync_cli.parse_args(['--api-url', url, '--credentials-file', credentials_file, '--rate-limit', '100000',
+                                     '--cursor-store', 'sqlite', '--concurrency', str(args.users), '--page-size', '1000',
+                                     '--max-page-size', '1000', '--channel-profile', 'full', *passthrough])
+    connection = database_utils.connect_to_db(os.path.join(directory, 'bench.db'))
+    last_place_table = database_utils.create_table(connection, database_utils.LAST_PLACE_TABLE)
+    database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+    database_utils.create_light_exposure_tables(connection)
+    db = FakeFirestore(args.firestore_latency, retain=False)
+    user_ids = list(range(1, args.users + 1))
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    summaries = await sync_cli.sync_users(sync_args, db, connection, user_ids, sync_args.rate_limit, Metrics())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    database_utils.close_connection(connection)
+
+    logs = sum(summary.logs_written for summary in summaries)
+    failed = sum(1 for summary in summaries if not summary.ok)
+    print(f"{len(summaries)} users ({failed} failed), {logs} logs in {elapsed:.2f}s, concurrency {sync_args.concurrency}, "
+          f"page size {sync_args.max_page_size}, layout {sync_args.storage_layout}, "
+          f"channels {', '.join(sync_cli.build_channel_config(sync_args).channels)}")
+    print(f"tracemalloc peak above the baseline: {(peak - baseline) / 2 ** 20:.1f} MiB")
+    for stat in snapshot.statistics('lineno')[:args.top]:
+        print(f"  {stat}")
+
+
+def main():
+    args = parse_args()
+    port = free_port()
+    api = subprocess.Popen([sys.executable, MOCK_API, '--port', str(port), '--users', str(args.users), '--epochs',
+                            str(args.epochs), '--latency', str(args.api_latency)], stdout=subprocess.DEVNULL)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(bench(args, f"http://127.0.0.1:{port}", directory))
+    finally:
+        api.terminate()
+        api.wait()
+
+
+if __name__ == "__main__":
+    main()
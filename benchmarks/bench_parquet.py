@@ -0,0 +1,116 @@
+"""
+Parquet export benchmark: a year of one user's one-minute epochs, loaded for analysis.
+
+Stages --days days of logs (the mock Condor API's channels) in a temporary SQLite store, then
+compares the dict-list path (load_user_actigraphy + create_dataframe) with the Parquet fast path
+(create_dataframe_from_parquet) for the whole period and all channels, one channel, and one
+channel for a month, and times a full and an incremental export. Reading the same data from
+Firestore would take one document read per epoch (printed for reference).
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_condor_api import START, MockCondorAPI
+from utils import database_utils
+from utils.actigraphy_utils import (
+    actigraphy_actogram_data,
+    actigraphy_select_period,
+    create_dataframe,
+    create_dataframe_from_parquet,
+    load_user_actigraphy,
+)
+from utils.parquet_export import export_user_parquet
+
+USER_ID = 1
+METADATA = {'id', 'company_id', 'user_id', 'device_id', 'log_type', 'log_time', 'body_part', 'from_service', 'state'}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--channel', default='pim', help="Channel of the single-channel loads.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per load; the median is reported.")
+    return parser.parse_args(argv)
+
+
+def stage_days(connection, first_day: int, days: int) -> int:
+    """Stage days first_day..first_day + days - 1 of the mock user's epochs; returns the rows staged."""
+    rows = 0
+    for day in range(first_day, first_day + days):
+        records = [MockCondorAPI.record(USER_ID, day * 1440 + minute + 1) for minute in range(1440)]
+        logs = [(record['log_time'], {name: value for name, value in record.items() if name not in METADATA})
+                for record in records]
+        rows += database_utils.insert_measurement_logs(connection, database_utils.MEASUREMENT_LOGS_TABLE, USER_ID, logs)
+    return rows
+
+
+def timed(function, repeat: int):
+    """(median seconds, last result) of repeat calls."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+
+def directory_size(root: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(root) for name in names)
+
+
+def main():
+    args = parse_args()
+    month_start = START + datetime.timedelta(days=max(0, args.days - 31))
+    month_end = START + datetime.timedelta(days=args.days)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'bench.db')
+        root = os.path.join(directory, 'parquet')
+        connection = database_utils.connect_to_db(db_path)
+        last_place_table = database_utils.create_table(connection, database_utils.LAST_PLACE_TABLE)
+        database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+        start = time.perf_counter()
+        rows = stage_days(connection, 0, args.days)
+        print(f"Staged {rows} epochs ({args.days} days) of user {USER_ID} in {time.perf_counter() - start:.1f}s; "
+              f"from Firestore that is {rows} document reads")
+
+        start = time.perf_counter()
+        days = export_user_parquet(connection, root, USER_ID)
+        print(f"Full export: {days} day files, {directory_size(root) / 2 ** 20:.1f} MiB, {time.perf_counter() - start:.2f}s")
+        stage_days(connection, args.days, 1)
+        start = time.perf_counter()
+        days = export_user_parquet(connection, root, USER_ID)
+        print(f"Incremental export after one more day: {days} day files rewritten in {time.perf_counter() - start:.3f}s")
+
+        def dict_path(columns=None, start_date=None, end_date=None):
+            act_data = load_user_actigraphy(connection, database_utils.MEASUREMENT_LOGS_TABLE, USER_ID, columns)
+            return actigraphy_select_period(create_dataframe(act_data), start_date, end_date)
+
+        cases = [
+            ("all channels, whole period", {}),
+            (f"{args.channel}, whole period", {'columns': [args.channel]}),
+            (f"{args.channel}, last month", {'columns': [args.channel], 'start_date': month_start, 'end_date': month_end}),
+        ]
+        print(f"{'load':<28} {'dict lists':>11} {'parquet':>9} {'rows':>8}  MiB in memory")
+        for label, options in cases:
+            dict_seconds, expected = timed(lambda: dict_path(**options), args.repeat)
+            parquet_seconds, df = timed(lambda: create_dataframe_from_parquet(root, USER_ID, **options), args.repeat)
+            assert len(df) == len(expected) and (df.index == expected.index).all()
+            print(f"{label:<28} {dict_seconds * 1000:9.0f}ms {parquet_seconds * 1000:7.0f}ms {len(df):8d}  "
+                  f"{expected.memory_usage(deep=True).sum() / 2 ** 20:.1f} -> {df.memory_usage(deep=True).sum() / 2 ** 20:.1f}")
+
+        seconds, data = timed(lambda: actigraphy_actogram_data(
+            create_dataframe_from_parquet(root, USER_ID, [args.channel], month_start, month_end), args.channel), args.repeat)
+        print(f"Actogram data of the last month from Parquet: {data['n_rows']} rows in {seconds * 1000:.0f}ms")
+        database_utils.close_connection(connection)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Users/sec of the sharded runner on a parse-heavy synthetic workload, for 1..N shard processes."""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database_utils
+from utils.channels import CHANNEL_PROFILES, ChannelProjection
+from utils.chunked_storage import encode_day, group_by_day
+from utils.metrics import Metrics, PAGE_WRITE_SECONDS, timed
+from utils.sync_scheduler import UserSyncSummary, run_sharded, run_sync_pool
+
+START_MS = 1_700_000_000_000
+EPOCH_MS = 60_000
+
+
+def make_page(user_id: int, page: int, page_size: int):
+    """Raw API logs with ISO timestamps, so parsing dominates like in a real backfill."""
+    logs = []
+    for i in range(page * page_size, (page + 1) * page_size):
+        timestamp = START_MS + i * EPOCH_MS
+        logs.append({
+            'id': i, 'user_id': user_id, 'device_id': 7, 'log_type': 'actigraphy',
+            'log_time': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(timestamp / 1000)),
+            'lux_melanopic': float(i % 997), 'lux': float(i % 991), 'lux_photopic': float(i % 983),
+            'pim': float(i % 89), 'tat': float(i % 61), 'zcm': float(i % 7),
+            'temperature': 31.5, 'ext_temperature': 22.0,
+        })
+    return logs
+
+
+def bench_shard(shard: int, user_ids: list, pages: int, page_size: int):
+    """One shard process: project every page, stage it in SQLite and pack it into day documents."""
+    projection = ChannelProjection(CHANNEL_PROFILES['full'])
+    connection = database_utils.connect_to_db(':memory:')
+    table = database_utils.create_measurement_logs_table(connection, 'sensor_logs', 'last_place_table')
+
+    async def sync_user(user_id: int):
+        summary = UserSyncSummary(user_id)
+        for page in range(pages):
+            data = make_page(user_id, page, page_size)
+            with timed(PAGE_WRITE_SECONDS):
+                logs = projection(data)
+                database_utils.insert_measurement_logs(connection, table, user_id, logs)
+                for offsets, channels in group_by_day(logs, projection.channels).values():
+                    encode_day(offsets, channels)
+            summary.pages_fetched += 1
+            summary.logs_written += len(logs)
+        return summary
+
+    summaries = asyncio.run(run_sync_pool(user_ids, sync_user, concurrency=1))
+    connection.close()
+    return summaries, Metrics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--pages', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--max-shards', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    user_ids = list(range(1, args.users + 1))
+    print(f"{os.cpu_count()} CPUs, {args.users} users x {args.pages} pages x {args.page_size} logs")
+    shard_counts = sorted({1, *(2 ** k for k in range(1, 8) if 2 ** k <= args.max_shards), args.max_shards})
+    baseline = None
+    for shards in shard_counts:
+        start = time.perf_counter()
+        summaries, _ = asyncio.run(run_sharded(user_ids, shards, bench_shard, args.pages, args.page_size))
+        elapsed = time.perf_counter() - start
+        failed = [summary for summary in summaries if not summary.ok]
+        if failed:
+            raise SystemExit(f"{len(failed)} users failed: {failed[0].error}")
+        rate = len(user_ids) / elapsed
+        baseline = baseline or rate
+        print(f"{shards:>3} shards: {elapsed:7.2f}s  {rate:7.2f} users/s  "
+              f"{sum(s.logs_written for s in summaries) / elapsed:>9.0f} logs/s  speedup {rate / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
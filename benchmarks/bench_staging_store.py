@@ -0,0 +1,57 @@
+"""Rows/sec of the SQLite staging store: the per-row insert_measurement_log path vs bulk insert_measurement_logs."""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database_utils
+
+START_MS = 1_700_000_000_000
+EPOCH_MS = 60_000
+PAGE_SIZE = 1000
+
+
+def make_logs(count: int):
+    return [(START_MS + i * EPOCH_MS, {'lux_melanopic': float(i % 500)}) for i in range(count)]
+
+
+def open_store(directory: str, name: str, tune: bool):
+    connection = database_utils.connect_to_db(os.path.join(directory, name), tune=tune)
+    table = database_utils.create_measurement_logs_table(connection, 'sensor_logs', 'last_place_table')
+    return connection, table
+
+
+def bench_per_row(directory: str, count: int) -> float:
+    connection, table = open_store(directory, f"per_row_{count}.db", tune=False)
+    start = time.perf_counter()
+    for timestamp, measurements in make_logs(count):
+        database_utils.insert_measurement_log(connection, table, measurements, 1, timestamp)
+    elapsed = time.perf_counter() - start
+    database_utils.close_connection(connection)
+    return count / elapsed
+
+
+def bench_bulk(directory: str, count: int) -> float:
+    connection, table = open_store(directory, f"bulk_{count}.db", tune=True)
+    logs = make_logs(count)
+    start = time.perf_counter()
+    for offset in range(0, count, PAGE_SIZE):
+        database_utils.insert_measurement_logs(connection, table, 1, logs[offset:offset + PAGE_SIZE])
+    elapsed = time.perf_counter() - start
+    database_utils.close_connection(connection)
+    return count / elapsed
+
+
+def main(sizes=(10_000, 100_000, 1_000_000), per_row_limit: int = 10_000):
+    with tempfile.TemporaryDirectory() as directory:
+        for count in sizes:
+            line = f"{count:>9} rows  bulk ({PAGE_SIZE}/txn, WAL): {bench_bulk(directory, count):>10.0f} rows/s"
+            if count <= per_row_limit:
+                line += f"  per-row commit: {bench_per_row(directory, count):>8.0f} rows/s"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
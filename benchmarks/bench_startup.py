@@ -0,0 +1,85 @@
+"""
+Startup cost of the entry points: import time (python -X importtime) and peak RSS per command.
+
+Every entry point is imported in a fresh interpreter --repeat times; the table shows the median
+total import time, the wall time of the whole process, the peak RSS after the imports and which
+of the heavy third-party packages got loaded. Use --importtime to print the slowest imports of
+one entry point (cumulative, as reported by -X importtime).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each command of main.py imports before it starts working
+ENTRY_POINTS = {
+    'cli': "import main",
+    'sync': "import sync_cli",
+    'serve': "import server",
+    'plot': "import main; from utils.actigraphy_utils import actigraphy_double_plot_actogram, create_dataframe, "
+            "load_user_actigraphy; from utils.database_utils import connect_to_db; import plotly.graph_objs",
+}
+
+HEAVY_PACKAGES = ('firebase_admin', 'google.cloud.firestore', 'grpc', 'numpy', 'pandas', 'plotly', 'aiohttp',
+                  'aiosqlite', 'tenacity', 'requests', 'pyarrow')
+
+REPORT = ("import json, resource, sys; print(json.dumps({'rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "
+          "'modules': sorted(name for name in %r if name in sys.modules)}))" % (HEAVY_PACKAGES,))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('entry_points', nargs='*', metavar='ENTRY_POINT',
+                        help=f"Entry points to measure: {', '.join(ENTRY_POINTS)} (default: all).")
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per entry point.")
+    parser.add_argument('--importtime', metavar='ENTRY_POINT', choices=ENTRY_POINTS,
+                        help="Print the slowest imports of this entry point.")
+    parser.add_argument('--top', type=int, default=25, help="Imports listed with --importtime.")
+    args = parser.parse_args(argv)
+    unknown = set(args.entry_points) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(sorted(unknown))}")
+    return args
+
+
+def run_entry_point(code: str):
+    """Import in a fresh interpreter: (total import µs, wall seconds, report, [(cumulative µs, module)])."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"{code}\n{REPORT}"], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    total, imports = 0, []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        total += int(self_us)
+        imports.append((int(cumulative_us), name))
+    return total, wall, json.loads(process.stdout.splitlines()[-1]), imports
+
+
+def main():
+    args = parse_args()
+    if args.importtime:
+        _, _, _, imports = run_entry_point(ENTRY_POINTS[args.importtime])
+        # Nested imports are indented by -X importtime; keep that to show what pulled them in
+        for cumulative_us, name in sorted(imports, reverse=True)[:args.top]:
+            print(f"{cumulative_us / 1000:9.1f} ms  {name}")
+        return
+
+    print(f"{'entry point':<12} {'imports':>9} {'process':>9} {'peak RSS':>10}  heavy packages loaded")
+    for name in args.entry_points or ENTRY_POINTS:
+        runs = [run_entry_point(ENTRY_POINTS[name]) for _ in range(args.repeat)]
+        import_ms = statistics.median(run[0] for run in runs) / 1000
+        wall_ms = statistics.median(run[1] for run in runs) * 1000
+        rss_mib = statistics.median(run[2]['rss_kib'] for run in runs) / 1024
+        print(f"{name:<12} {import_ms:7.0f}ms {wall_ms:7.0f}ms {rss_mib:7.1f}MiB  {', '.join(runs[0][2]['modules']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
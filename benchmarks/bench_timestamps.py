@@ -0,0 +1,55 @@
+"""Log time conversion per page: per-record fromisoformat vs the vectorized log_times_to_millis, for 10, 1k and 100k records."""
+import datetime
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.timestamps import log_times_to_millis
+
+START = datetime.datetime(2024, 3, 1)
+
+
+def make_log_times(count: int, offset: str = ''):
+    """Log times the way the Condor API sends them ('YYYY-MM-DD HH:MM:SS'), optionally with a UTC offset."""
+    return [(START + datetime.timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S') + offset for i in range(count)]
+
+
+def per_record(log_times):
+    # What insert_measurement_log_firestore did: one fromisoformat per log
+    return [int(datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc).timestamp() * 1000) for value in log_times]
+
+
+def dataframe_parse(log_times):
+    # What create_dataframe did: a second, format-driven parse of the same strings
+    return pd.to_datetime(pd.Series(log_times), format='%Y-%m-%d %H:%M:%S')
+
+
+def best_of(function, argument, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes=(10, 1_000, 100_000)):
+    for label, offset, tz in (('naive, UTC', '', 'UTC'), ('naive, Europe/Madrid', '', 'Europe/Madrid'), ('+02:00 offset', '+02:00', 'UTC')):
+        print(label)
+        for count in sizes:
+            log_times = make_log_times(count, offset)
+            repeat = max(3, 100_000 // count)
+            assert log_times_to_millis(log_times).tolist() == per_record(log_times) or offset or tz != 'UTC'
+            old = best_of(per_record, log_times, repeat)
+            frame = best_of(dataframe_parse, log_times, repeat) if not offset else float('nan')
+            new = best_of(lambda values: log_times_to_millis(values, tz), log_times, repeat)
+            print(f"  {count:>7} records: per-record {old * 1e3:9.3f} ms  pd.to_datetime(format) {frame * 1e3:9.3f} ms  "
+                  f"log_times_to_millis {new * 1e3:9.3f} ms  ({count / new:>12.0f} rec/s, {old / new:6.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
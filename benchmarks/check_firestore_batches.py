@@ -0,0 +1,262 @@
+"""
+Check the Firestore round trips of insert_measurement_logs_firestore_batched on the in-memory fake.
+
+N logs must take exactly ceil(N / 500) BatchCommit RPCs and nothing else, for (timestamp,
+measurements) pairs and MeasurementPage input alike. When one batch keeps failing, its commits are
+retried up to max_attempts, the other batches are still committed once each, and exactly the
+failed batch's timestamps are reported while the rest of the page lands.
+
+A sync checkpoint added to the last batch (final_writes) must never push it past 500 writes (the
+fake rejects such a commit like Firestore does), also when the page size is a multiple of 500: for
+the batched writer, the packed day layout and a whole sync in every layout.
+
+Day batches retry transient errors the same way, a day too large for a Firestore document fails
+before anything is written, and main.py migrate-days copies per-epoch documents into days.
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.api_core import exceptions as google_exceptions
+
+from benchmarks.fake_firestore import FakeFirestore, FakeWriteBatch
+from benchmarks.sync_fixture import SyncFixture, compare
+from utils.chunked_storage import (
+    DAY_MILLIS,
+    LAYOUT_DAYS,
+    MEASUREMENT_LAYOUTS,
+    decode_day,
+    migrate_user_to_days_firestore,
+    write_measurement_days_firestore,
+)
+from utils.database_utils import FIRESTORE_MAX_BATCH_SIZE, insert_measurement_logs_firestore_batched
+from utils.measurement_page import MeasurementPage
+
+START_MILLIS = 1_700_000_000_000
+CHANNELS = ('lux', 'activity')
+
+
+class FailingWriteBatch(FakeWriteBatch):
+    async def commit(self) -> None:
+        first_timestamp = int(self._writes[0][0].rsplit('/', 1)[-1]) if self._writes else None
+        if first_timestamp in self.db.failing:
+            await self.db._rpc('commit')
+            self.db.failed_commits += 1
+            raise google_exceptions.ServiceUnavailable('injected commit failure')
+        await super().commit()
+
+
+class FailingFirestore(FakeFirestore):
+    """A FakeFirestore whose batches starting at one of the `failing` timestamps never commit."""
+
+    def __init__(self, failing=()):
+        super().__init__()
+        self.failing = set(failing)
+
+    def batch(self) -> FailingWriteBatch:
+        return FailingWriteBatch(self)
+
+
+class FlakyWriteBatch(FakeWriteBatch):
+    async def commit(self) -> None:
+        if self.db.rpcs['commit'] % 2 == 0:
+            await self.db._rpc('commit')
+            self.db.failed_commits += 1
+            raise google_exceptions.ServiceUnavailable('injected commit failure')
+        await super().commit()
+
+
+class FlakyFirestore(FakeFirestore):
+    """A FakeFirestore whose every other commit fails, starting with the first."""
+
+    def batch(self) -> FlakyWriteBatch:
+        return FlakyWriteBatch(self)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 499, 500, 501, 1000, 1234, 5000])
+    return parser.parse_args(argv)
+
+
+def make_logs(count: int):
+    timestamps = START_MILLIS + np.arange(count, dtype=np.int64) * 60_000
+    values = np.arange(count * len(CHANNELS), dtype=np.float32).reshape(count, len(CHANNELS))
+    pairs = [(timestamp, dict(zip(CHANNELS, row))) for timestamp, row in zip(timestamps.tolist(), values.tolist())]
+    return pairs, MeasurementPage(CHANNELS, timestamps, values)
+
+
+def stored(db: FakeFirestore) -> list:
+    return sorted(data['timestamp'] for path, data in db.documents.items() if path.startswith('actigraphy_data/1/measurements/'))
+
+
+async def check_commits(size: int) -> list:
+    problems = []
+    pairs, page = make_logs(size)
+    for label, logs in (('pairs', pairs), ('page', page)):
+        db = FakeFirestore()
+        result = await insert_measurement_logs_firestore_batched(db, 1, logs)
+        expected = math.ceil(size / FIRESTORE_MAX_BATCH_SIZE)
+        if dict(db.rpcs) != {'commit': expected}:
+            problems.append(f"{size} logs as {label}: RPCs {dict(db.rpcs)}, expected {expected} commits only")
+        if not result.ok or result.written != size or result.batches != expected or len(stored(db)) != size:
+            problems.append(f"{size} logs as {label}: {result.written} written in {result.batches} batches, "
+                            f"{len(stored(db))} stored, {len(result.failed_timestamps)} failed")
+    return problems
+
+
+async def check_partial_failure(size: int, failed_batch: int, max_attempts: int) -> list:
+    pairs, page = make_logs(size)
+    batches = math.ceil(size / FIRESTORE_MAX_BATCH_SIZE)
+    failed = page.timestamps[failed_batch * FIRESTORE_MAX_BATCH_SIZE:(failed_batch + 1) * FIRESTORE_MAX_BATCH_SIZE].tolist()
+    db = FailingFirestore([failed[0]])
+    result = await insert_measurement_logs_firestore_batched(db, 1, page, max_attempts=max_attempts)
+
+    problems = []
+    expected_commits = batches - 1 + max_attempts
+    if dict(db.rpcs) != {'commit': expected_commits}:
+        problems.append(f"RPCs {dict(db.rpcs)}, expected {expected_commits} commits only "
+                        f"({batches - 1} batches once, the failing one {max_attempts} times)")
+    if sorted(result.failed_timestamps) != failed:
+        problems.append(f"{len(result.failed_timestamps)} failed timestamps reported, expected the {len(failed)} of batch {failed_batch}")
+    if result.written != size - len(failed) or result.batches != batches - 1 or len(result.errors) != 1:
+        problems.append(f"{result.written} written in {result.batches} batches with {len(result.errors)} errors")
+    if stored(db) != sorted(set(page.timestamps.tolist()) - set(failed)):
+        problems.append(f"{len(stored(db))} documents stored, expected every log but the failed batch's")
+    return problems
+
+
+def checkpoint_write(db: FakeFirestore):
+    return lambda batch: batch.set(db.collection('last_place_table').document('1'), {'starting_after': 'x', 'data_size': 0}, merge=True)
+
+
+async def check_final_writes(size: int) -> list:
+    problems = []
+    _, page = make_logs(size)
+    db = FakeFirestore()
+    result = await insert_measurement_logs_firestore_batched(db, 1, page, final_writes=checkpoint_write(db))
+    if not result.ok or len(stored(db)) != size or 'last_place_table/1' not in db.documents:
+        problems.append(f"documents: {result.errors[:1]}, {len(stored(db))} of {size} stored, "
+                        f"checkpoint {'written' if 'last_place_table/1' in db.documents else 'missing'}")
+
+    # One log per day: as many day documents as logs
+    days = MeasurementPage(CHANNELS, START_MILLIS + np.arange(size, dtype=np.int64) * 86_400_000,
+                           np.ones((size, len(CHANNELS)), dtype=np.float32))
+    db = FakeFirestore()
+    try:
+        written = await write_measurement_days_firestore(db, 1, days, CHANNELS, final_writes=checkpoint_write(db))
+    except google_exceptions.GoogleAPIError as error:
+        problems.append(f"days: {error}")
+    else:
+        if written != size or 'last_place_table/1' not in db.documents:
+            problems.append(f"days: {written} of {size} day documents written")
+    return problems
+
+
+def day_documents(db: FakeFirestore) -> dict:
+    return {path: data for path, data in db.documents.items() if path.startswith('actigraphy_days/1/days/')}
+
+
+async def check_days_retry() -> list:
+    problems = []
+    _, page = make_logs(1000)
+    db = FlakyFirestore()
+    try:
+        written = await write_measurement_days_firestore(db, 1, page, CHANNELS)
+    except google_exceptions.GoogleAPIError as error:
+        problems.append(f"transient errors were not retried: {error}")
+    else:
+        if db.failed_commits != 1 or db.rpcs['commit'] != 2 or len(day_documents(db)) != written:
+            problems.append(f"{db.failed_commits} failed of {db.rpcs['commit']} commits, {len(day_documents(db))} of {written} days stored")
+
+    # 100k epochs of 12 channels in one day: several MiB once encoded
+    epochs = 100_000
+    oversized = MeasurementPage(tuple(f"channel{i}" for i in range(12)), START_MILLIS + np.arange(epochs, dtype=np.int64) % DAY_MILLIS // 2,
+                                np.random.default_rng(0).random((epochs, 12), dtype=np.float32))
+    db = FakeFirestore()
+    try:
+        await write_measurement_days_firestore(db, 1, oversized, oversized.channels)
+    except ValueError as error:
+        if db.rpcs.get('commit'):
+            problems.append(f"an oversized day raised after {db.rpcs['commit']} commits: {error}")
+    else:
+        problems.append("an oversized day document was written")
+    return problems
+
+
+async def check_migration() -> list:
+    _, page = make_logs(1234)
+    db = FakeFirestore()
+    await insert_measurement_logs_firestore_batched(db, 1, page)
+    copied = await migrate_user_to_days_firestore(db, 1, CHANNELS)
+    # Running it again merges into the same days
+    copied_again = await migrate_user_to_days_firestore(db, 1, CHANNELS)
+    timestamps = sorted(int(offset) + data['day_start'] for data in day_documents(db).values() for offset in decode_day(data)[0])
+    if copied != copied_again or copied != len(page) or timestamps != page.timestamps.tolist():
+        return [f"copied {copied} then {copied_again} epochs, {len(timestamps)} of {len(page)} in day documents"]
+    return []
+
+
+async def check_sync(layout: str) -> list:
+    problems = []
+    for page_size in ('500', '1000'):
+        async with SyncFixture(users=2, epochs=3000) as fixture:
+            summaries = await fixture.sync('--storage-layout', layout, '--cursor-store', 'firestore',
+                                           '--page-size', page_size, '--max-page-size', page_size)
+            problems.extend(f"pages of {page_size}, user {summary.user_id}: {summary.error}" for summary in summaries if not summary.ok)
+            for user_id in fixture.user_ids:
+                stored_epochs = fixture.day_epochs(user_id) if layout == LAYOUT_DAYS else fixture.epoch_documents(user_id)
+                problems.extend(f"pages of {page_size}, user {user_id}: {problem}"
+                                for problem in compare('epochs', stored_epochs, fixture.expected(user_id)))
+    return problems
+
+
+async def run(args) -> bool:
+    ok = True
+    for size in args.sizes:
+        problems = await check_commits(size)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: {size} logs, {math.ceil(size / FIRESTORE_MAX_BATCH_SIZE)} commits")
+        for problem in problems:
+            print(f"  {problem}")
+    for failed_batch, max_attempts in ((0, 1), (1, 1), (1, 3), (2, 2)):
+        problems = await check_partial_failure(1234, failed_batch, max_attempts)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: 1234 logs, batch {failed_batch} failing {max_attempts} attempts")
+        for problem in problems:
+            print(f"  {problem}")
+    for size in (499, 500, 1000):
+        problems = await check_final_writes(size)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: {size} logs and {size} days with a checkpoint write")
+        for problem in problems:
+            print(f"  {problem}")
+    for name, check in (('day batches retried, oversized day rejected', check_days_retry),
+                        ('migration of 1234 epoch documents into days', check_migration)):
+        problems = await check()
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: {name}")
+        for problem in problems:
+            print(f"  {problem}")
+    for layout in MEASUREMENT_LAYOUTS:
+        problems = await check_sync(layout)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: sync in layout {layout}, Firestore cursor store, pages of 500 and 1000")
+        for problem in problems[:5]:
+            print(f"  {problem}")
+    return ok
+
+
+def main():
+    if not asyncio.run(run(parse_args())):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Check the vectorized ISO 8601 parser of log_times_to_millis against the scalar timestamp_to_millis.
+
+Pages of random log times mix every layout the parser handles: 'T' or space separator, no
+fraction or 1 to 9 digits of it, naive, 'Z', '±HH:MM' and '±HHMM', plus layouts it hands to pandas
+(no seconds, a lone date). Each page is converted in one call and value by value, for UTC, named
+zones and the machine's zone ('local'); every log must agree.
+
+Naive log times are read in the machine's local time, as the sync always did: for 'local',
+whole-second naive times around the DST transitions of --local-zone must also match the
+datetime.fromisoformat(...).timestamp() reading that produced the stored timestamps.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.check_log_time_paths import wall_times
+
+ZONES = ('UTC', 'local', 'Europe/Madrid', 'Asia/Kolkata', 'America/St_Johns')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--zones', nargs='+', default=list(ZONES))
+    parser.add_argument('--local-zone', default='America/New_York', help="TZ the check runs in, read as 'local'.")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def random_log_time(rng: random.Random) -> str:
+    moment = datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=rng.randrange(40 * 365 * 86400))
+    text = moment.strftime('%Y-%m-%d') + rng.choice('T ') + moment.strftime('%H:%M:%S')
+    layout = rng.random()
+    if layout < 0.05:
+        return text[:16]
+    if layout < 0.08:
+        return text[:10]
+    if rng.random() < 0.4:
+        text += '.' + ''.join(rng.choice('0123456789') for _ in range(rng.randint(1, 9)))
+    zone = rng.random()
+    if zone < 0.4:
+        return text
+    if zone < 0.55:
+        return text + 'Z'
+    sign = rng.choice('+-')
+    hours, minutes = rng.randint(0, 14), rng.choice((0, 15, 30, 45))
+    return text + f"{sign}{hours:02d}:{minutes:02d}" if zone < 0.8 else text + f"{sign}{hours:02d}{minutes:02d}"
+
+
+def check_pages(zone: str, pages: int, page_size: int, seed: int) -> list:
+    from utils.timestamps import log_times_to_millis, timestamp_to_millis
+
+    rng = random.Random(seed)
+    problems = []
+    for _ in range(pages):
+        page = [random_log_time(rng) for _ in range(page_size)]
+        vectorized = log_times_to_millis(page, zone).tolist()
+        scalar = [timestamp_to_millis(value, zone) for value in page]
+        problems.extend(f"{value!r}: {fast} vectorized, {slow} scalar"
+                        for value, fast, slow in zip(page, vectorized, scalar) if fast != slow)
+    return problems
+
+
+def check_previous_reading(local_zone: str) -> list:
+    from utils.timestamps import log_times_to_millis, timestamp_to_millis
+
+    times = wall_times(local_zone, (2023, 2024), 15)
+    strings = [value.strftime('%Y-%m-%d %H:%M:%S') for value in times]
+    previous = [int(datetime.datetime.fromisoformat(value).timestamp() * 1000) for value in strings]
+    problems = []
+    for name, millis in (('vectorized', log_times_to_millis(strings).tolist()), ('scalar', [timestamp_to_millis(value) for value in strings])):
+        problems.extend(f"{name} {value!r}: {new}, previously {old}" for value, new, old in zip(strings, millis, previous) if new != old)
+    return problems
+
+
+def main():
+    args = parse_args()
+    # Before the first conversion: the local zone is resolved once
+    os.environ['TZ'] = args.local_zone
+    time.tzset()
+
+    ok = True
+    for zone in args.zones:
+        problems = check_pages(zone, args.pages, args.page_size, args.seed)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: {zone}, {args.pages} pages of {args.page_size} mixed log times")
+        for problem in problems[:5]:
+            print(f"  {problem}")
+    problems = check_previous_reading(args.local_zone)
+    ok = ok and not problems
+    print(f"{'OK' if not problems else 'FAILED'}: naive log times read like before in {args.local_zone}, DST transitions included")
+    for problem in problems[:5]:
+        print(f"  {problem}")
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
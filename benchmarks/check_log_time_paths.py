@@ -0,0 +1,92 @@
+"""
+Check that every path of log_times_to_millis reads naive log times like timestamp_to_millis does.
+
+Small pages are converted one log at a time with zoneinfo, larger ones with the vectorized parser
+and pandas. For a few zones, wall times every --step minutes across the DST transitions of the
+given years (gaps and repeated hours included) go through the scalar path, the vectorized one for
+'YYYY-MM-DD HH:MM:SS' strings, the pandas fallback for other ISO layouts and datetime64 arrays. All
+four must agree on every log.
+"""
+import argparse
+import datetime
+import os
+import sys
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.timestamps import log_times_to_millis, timestamp_to_millis
+
+# Northern and southern hemisphere, a 30 minute DST shift (Lord Howe) and a transition at midnight (Santiago)
+ZONES = ('Europe/Madrid', 'America/New_York', 'Australia/Sydney', 'Australia/Lord_Howe', 'America/Santiago')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zones', nargs='+', default=list(ZONES))
+    parser.add_argument('--years', type=int, nargs='+', default=[2023, 2024, 2025])
+    parser.add_argument('--step', type=int, default=15, help="Minutes between wall times around a transition.")
+    return parser.parse_args(argv)
+
+
+def transitions(zone: str, year: int):
+    """The UTC offset changes of `zone` in `year`, as the naive UTC hours they happen in."""
+    tz = ZoneInfo(zone)
+    hour = datetime.datetime(year, 1, 1)
+    end = datetime.datetime(year + 1, 1, 1)
+    offset = hour.replace(tzinfo=datetime.timezone.utc).astimezone(tz).utcoffset()
+    while hour < end:
+        hour += datetime.timedelta(hours=1)
+        next_offset = hour.replace(tzinfo=datetime.timezone.utc).astimezone(tz).utcoffset()
+        if next_offset != offset:
+            yield hour, offset
+            offset = next_offset
+
+
+def wall_times(zone: str, years, step: int):
+    """Naive wall times every `step` minutes from three hours before to three hours after each transition."""
+    times = []
+    for year in years:
+        for utc_hour, offset in transitions(zone, year):
+            start = utc_hour + offset - datetime.timedelta(hours=3)
+            times.extend(start + datetime.timedelta(minutes=minute) for minute in range(0, 6 * 60 + 1, step))
+    return times
+
+
+def check_zone(zone: str, years, step: int) -> list:
+    times = wall_times(zone, years, step)
+    strings = [time.strftime('%Y-%m-%d %H:%M:%S') for time in times]
+    scalar = np.array([timestamp_to_millis(value, zone) for value in strings], dtype=np.int64)
+    paths = {
+        'vectorized strings': log_times_to_millis(strings, zone),
+        # No seconds: not the API's layout, so these rows go through pandas
+        'pandas fallback': log_times_to_millis([time.strftime('%Y-%m-%dT%H:%M') for time in times], zone),
+        'datetime64': log_times_to_millis(np.array(times, dtype='datetime64[ms]'), zone),
+    }
+    problems = []
+    for name, millis in paths.items():
+        differ = np.flatnonzero(millis != scalar)
+        if len(differ):
+            index = differ[0]
+            problems.append(f"{name}: {len(differ)} of {len(times)} logs differ, e.g. {strings[index]} -> "
+                            f"{millis[index]} instead of {scalar[index]}")
+    return problems, len(times)
+
+
+def main():
+    args = parse_args()
+    ok = True
+    for zone in args.zones:
+        problems, checked = check_zone(zone, args.years, args.step)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: {zone}, {checked} wall times around DST transitions")
+        for problem in problems:
+            print(f"  {problem}")
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Check the keyset pages of query_measurements_sqlite (the /measurements queries) against one query.
+
+For a few users with gaps in their data, raw and downsampled rows read in small pages must equal
+the rows of a single unpaged query. Every page must only read and group its own rows,
+not the ones before or after it, so reading all pages may not take much longer than the single
+query (--max-overhead) and the last pages not much longer than the first ones (--max-slowdown).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database_utils
+from utils.measurement_queries import query_measurements_sqlite
+
+START_MS = 1_700_000_000_000
+EPOCH_MS = 60_000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--epochs', type=int, default=200_000, help="Epochs per user.")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--every', type=int, nargs='+', default=[0, 1, 7, 60], help="Downsampling minutes, 0 for raw rows.")
+    parser.add_argument('--max-overhead', type=float, default=4.0, help="Allowed ratio of all pages' time to the single query's.")
+    parser.add_argument('--max-slowdown', type=float, default=3.0, help="Allowed ratio of the last pages' time to the first ones'.")
+    return parser.parse_args(argv)
+
+
+def fill(connection, table: str, users: int, epochs: int) -> None:
+    rng = np.random.default_rng(0)
+    for user_id in range(1, users + 1):
+        # Every tenth hour is missing, so some buckets are partial or absent
+        timestamps = START_MS + np.arange(epochs, dtype=np.int64) * EPOCH_MS
+        timestamps = timestamps[(timestamps // 3_600_000) % 10 != 0]
+        values = rng.random(len(timestamps)).round(3).tolist()
+        logs = [(timestamp, {'lux': value}) for timestamp, value in zip(timestamps.tolist(), values)]
+        for offset in range(0, len(logs), 10_000):
+            database_utils.insert_measurement_logs(connection, table, user_id, logs[offset:offset + 10_000])
+
+
+def read_pages(connection, table: str, user_ids, every: int, page_size: int):
+    _, pages = query_measurements_sqlite(connection, table, user_ids, downsample_minutes=every or None, page_size=page_size)
+    rows, seconds = [], []
+    while True:
+        start = time.perf_counter()
+        page = next(pages, None)
+        if page is None:
+            return rows, seconds
+        seconds.append(time.perf_counter() - start)
+        rows.extend(page)
+
+
+def check(connection, table: str, user_ids, every: int, page_size: int, max_overhead: float, max_slowdown: float) -> list:
+    expected, single = read_pages(connection, table, user_ids, every, page_size=10 ** 9)
+    rows, seconds = read_pages(connection, table, user_ids, every, page_size)
+    problems = []
+    if rows != expected:
+        differ = next((index for index, (row, reference) in enumerate(zip(rows, expected)) if row != reference), min(len(rows), len(expected)))
+        problems.append(f"{len(rows)} paged rows, {len(expected)} expected, first difference at row {differ}")
+    if sum(seconds) > max_overhead * sum(single):
+        problems.append(f"{len(seconds)} pages take {sum(seconds):.2f} s, one query {sum(single):.2f} s")
+    window = max(1, len(seconds) // 10)
+    if len(seconds) >= 4 * window:
+        first, last = np.median(seconds[1:1 + window]), np.median(seconds[-1 - window:-1])
+        if last > max_slowdown * first:
+            problems.append(f"pages slow down from {first * 1e3:.2f} ms to {last * 1e3:.2f} ms over {len(seconds)} pages")
+    return problems, len(rows), len(seconds)
+
+
+def main():
+    args = parse_args()
+    user_ids = list(range(1, args.users + 1))
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        connection = database_utils.connect_to_db(os.path.join(directory, 'pages.db'), tune=True)
+        table = database_utils.create_measurement_logs_table(connection, 'sensor_logs', 'last_place_table')
+        fill(connection, table, args.users, args.epochs)
+        for every in args.every:
+            problems, count, pages = check(connection, table, user_ids, every, args.page_size, args.max_overhead, args.max_slowdown)
+            ok = ok and not problems
+            label = f"every {every} minutes" if every else "raw rows"
+            print(f"{'OK' if not problems else 'FAILED'}: {label}, {count} rows in {pages} pages of {args.page_size}")
+            for problem in problems:
+                print(f"  {problem}")
+        database_utils.close_connection(connection)
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
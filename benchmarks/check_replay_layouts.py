@@ -0,0 +1,131 @@
+"""
+Check that logs staged while Firestore was failing reach Firestore in the sync's storage layout.
+
+For every layout and cursor store, a first sync runs with every Firestore commit failing, so pages
+are staged but not uploaded (and, with the SQLite cursor store, their cursors still advance); its
+failed users must still be reported with the pages they fetched. A second sync with Firestore
+back up must replay them before resuming: afterwards every layout the sync writes holds each of
+the API's epochs exactly once, the other layout holds nothing and no staged log is left pending.
+
+A backlog is replayed --chunk-size logs at a time: no read of the staging store returns more, and
+a replay while Firestore is still down reads every pending log once, leaving them all pending.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from google.api_core.exceptions import GoogleAPIError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.sync_fixture import SyncFixture, compare
+from utils import database_utils
+from utils.chunked_storage import LAYOUT_DAYS, LAYOUT_DOCUMENTS, MEASUREMENT_LAYOUTS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=3000, help="Records per user.")
+    parser.add_argument('--chunk-size', type=int, default=700, help="Logs per chunk of the chunked replay.")
+    return parser.parse_args(argv)
+
+
+async def check(args, layout: str, cursor_store: str) -> list:
+    options = ['--storage-layout', layout, '--cursor-store', cursor_store, '--page-size', '500', '--max-page-size', '500']
+    async with SyncFixture(args.users, args.epochs, firestore_error_rate=1.0) as fixture:
+        problems = []
+        try:
+            failed = await fixture.sync(*options)
+        except GoogleAPIError:
+            # The Firestore cursor store cannot flush either while Firestore is down
+            pass
+        else:
+            # A failed user's summary keeps what the sync did before the error
+            problems.extend(f"user {summary.user_id}: failed sync reported {summary.pages_fetched} pages ({summary.error})"
+                            for summary in failed if summary.ok or not summary.pages_fetched)
+        fixture.db.error_rate = 0.0
+        summaries = await fixture.sync(*options)
+
+        problems.extend(f"user {summary.user_id}: {summary.error}" for summary in summaries if not summary.ok)
+        for user_id in fixture.user_ids:
+            expected = fixture.expected(user_id)
+            documents, days = fixture.epoch_documents(user_id), fixture.day_epochs(user_id)
+            if layout == LAYOUT_DAYS:
+                problems.extend(f"user {user_id}: {problem}" for problem in compare('day documents', days, expected))
+                if documents:
+                    problems.append(f"user {user_id}: {len(documents)} per-epoch documents written in the days layout")
+            else:
+                problems.extend(f"user {user_id}: {problem}" for problem in compare('epoch documents', documents, expected))
+                if layout == LAYOUT_DOCUMENTS and days:
+                    problems.append(f"user {user_id}: {len(days)} day epochs written in the documents layout")
+                if layout != LAYOUT_DOCUMENTS:
+                    problems.extend(f"user {user_id}: {problem}" for problem in compare('day documents', days, expected))
+            staged = fixture.staged(user_id)
+            if staged['pending']:
+                problems.append(f"user {user_id}: {staged['pending']} staged logs still pending")
+    return problems
+
+
+async def check_chunks(args, layout: str) -> list:
+    problems = []
+    reads = []
+    get_pending = database_utils.get_pending_measurement_logs
+
+    def counted_get_pending(*arguments, **options):
+        rows = get_pending(*arguments, **options)
+        reads.append([timestamp for timestamp, _ in rows])
+        return rows
+
+    async with SyncFixture(1, args.epochs) as fixture:
+        # A backlog as a sync leaves it while Firestore is down: staged, not uploaded
+        database_utils.insert_measurement_logs(fixture.connection, database_utils.MEASUREMENT_LOGS_TABLE, 1,
+                                               [(timestamp, {'lux': 1.0}) for timestamp in fixture.expected(1)])
+        pending = fixture.staged(1)['pending']
+        database_utils.get_pending_measurement_logs = counted_get_pending
+        try:
+            for error_rate in (1.0, 0.0):
+                fixture.db.error_rate = error_rate
+                reads.clear()
+                result = await database_utils.upload_pending_measurement_logs_firestore(
+                    fixture.db, fixture.connection, database_utils.MEASUREMENT_LOGS_TABLE, 1, layout=layout, chunk_size=args.chunk_size)
+                read = [timestamp for rows in reads for timestamp in rows]
+                label = 'Firestore down' if error_rate else 'Firestore up'
+                if max(map(len, reads)) > args.chunk_size or len(read) != len(set(read)) or len(read) != pending:
+                    problems.append(f"{label}: {len(reads)} reads of {[len(rows) for rows in reads]} logs for {pending} pending")
+                left = fixture.staged(1)['pending']
+                if (error_rate and (left != pending or len(result.failed_timestamps) != pending)) or (not error_rate and (left or not result.ok)):
+                    problems.append(f"{label}: {left} of {pending} logs left pending, {len(result.failed_timestamps)} reported failed")
+        finally:
+            database_utils.get_pending_measurement_logs = get_pending
+        stored = fixture.day_epochs(1) if layout == LAYOUT_DAYS else fixture.epoch_documents(1)
+        problems.extend(compare('stored epochs', stored, fixture.expected(1)))
+    return problems
+
+
+async def run(args) -> bool:
+    ok = True
+    for layout in MEASUREMENT_LAYOUTS:
+        for cursor_store in ('sqlite', 'firestore'):
+            problems = await check(args, layout, cursor_store)
+            ok = ok and not problems
+            print(f"{'OK' if not problems else 'FAILED'}: layout {layout}, cursor store {cursor_store}")
+            for problem in problems[:5]:
+                print(f"  {problem}")
+    for layout in MEASUREMENT_LAYOUTS:
+        problems = await check_chunks(args, layout)
+        ok = ok and not problems
+        print(f"{'OK' if not problems else 'FAILED'}: layout {layout}, backlog replayed in chunks of {args.chunk_size}")
+        for problem in problems[:5]:
+            print(f"  {problem}")
+    return ok
+
+
+def main():
+    if not asyncio.run(run(parse_args())):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Check the async server's response cache: cancellation, change polling and per-user invalidation.
+
+- A caller cancelled while its load runs does not cancel the load for the callers waiting on it,
+  and a load whose callers all went away still completes (and its error is not left unretrieved).
+- The `changes` hook is awaited at most once per check interval, however many lookups arrive, and
+  concurrent lookups share one call.
+- A sync in another process that updates one user's light exposure drops that user's cached
+  response, and only that one: the other users are still served from the cache.
+- A summary table created before revisions existed gets the column when the sync opens it.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+from utils import database_utils
+from utils.cache import TTLCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_MS = 1_700_000_000_000
+USERS = (1, 2, 3)
+
+# Run in another process: stage a few more logs of one user, like a sync would
+SYNC_ONE_USER = '''
+import sys
+sys.path.insert(0, {root!r})
+from utils import database_utils
+connection = database_utils.connect_to_db({path!r})
+table = database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, 'last_place_table')
+database_utils.create_light_exposure_tables(connection)
+logs = [({start} + i * 60_000, {{'lux_melanopic': 1000.0}}) for i in range(60)]
+database_utils.insert_measurement_logs(connection, table, {user_id}, logs)
+database_utils.update_light_exposure_aggregates(connection, table, {user_id}, [t for t, _ in logs])
+connection.close()
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    return parser.parse_args(argv)
+
+
+def report(name: str, problems: list) -> bool:
+    print(f"{'OK' if not problems else 'FAILED'}: {name}")
+    for problem in problems:
+        print(f"  {problem}")
+    return not problems
+
+
+async def check_cancellation() -> list:
+    problems = []
+    unretrieved = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: unretrieved.append(context.get('message')))
+
+    cache = TTLCache()
+    loads = 0
+
+    async def load():
+        nonlocal loads
+        loads += 1
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    first = asyncio.ensure_future(cache.get_or_load(1, load))
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(cache.get_or_load(1, load))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    value = await second
+    if not first.cancelled() or value != 'value' or loads != 1 or cache.get(1) != 'value':
+        problems.append(f"cancelling the first caller: second got {value!r}, {loads} loads, cached {cache.get(1)!r}")
+
+    only = asyncio.ensure_future(cache.get_or_load(2, load))
+    await asyncio.sleep(0.01)
+    only.cancel()
+    await asyncio.sleep(0.1)
+    if cache.get(2) != 'value':
+        problems.append("a load whose only caller was cancelled was not stored")
+
+    async def fail():
+        await asyncio.sleep(0.02)
+        raise RuntimeError('load failed')
+
+    only = asyncio.ensure_future(cache.get_or_load(3, fail))
+    await asyncio.sleep(0.01)
+    only.cancel()
+    await asyncio.sleep(0.05)
+    gc.collect()
+    if unretrieved:
+        problems.append(f"unretrieved errors: {unretrieved}")
+    if 3 in cache._loading:
+        problems.append("a failed load stayed registered")
+    return problems
+
+
+async def check_change_polling() -> list:
+    problems = []
+    now = 0.0
+    calls = 0
+
+    async def changes():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return [1]
+
+    async def load():
+        return 'value'
+
+    cache = TTLCache(ttl=60.0, clock=lambda: now, changes=changes, check_interval=1.0)
+    await asyncio.gather(*(cache.get_or_load(key, load) for key in range(50)))
+    for key in range(50):
+        await cache.get_or_load(key, load)
+    if calls != 1:
+        problems.append(f"{calls} change checks for 100 lookups within one interval, expected 1")
+    now = 1.5
+    await cache.get_or_load(2, load)
+    if calls != 2:
+        problems.append(f"{calls} change checks after the interval, expected 2")
+    if cache.get(1) is not None or cache.get(2) is None or cache.stats.invalidations != 1:
+        problems.append(f"changed key kept or other keys dropped: {cache.stats.to_dict()}")
+    return problems
+
+
+def create_database(path: str, with_revisions: bool = True) -> None:
+    connection = database_utils.connect_to_db(path)
+    table = database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, 'last_place_table')
+    if not with_revisions:
+        # The summary table as created before revisions were added
+        connection.execute(f'''
+        CREATE TABLE {database_utils.LIGHT_EXPOSURE_SUMMARY_TABLE} (
+            user_id INTEGER NOT NULL, window_days INTEGER NOT NULL, mean_lux REAL, cumulative_lux REAL NOT NULL,
+            sample_count INTEGER NOT NULL, last_day TEXT NOT NULL, PRIMARY KEY (user_id, window_days)
+        ) WITHOUT ROWID
+        ''')
+    database_utils.create_light_exposure_tables(connection)
+    for user_id in USERS:
+        logs = [(START_MS + i * 60_000, {'lux_melanopic': float(user_id)}) for i in range(60)]
+        database_utils.insert_measurement_logs(connection, table, user_id, logs)
+        database_utils.update_light_exposure_aggregates(connection, table, user_id, [t for t, _ in logs])
+    connection.close()
+
+
+async def check_cross_process(with_revisions: bool) -> list:
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'backend.db')
+        create_database(path, with_revisions)
+        connection = sqlite3.connect(path)
+        columns = {row[1] for row in connection.execute(f"PRAGMA table_info({database_utils.LIGHT_EXPOSURE_SUMMARY_TABLE})")}
+        connection.close()
+        if 'revision' not in columns:
+            problems.append("the summary table has no revision column")
+
+        app = server.create_app(path, cache_check_interval=0.0)
+        async with TestClient(TestServer(app)) as client:
+            async def light_exposure(user_id: int) -> float:
+                async with client.get(f"/get_value/{user_id}") as response:
+                    return (await response.json())['cumulative_light_exposure']
+
+            before = {user_id: await light_exposure(user_id) for user_id in USERS}
+            hits = app['cache'].stats.hits
+            subprocess.run([sys.executable, '-c', SYNC_ONE_USER.format(root=ROOT, path=path, start=START_MS + 3_600_000, user_id=1)],
+                           check=True)
+            after = {user_id: await light_exposure(user_id) for user_id in USERS}
+            stats = app['cache'].stats
+
+        if after[1] == before[1]:
+            problems.append(f"user 1 still served {after[1]} after another process updated it")
+        if {user_id: after[user_id] for user_id in USERS[1:]} != {user_id: before[user_id] for user_id in USERS[1:]}:
+            problems.append(f"other users changed: {before} -> {after}")
+        if stats.hits - hits != len(USERS) - 1 or stats.invalidations != 1:
+            problems.append(f"{stats.hits - hits} hits and {stats.invalidations} invalidations after the update, "
+                            f"expected {len(USERS) - 1} and 1")
+    return problems
+
+
+async def run() -> bool:
+    ok = report("cancelled callers do not cancel shared loads", await check_cancellation())
+    ok = report("change checks rate-limited and shared", await check_change_polling()) and ok
+    ok = report("update from another process drops only that user", await check_cross_process(True)) and ok
+    ok = report("summary table from before revisions upgraded and invalidated per user", await check_cross_process(False)) and ok
+    return ok
+
+
+def main():
+    parse_args()
+    if not asyncio.run(run()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Check that a sync killed mid-run resumes without gaps or duplicates.
+
+The sync runs in a child process against the mock Condor API (served by this process) and a
+Firestore fake that journals every write to disk, so Firestore outlives the child like the real
+one would. The child SIGKILLs itself right before its Nth Firestore commit: no finally block, no
+cursor flush, and the page being written is staged in SQLite but not (fully) in Firestore. After
+a few such kills a last sync runs to the end. Every epoch of the API must then be in Firestore and
+in the staging store exactly once, with nothing left pending, for every layout and cursor store.
+"""
+import argparse
+import asyncio
+import os
+import pickle
+import random
+import signal
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.sync_fixture import SyncFixture, compare
+from utils.chunked_storage import LAYOUT_DAYS, LAYOUT_DOCUMENTS, MEASUREMENT_LAYOUTS
+
+
+class JournaledFirestore(FakeFirestore):
+    """A FakeFirestore that appends every write to a journal file and starts from what it holds."""
+
+    def __init__(self, journal: str, kill_at_commit: int = 0):
+        super().__init__()
+        self.journal = journal
+        self.kill_at_commit = kill_at_commit
+        self.commits = 0
+        if os.path.exists(journal):
+            with open(journal, 'rb') as file:
+                while True:
+                    try:
+                        path, data, merge = pickle.load(file)
+                    except EOFError:
+                        break
+                    super()._write(path, data, merge)
+        self.writes = 0
+
+    async def _rpc(self, kind: str) -> None:
+        if kind == 'commit':
+            self.commits += 1
+            if self.commits == self.kill_at_commit:
+                os.kill(os.getpid(), signal.SIGKILL)
+        await super()._rpc(kind)
+
+    def _write(self, path: str, data: dict, merge: bool) -> None:
+        super()._write(path, data, merge)
+        with open(self.journal, 'ab') as file:
+            pickle.dump((path, data, merge), file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--epochs', type=int, default=3000, help="Records per user.")
+    parser.add_argument('--kills', type=int, default=3, help="Kills before the sync is let finish.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the commits the kills happen at.")
+    # Internal: run one sync in this process (the child)
+    parser.add_argument('--child', nargs=4, metavar=('URL', 'CREDENTIALS', 'DB', 'JOURNAL'), help=argparse.SUPPRESS)
+    parser.add_argument('--kill-at-commit', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('sync_args', nargs=argparse.REMAINDER,
+                        help="Options passed on to every sync after '--' (e.g. -- --record-cursors)")
+    return parser.parse_args(argv)
+
+
+async def child(args) -> None:
+    import sync_cli
+    from utils import database_utils
+    from utils.metrics import Metrics
+
+    url, credentials_file, db_path, journal = args.child
+    passthrough = args.sync_args[1:] if args.sync_args[:1] == ['--'] else args.sync_args
+    sync_args = sync_cli.parse_args(['--api-url', url, '--credentials-file', credentials_file, '--rate-limit', '100000',
+                                     *passthrough])
+    connection = database_utils.connect_to_db(db_path)
+    db = JournaledFirestore(journal, args.kill_at_commit)
+    try:
+        await sync_cli.sync_users(sync_args, db, connection, list(range(1, args.users + 1)), sync_args.rate_limit, Metrics())
+    finally:
+        database_utils.close_connection(connection)
+
+
+async def run_child(fixture: SyncFixture, journal: str, options: list, kill_at_commit: int = 0) -> int:
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--users', str(len(fixture.user_ids)), '--kill-at-commit', str(kill_at_commit),
+        '--child', fixture.url, fixture.credentials_file, fixture.db_path, journal, '--', *options,
+        stdout=asyncio.subprocess.DEVNULL)
+    return await process.wait()
+
+
+async def check(args, layout: str, cursor_store: str, rng: random.Random) -> list:
+    passthrough = args.sync_args[1:] if args.sync_args[:1] == ['--'] else args.sync_args
+    options = ['--storage-layout', layout, '--cursor-store', cursor_store, '--page-size', '500', '--max-page-size', '500',
+               '--concurrency', '2', *passthrough]
+    async with SyncFixture(args.users, args.epochs) as fixture:
+        journal = os.path.join(fixture.directory.name, 'firestore.journal')
+        problems = []
+        page_commits = args.epochs * args.users // 500
+        for _ in range(args.kills):
+            # Every run resumes where the last one died; one with fewer commits left than the kill point just finishes
+            status = await run_child(fixture, journal, options, kill_at_commit=rng.randint(1, page_commits))
+            if status not in (0, -signal.SIGKILL):
+                problems.append(f"run meant to be killed exited with {status}")
+        status = await run_child(fixture, journal, options)
+        if status != 0:
+            problems.append(f"final run exited with {status}")
+
+        fixture.db = JournaledFirestore(journal)
+        for user_id in fixture.user_ids:
+            expected = fixture.expected(user_id)
+            if layout != LAYOUT_DAYS:
+                problems.extend(f"user {user_id}: {problem}" for problem in compare('epoch documents', fixture.epoch_documents(user_id), expected))
+            if layout != LAYOUT_DOCUMENTS:
+                problems.extend(f"user {user_id}: {problem}" for problem in compare('day documents', fixture.day_epochs(user_id), expected))
+            staged = fixture.staged(user_id)
+            if staged['rows'] != len(expected) or staged['pending']:
+                problems.append(f"user {user_id}: {staged['rows']} staged rows ({staged['pending']} pending), expected {len(expected)}")
+    return problems
+
+
+async def run(args) -> bool:
+    rng = random.Random(args.seed)
+    ok = True
+    for layout in MEASUREMENT_LAYOUTS:
+        for cursor_store in ('sqlite', 'firestore'):
+            problems = await check(args, layout, cursor_store, rng)
+            ok = ok and not problems
+            print(f"{'OK' if not problems else 'FAILED'}: layout {layout}, cursor store {cursor_store}, {args.kills} kills")
+            for problem in problems[:5]:
+                print(f"  {problem}")
+    return ok
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        asyncio.run(child(args))
+    elif not asyncio.run(run(args)):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+In-memory stand-in for firestore.AsyncClient, covering what the sync and the query helpers use.
+
+Documents live in a dict keyed by path. Every round trip (document get/set, get_all, query stream,
+batch commit) counts as one RPC and can be given a latency; commits can fail with
+ServiceUnavailable at a given rate to exercise the retry path, and fail with InvalidArgument like
+Firestore's when a batch holds more than 500 writes. Counters report RPCs per kind and
+document reads and writes, which is what Firestore bills. With retain=False writes are counted
+but not kept, so memory benchmarks measure the sync rather than the fake's storage.
+
+To run against the Firestore emulator instead, start it and set FIRESTORE_EMULATOR_HOST (main.py
+then connects to it without service account credentials).
+"""
+import asyncio
+import copy
+import operator
+import random
+from collections import Counter
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+# Most writes Firestore accepts in one commit
+MAX_BATCH_WRITES = 500
+
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '==': operator.eq, '>=': operator.ge, '>': operator.gt, '!=': operator.ne}
+
+
+class FakeSnapshot:
+    def __init__(self, reference: 'FakeDocument', data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return self._data.get(field) if self._data else None
+
+
+class FakeDocument:
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name: str) -> 'FakeCollection':
+        return FakeCollection(self.db, f"{self.path}/{name}")
+
+    async def get(self) -> FakeSnapshot:
+        await self.db._rpc('get')
+        self.db.reads += 1
+        return FakeSnapshot(self, self.db.documents.get(self.path))
+
+    async def set(self, data: dict, merge: bool = False) -> None:
+        await self.db._rpc('set')
+        self.db._write(self.path, data, merge)
+
+
+class FakeQuery:
+    def __init__(self, collection: 'FakeCollection', filters=(), order: Optional[str] = None, count: Optional[int] = None,
+                 after: Optional[dict] = None):
+        self.collection = collection
+        self.filters = list(filters)
+        self.order = order
+        self.count = count
+        self.after = after
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None) -> 'FakeQuery':
+        condition = (filter.field_path, filter.op_string, filter.value) if filter is not None else (field_path, op_string, value)
+        return FakeQuery(self.collection, self.filters + [condition], self.order, self.count, self.after)
+
+    def order_by(self, field_path: str) -> 'FakeQuery':
+        return FakeQuery(self.collection, self.filters, field_path, self.count, self.after)
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return FakeQuery(self.collection, self.filters, self.order, count, self.after)
+
+    def start_after(self, document_fields: dict) -> 'FakeQuery':
+        """Only the order_by field of the cursor is used."""
+        return FakeQuery(self.collection, self.filters, self.order, self.count, document_fields)
+
+    async def stream(self) -> AsyncIterator[FakeSnapshot]:
+        db = self.collection.db
+        await db._rpc('query')
+        documents = [(path, data) for path, data in db._children(self.collection.path)]
+        for field, op, value in self.filters:
+            documents = [(path, data) for path, data in documents if field in data and _OPERATORS[op](data[field], value)]
+        if self.order is not None:
+            documents.sort(key=lambda item: item[1].get(self.order))
+            if self.after is not None:
+                documents = [(path, data) for path, data in documents if data.get(self.order) > self.after[self.order]]
+        if self.count is not None:
+            documents = documents[:self.count]
+        # An empty result still bills one read
+        db.reads += max(1, len(documents))
+        for path, data in documents:
+            yield FakeSnapshot(FakeDocument(db, path), copy.deepcopy(data))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self.db = db
+        self.path = path
+        super().__init__(self)
+
+    def document(self, document_id: str) -> FakeDocument:
+        return FakeDocument(self.db, f"{self.path}/{document_id}")
+
+    async def list_documents(self) -> AsyncIterator[FakeDocument]:
+        await self.db._rpc('list')
+        prefix = self.path + '/'
+        ids = sorted({path[len(prefix):].split('/', 1)[0] for path in self.db.documents if path.startswith(prefix)})
+        for document_id in ids:
+            yield self.document(document_id)
+
+
+class FakeWriteBatch:
+    def __init__(self, db: 'FakeFirestore'):
+        self.db = db
+        self._writes = []
+
+    def set(self, reference: FakeDocument, data: dict, merge: bool = False) -> None:
+        self._writes.append((reference.path, copy.deepcopy(data) if self.db.retain else data, merge))
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    async def commit(self) -> None:
+        await self.db._rpc('commit')
+        if len(self._writes) > MAX_BATCH_WRITES:
+            raise google_exceptions.InvalidArgument(f"maximum {MAX_BATCH_WRITES} writes allowed per request, got {len(self._writes)}")
+        if self.db.error_rate and self.db.random.random() < self.db.error_rate:
+            self.db.failed_commits += 1
+            raise google_exceptions.ServiceUnavailable('injected commit failure')
+        for path, data, merge in self._writes:
+            self.db._write(path, data, merge)
+
+
+class FakeFirestore:
+    """
+    The subset of firestore.AsyncClient the sync uses, in memory.
+
+    rpc_latency seconds are awaited on every round trip; batch commits fail with probability error_rate.
+    """
+
+    def __init__(self, rpc_latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, retain: bool = True):
+        self.documents: Dict[str, dict] = {}
+        self.retain = retain
+        self.rpc_latency = rpc_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.rpcs = Counter()
+        self.reads = 0
+        self.writes = 0
+        self.failed_commits = 0
+
+    def reset_counters(self) -> None:
+        self.rpcs.clear()
+        self.reads = self.writes = self.failed_commits = 0
+
+    def counters(self) -> dict:
+        return {'rpcs': sum(self.rpcs.values()), **{f"rpcs_{kind}": value for kind, value in sorted(self.rpcs.items())},
+                'reads': self.reads, 'writes': self.writes, 'failed_commits': self.failed_commits}
+
+    async def _rpc(self, kind: str) -> None:
+        self.rpcs[kind] += 1
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+
+    def _write(self, path: str, data: dict, merge: bool) -> None:
+        self.writes += 1
+        if not self.retain:
+            return
+        data = copy.deepcopy(data)
+        if merge and path in self.documents:
+            self.documents[path].update(data)
+        else:
+            self.documents[path] = data
+
+    def _children(self, collection_path: str):
+        prefix = collection_path + '/'
+        return [(path, data) for path, data in self.documents.items() if path.startswith(prefix) and '/' not in path[len(prefix):]]
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    async def get_all(self, references: Iterable[FakeDocument]) -> AsyncIterator[FakeSnapshot]:
+        references = list(references)
+        await self._rpc('get_all')
+        self.reads += len(references)
+        for reference in references:
+            yield FakeSnapshot(reference, copy.deepcopy(self.documents.get(reference.path)))
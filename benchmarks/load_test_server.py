@@ -0,0 +1,141 @@
+"""
+Load test for the /get_value/{user_id} endpoint: requests/sec and latency percentiles.
+
+Starts the server on a temporary database filled with synthetic light exposure aggregates,
+unless --url points at a running server.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import HTTPServer
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from utils import database_utils
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def build_database(path: str, users: int, days: int = 30, epochs_per_day: int = 24) -> None:
+    connection = database_utils.connect_to_db(path)
+    table = database_utils.create_measurement_logs_table(connection, 'sensor_logs', 'last_place_table')
+    database_utils.create_light_exposure_tables(connection)
+    start = 1_704_067_200_000
+    for user_id in range(1, users + 1):
+        logs = [(start + i * DAY_MS // epochs_per_day, {'lux_melanopic': random.random() * 300})
+                for i in range(days * epochs_per_day)]
+        database_utils.insert_measurement_logs(connection, table, user_id, logs)
+        database_utils.update_light_exposure_aggregates(connection, table, user_id, (t for t, _ in logs))
+    database_utils.close_connection(connection)
+
+
+def start_legacy_server(db_path: str, port: int):
+    class QuietHandler(server.RequestHandler):
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(('127.0.0.1', port), QuietHandler)
+    httpd.connection = server.connect_read_only(db_path)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        httpd.shutdown()
+        httpd.connection.close()
+    return stop
+
+
+def start_async_server(db_path: str, port: int):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server.create_app(db_path), access_log=None)
+
+    async def start():
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    loop.run_until_complete(start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return stop
+
+
+SERVERS = {'legacy': start_legacy_server, 'async': start_async_server}
+
+
+async def run_load_async(url: str, users: int, requests: int, concurrency: int):
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client(session):
+        for _ in remaining:
+            user_id = random.randint(1, users)
+            start = time.perf_counter()
+            async with session.get(f"{url}/get_value/{user_id}") as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+
+    # One keep-alive connection per simulated client
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def run_load(url: str, users: int, requests: int, concurrency: int):
+    latencies, elapsed = asyncio.run(run_load_async(url, users, requests, concurrency))
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1e3
+
+    return requests / elapsed, percentile(50), percentile(99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help="Test a running server instead of starting one.")
+    parser.add_argument('--server', choices=sorted(SERVERS), nargs='+', default=['legacy', 'async'])
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--port', type=int, default=8181)
+    args = parser.parse_args()
+
+    if args.url:
+        targets = [(args.url, None, args.url)]
+    else:
+        directory = tempfile.mkdtemp()
+        db_path = os.path.join(directory, 'backend.db')
+        build_database(db_path, args.users)
+        targets = []
+        for offset, name in enumerate(args.server):
+            port = args.port + offset
+            targets.append((name, SERVERS[name](db_path, port), f"http://127.0.0.1:{port}"))
+            time.sleep(0.2)
+
+    for name, stop, url in targets:
+        try:
+            rps, p50, p99 = run_load(url, args.users, args.requests, args.concurrency)
+            print(f"{name:<10} {rps:8.0f} req/s   p50 {p50:6.2f} ms   p99 {p99:6.2f} ms")
+        finally:
+            if stop is not None:
+                stop()
+
+
+if __name__ == "__main__":
+    main()
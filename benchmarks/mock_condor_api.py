@@ -0,0 +1,161 @@
+"""
+Local stand-in for the Condor API: synthetic, paginated actigraphy data for benchmarks and soak tests.
+
+Serves GET /v1/users/{user_id} and GET /v1/users/{user_id}/actigraphy_data?limit=&starting_after=
+with records shaped like the real API's. Every user has `epochs` one-minute epochs; record ids run
+from 1 and `starting_after` is the id of the last record returned (None once there is nothing more).
+Response latency and the rate of 503 errors are configurable, and counters tell how many requests
+and records were served (requests also per user).
+
+Run standalone and point the sync at it:
+
+    python benchmarks/mock_condor_api.py --port 8080 --users 400 --epochs 10000 --latency 0.05
+    CONDOR_API_URL=http://127.0.0.1:8080 python main.py --user-range 1 401 ...
+"""
+import argparse
+import asyncio
+import datetime
+import math
+import random
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+from aiohttp import web
+
+START = datetime.datetime(2024, 1, 1)
+EPOCH = datetime.timedelta(minutes=1)
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 1000
+
+
+class MockCondorAPI:
+    """
+    Synthetic actigraphy for users 1..users (or the given user ids), epochs records each.
+
+    latency seconds (plus up to `jitter` more) are added to every response, and a request fails
+    with 503 and Retry-After: 0 with probability error_rate.
+    """
+
+    def __init__(self, users=100, epochs: int = 1440, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 max_limit: int = MAX_LIMIT, seed: int = 0):
+        user_ids = range(1, users + 1) if isinstance(users, int) else users
+        self.epochs: Dict[int, int] = {user_id: epochs for user_id in user_ids}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_limit = max_limit
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.records_served = 0
+        self.requests_per_user = Counter()
+
+    def add_epochs(self, user_ids: Iterable[int], count: int) -> None:
+        """Let users' devices upload `count` more epochs (new users start from zero)."""
+        for user_id in user_ids:
+            self.epochs[user_id] = self.epochs.get(user_id, 0) + count
+
+    def reset_counters(self) -> None:
+        self.requests = self.errors = self.records_served = 0
+        self.requests_per_user.clear()
+
+    @staticmethod
+    def record(user_id: int, record_id: int) -> dict:
+        """Record `record_id` of a user: deterministic, with a daily light cycle in the lux channels."""
+        minute = record_id - 1
+        daylight = max(0.0, math.sin((minute % 1440 - 360) / 1440 * 2 * math.pi))
+        lux = round(daylight * (800 + (user_id * 37 + minute) % 200), 2)
+        return {
+            'id': record_id, 'company_id': 1, 'user_id': user_id, 'device_id': 1000 + user_id, 'log_type': 'actigraphy',
+            'log_time': (START + minute * EPOCH).strftime('%Y-%m-%d %H:%M:%S'),
+            'body_part': 'wrist', 'from_service': 'condor', 'state': 0,
+            'lux_melanopic': round(lux * 0.6, 2), 'lux': lux, 'lux_photopic': lux, 'lux_rhodopic': round(lux * 0.7, 2),
+            'lux_cyanopic': round(lux * 0.4, 2), 'lux_chloropic': round(lux * 0.9, 2), 'lux_erythropic': round(lux * 0.8, 2),
+            'pim': (user_id + minute * 7) % 500, 'tat': (minute * 3) % 60, 'zcm': minute % 17,
+            'temperature': round(31 + daylight * 3, 2), 'ext_temperature': round(18 + daylight * 8, 2),
+            'battery': 100 - minute % 100, 'activity': (minute * 11) % 300,
+        }
+
+    async def _respond(self, request: web.Request) -> Optional[web.Response]:
+        """Common latency and error injection; returns the error response if this request fails."""
+        self.requests += 1
+        self.requests_per_user[request.match_info.get('user_id')] += 1
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'error': 'service unavailable'}, status=503, headers={'Retry-After': '0'})
+        return None
+
+    def _user(self, request: web.Request) -> int:
+        try:
+            user_id = int(request.match_info['user_id'])
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid user id')
+        if user_id not in self.epochs:
+            raise web.HTTPNotFound(text=f'user {user_id} not found')
+        return user_id
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        error = await self._respond(request)
+        if error is not None:
+            return error
+        user_id = self._user(request)
+        return web.json_response({'id': user_id, 'company_id': 1, 'devices': [{'id': 1000 + user_id}]})
+
+    async def get_actigraphy_data(self, request: web.Request) -> web.Response:
+        error = await self._respond(request)
+        if error is not None:
+            return error
+        user_id = self._user(request)
+        try:
+            limit = min(int(request.query.get('limit', DEFAULT_LIMIT)), self.max_limit)
+            starting_after = int(request.query.get('starting_after', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid limit or starting_after')
+        if limit < 1:
+            raise web.HTTPBadRequest(text='limit must be positive')
+
+        available = self.epochs[user_id]
+        first = max(starting_after, 0) + 1
+        last = min(first + limit - 1, available)
+        data = [self.record(user_id, record_id) for record_id in range(first, last + 1)]
+        self.records_served += len(data)
+        next_starting_after = str(last) if data and last < available else None
+        return web.json_response({'data': data, 'starting_after': next_starting_after})
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/v1/users/{user_id}', self.get_user)
+        app.router.add_get('/v1/users/{user_id}/actigraphy_data', self.get_actigraphy_data)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        """Serve in the running event loop; returns (runner, base_url). Port 0 picks a free port."""
+        runner = web.AppRunner(self.create_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--users', type=int, default=100, help="Users 1..N exist.")
+    parser.add_argument('--epochs', type=int, default=1440, help="Records per user.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many more seconds, at random.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with 503.")
+    args = parser.parse_args()
+
+    api = MockCondorAPI(args.users, args.epochs, args.latency, args.jitter, args.error_rate)
+    print(f"Mock Condor API for users 1..{args.users} ({args.epochs} epochs each) on http://{args.host}:{args.port}")
+    web.run_app(api.create_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
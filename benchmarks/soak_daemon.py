@@ -0,0 +1,153 @@
+"""
+Soak test of the polling daemon (main.py daemon) against the mock Condor API and the in-memory Firestore.
+
+A fraction of the users is "active": their devices upload new epochs every --tick seconds, the
+others never do. The daemon runs for --duration seconds and is then stopped with SIGINT, like an
+operator would. The test checks that:
+
+- active users are polled far more often than dormant ones (the adaptive schedule works),
+- shutdown is graceful: after a final one-shot catch-up sync every user's Firestore data matches
+  what the API holds, with nothing lost or duplicated,
+- RSS stays flat over the run (sampled every tick).
+"""
+import argparse
+import asyncio
+import os
+import resource
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_cli as sync_main
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.mock_condor_api import MockCondorAPI
+from utils import database_utils
+from utils.metrics import Metrics
+
+
+def rss_bytes() -> int:
+    """Current resident set size (Linux), or the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--active', type=float, default=0.1, help="Fraction of users whose devices keep uploading.")
+    parser.add_argument('--epochs', type=int, default=1440, help="Records per user at the start.")
+    parser.add_argument('--tick', type=float, default=1.0, help="Seconds between uploads of the active devices.")
+    parser.add_argument('--epochs-per-tick', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=60.0, help="Seconds the daemon runs before SIGINT.")
+    parser.add_argument('--api-latency', type=float, default=0.01)
+    parser.add_argument('--api-error-rate', type=float, default=0.01)
+    parser.add_argument('--firestore-latency', type=float, default=0.002)
+    parser.add_argument('sync_args', nargs=argparse.REMAINDER,
+                        help="Options passed on to main.py after '--' (defaults: --min-interval 1 --max-interval 16)")
+    return parser.parse_args(argv)
+
+
+def count_documents(db: FakeFirestore, user_ids) -> dict:
+    """Measurement epochs stored per user, whatever the layout (documents or packed days)."""
+    counts = dict.fromkeys(user_ids, 0)
+    for path, data in db.documents.items():
+        parts = path.split('/')
+        if parts[0] == 'actigraphy_data' and len(parts) == 4 and parts[2] == 'measurements':
+            counts[int(parts[1])] += 1
+    if not any(counts.values()):
+        for path, data in db.documents.items():
+            parts = path.split('/')
+            if len(parts) == 4 and parts[2] == 'days' and 'count' in data:
+                counts[int(parts[1])] += data['count']
+    return counts
+
+
+async def soak(args) -> bool:
+    user_ids = list(range(1, args.users + 1))
+    active = user_ids[:max(1, int(len(user_ids) * args.active))]
+    api = MockCondorAPI(user_ids, args.epochs, args.api_latency, args.api_latency / 2, args.api_error_rate)
+    db = FakeFirestore(args.firestore_latency)
+    runner, url = await api.start()
+    samples = []
+
+    async def devices_upload():
+        while True:
+            await asyncio.sleep(args.tick)
+            api.add_epochs(active, args.epochs_per_tick)
+            samples.append(rss_bytes())
+
+    async def stop_later():
+        await asyncio.sleep(args.duration)
+        uploads.cancel()
+        os.kill(os.getpid(), signal.SIGINT)
+
+    with tempfile.TemporaryDirectory() as directory:
+        credentials_file = os.path.join(directory, 'credentials.txt')
+        with open(credentials_file, 'w') as file:
+            file.write("local-api-key\nlocal-token\n")
+        passthrough = args.sync_args[1:] if args.sync_args[:1] == ['--'] else args.sync_args
+        daemon_args = sync_main.parse_args(['--daemon', '--api-url', url, '--credentials-file', credentials_file,
+                                            '--rate-limit', '100000', '--min-interval', '1', '--max-interval', '16',
+                                            '--report-interval', '10', *passthrough])
+        connection = database_utils.connect_to_db(os.path.join(directory, 'soak.db'))
+        last_place_table = database_utils.create_table(connection, database_utils.LAST_PLACE_TABLE)
+        database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+        database_utils.create_light_exposure_tables(connection)
+
+        print(f"{len(user_ids)} users ({len(active)} active, +{args.epochs_per_tick} epochs every {args.tick:g}s) "
+              f"for {args.duration:g}s")
+        start = time.perf_counter()
+        uploads = asyncio.create_task(devices_upload())
+        stopper = asyncio.create_task(stop_later())
+        await sync_main.run_daemon(daemon_args, db, connection, user_ids)
+        stopped = time.perf_counter() - start
+        await stopper
+        ingested = count_documents(db, user_ids)
+
+        api_requests = dict(api.requests_per_user)
+        per_active = sum(api_requests.get(str(user_id), 0) for user_id in active) / len(active)
+        dormant = [user_id for user_id in user_ids if user_id not in active]
+        per_dormant = sum(api_requests.get(str(user_id), 0) for user_id in dormant) / max(1, len(dormant))
+        behind = sum(api.epochs[user_id] - ingested[user_id] for user_id in user_ids)
+        print(f"stopped after {stopped:.1f}s: {api.requests} API requests ({api.errors} errors), "
+              f"{per_active:.1f} per active user, {per_dormant:.1f} per dormant user; "
+              f"Firestore {sum(db.rpcs.values())} RPCs; {behind} epochs not ingested yet at shutdown")
+        if samples:
+            # The in-memory Firestore's documents count towards RSS too
+            middle = samples[len(samples) // 2]
+            print(f"RSS: {samples[0] / 2 ** 20:.1f} MiB after the first tick, {middle / 2 ** 20:.1f} MiB half way, "
+                  f"{samples[-1] / 2 ** 20:.1f} MiB at the end ({len(db.documents)} Firestore documents held)")
+
+        # Catch up once more without the daemon: nothing may have been lost or skipped at shutdown
+        catch_up_args = sync_main.parse_args(['--api-url', url, '--credentials-file', credentials_file, '--rate-limit', '100000',
+                                              *passthrough])
+        await sync_main.sync_users(catch_up_args, db, connection, user_ids, catch_up_args.rate_limit, Metrics())
+        database_utils.close_connection(connection)
+        await runner.cleanup()
+
+    final = count_documents(db, user_ids)
+    mismatched = {user_id: (final[user_id], api.epochs[user_id]) for user_id in user_ids if final[user_id] != api.epochs[user_id]}
+    if mismatched:
+        print(f"FAILED: {len(mismatched)} users differ from the API (stored, expected): {list(mismatched.items())[:5]}")
+    else:
+        print(f"OK: all {len(user_ids)} users match the API after the catch-up sync")
+    adaptive = per_active > 2 * per_dormant
+    if not adaptive:
+        print("FAILED: active users were not polled clearly more often than dormant ones")
+    return not mismatched and adaptive
+
+
+def main():
+    args = parse_args()
+    if not asyncio.run(soak(args)):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
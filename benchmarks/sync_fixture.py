@@ -0,0 +1,106 @@
+"""
+The mock Condor API, the in-memory Firestore and a temporary staging store wired together, for the
+check_*.py scripts that run the real sync and then look at what it stored:
+
+    async with SyncFixture(users=3, epochs=3000) as fixture:
+        await fixture.sync('--storage-layout', 'days')
+        fixture.day_epochs(1)
+"""
+import os
+import sys
+import tempfile
+from collections import Counter
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_cli
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.mock_condor_api import MockCondorAPI
+from utils import database_utils
+from utils.chunked_storage import decode_day
+from utils.metrics import Metrics
+from utils.timestamps import log_times_to_millis
+
+
+class SyncFixture:
+    """A mock API with users 1..users, a FakeFirestore and a staging database in a temporary directory."""
+
+    def __init__(self, users: int = 3, epochs: int = 3000, firestore_error_rate: float = 0.0, **api_options):
+        self.user_ids = list(range(1, users + 1))
+        self.api = MockCondorAPI(self.user_ids, epochs, **api_options)
+        self.db = FakeFirestore(error_rate=firestore_error_rate)
+        self.connection = None
+
+    async def __aenter__(self) -> 'SyncFixture':
+        self.runner, self.url = await self.api.start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.credentials_file = os.path.join(self.directory.name, 'credentials.txt')
+        with open(self.credentials_file, 'w') as file:
+            file.write("local-api-key\nlocal-token\n")
+        self.db_path = os.path.join(self.directory.name, 'staging.db')
+        self.connection = self.connect()
+        last_place_table = database_utils.create_table(self.connection, database_utils.LAST_PLACE_TABLE)
+        database_utils.create_measurement_logs_table(self.connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+        database_utils.create_light_exposure_tables(self.connection)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        database_utils.close_connection(self.connection)
+        await self.runner.cleanup()
+        self.directory.cleanup()
+
+    def connect(self):
+        return database_utils.connect_to_db(self.db_path)
+
+    def args(self, *options: str):
+        """sync_cli arguments against the mock API, plus `options`."""
+        return sync_cli.parse_args(['--api-url', self.url, '--credentials-file', self.credentials_file,
+                                    '--rate-limit', '100000', *options])
+
+    async def sync(self, *options: str, user_ids: List[int] = None) -> list:
+        """One sync run (sync_cli.sync_users) of the users; returns their summaries."""
+        args = self.args(*options)
+        return await sync_cli.sync_users(args, self.db, self.connection, user_ids or self.user_ids, args.rate_limit, Metrics())
+
+    def expected(self, user_id: int) -> List[int]:
+        """Timestamps (epoch ms) of every record the API holds for a user, as the sync computes them."""
+        log_times = [MockCondorAPI.record(user_id, record_id)['log_time'] for record_id in range(1, self.api.epochs[user_id] + 1)]
+        return log_times_to_millis(log_times).tolist()
+
+    def epoch_documents(self, user_id: int) -> List[int]:
+        """Timestamps of the user's per-epoch measurement documents."""
+        prefix = f"actigraphy_data/{user_id}/measurements/"
+        return sorted(data['timestamp'] for path, data in self.db.documents.items() if path.startswith(prefix))
+
+    def day_epochs(self, user_id: int) -> List[int]:
+        """Timestamps of every epoch in the user's packed day documents, duplicates included."""
+        prefix = f"actigraphy_days/{user_id}/days/"
+        timestamps = []
+        for path, data in self.db.documents.items():
+            if path.startswith(prefix):
+                offsets, _ = decode_day(data)
+                timestamps.extend((offsets.astype('int64') + data['day_start']).tolist())
+        return sorted(timestamps)
+
+    def staged(self, user_id: int) -> Dict[str, int]:
+        """Staged rows of a user: how many in total and how many still waiting for upload."""
+        total, pending = self.connection.execute(
+            f"SELECT COUNT(*), TOTAL(uploaded = 0) FROM {database_utils.MEASUREMENT_LOGS_TABLE} WHERE user_id = ?",
+            (user_id,)).fetchone()
+        return {'rows': total, 'pending': int(pending)}
+
+
+def compare(label: str, stored: List[int], expected: List[int]) -> List[str]:
+    """Problems of `stored` timestamps against `expected`: duplicates, gaps and strays (empty if none)."""
+    problems = []
+    duplicates = sum(count - 1 for count in Counter(stored).values() if count > 1)
+    missing = len(set(expected) - set(stored))
+    extra = len(set(stored) - set(expected))
+    if duplicates:
+        problems.append(f"{label}: {duplicates} duplicated epochs")
+    if missing:
+        problems.append(f"{label}: {missing} of {len(expected)} epochs missing")
+    if extra:
+        problems.append(f"{label}: {extra} unexpected epochs")
+    return problems
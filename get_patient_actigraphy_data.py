@@ -1,79 +1,282 @@
 import sys
 import inspect
 import os
-import utils
 import sqlite3
-from datetime import datetime
-import random
-import aiohttp
+import asyncio
+import time
+from typing import Optional, Union
 from firebase_admin import firestore
 
 folder = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 root = folder[0 : (len(folder) - len("examples"))]
 sys.path.insert(0, root)
  
-from utils.api_requests import get_user_actigraphy_data
-from utils.actigraphy_utils import create_plots
-from utils.database_utils import insert_or_update_user_last_place_firestore, get_user_data_firestore, insert_measurement_log_firestore
+from utils.api_requests import CondorClient
+from utils.channels import DEFAULT_PROJECTION, ChannelProjection
+from utils.chunked_storage import LAYOUT_BOTH, LAYOUT_DAYS, LAYOUT_DOCUMENTS, write_measurement_days_firestore
+from utils.cursor_store import Cursor, CursorStore
+from utils.measurement_page import MeasurementPage
+from utils.metrics import (
+    API_PAGE_SECONDS,
+    FIRESTORE_BATCHES,
+    FIRESTORE_FAILED_LOGS,
+    FIRESTORE_WRITE_SECONDS,
+    PAGE_WRITE_SECONDS,
+    QUEUE_DEPTH,
+    RECORDS_PER_PAGE,
+    SQLITE_WRITE_SECONDS,
+    USERS_UNCHANGED,
+    WATERMARK_SKIPPED_LOGS,
+    count,
+    observe,
+    timed,
+)
+from utils.database_utils import (
+    FIRESTORE_MAX_BATCH_SIZE,
+    BatchWriteResult,
+    insert_measurement_logs,
+    insert_measurement_logs_firestore_batched,
+    mark_measurement_logs_uploaded,
+    update_light_exposure_aggregates,
+    upsert_user_document_firestore,
+)
+from utils.sync_scheduler import UserSyncSummary, user_sync_summary
 
 
-async def assemble_data(db: firestore.AsyncClient, connection: sqlite3.Connection, measurement_log_table_name: str, user_id: int, data: list):
-    exclude_keys = {'id', 'company_id', 'user_id', 'device_id', 'log_type', 'log_time', 'body_part', 'from_service', 'state'}
-    include_keys = {'lux_melanopic'}
-    for log in data:
-        # Extract all measurement names and values from the log
-        measurement_values = {key: value for key, value in log.items() if key in include_keys}
-        await insert_measurement_log_firestore(db, measurement_values, user_id, log["log_time"])
+async def assemble_data(db: firestore.AsyncClient, connection: sqlite3.Connection, measurement_log_table_name: str, user_id: int, data: Union[MeasurementPage, list], batch_size: int = FIRESTORE_MAX_BATCH_SIZE, layout: str = LAYOUT_DOCUMENTS, projection: ChannelProjection = DEFAULT_PROJECTION, cursor_store: Optional[CursorStore] = None, cursor: Optional[Cursor] = None, watermark: Optional[int] = None) -> BatchWriteResult:
+    """
+    Write one page of logs to the staging store and Firestore.
 
+    data is a MeasurementPage of `projection`, or raw Condor logs that are projected here. With a
+    `watermark` (epoch ms of the newest log already ingested for the user), logs at or before it
+    are dropped, counted and reported; that loses records that arrive out of log time order, so it
+    is opt-in (--log-time-watermark).
 
-async def run_example(db: firestore.AsyncClient, session: aiohttp.ClientSession, connection: sqlite3.Connection, user_id: int, user_table_name: str, measurement_log_table_name: str):
-    start_time = datetime.now()
-    limit = 10
+    With a cursor_store and cursor, the cursor is written in the same SQLite transaction as the staged
+    logs (SQLite cursor store) or in the last Firestore batch of the page (Firestore cursor store),
+    and result.checkpointed tells whether it was committed. Staged logs that did not reach Firestore
+    stay pending and are replayed, in the same layout, before the user's next sync (see
+    upload_pending_measurement_logs_firestore), so a cursor committed with them is safe in every
+    layout (benchmarks/check_sync_kill.py kills the sync mid-run to check it). All writes are keyed
+    by timestamp, so writing a page again after a crash overwrites instead of duplicating.
+    """
+    # Keep only the configured channels of each log, as float32 arrays
+    logs = data if isinstance(data, MeasurementPage) else projection.page(data)
+    if watermark is not None:
+        fetched = len(logs)
+        logs = logs.after(watermark)
+        if len(logs) < fetched:
+            count(WATERMARK_SKIPPED_LOGS, fetched - len(logs))
+            print(f"user {user_id}: skipped {fetched - len(logs)} logs at or before the watermark {watermark}")
+    timestamps = logs.timestamps.tolist()
 
-    latest_user_data = await get_user_data_firestore(db, user_table_name, user_id)
+    sqlite_checkpoint = firestore_checkpoint = None
+    if cursor_store is not None and cursor is not None and len(logs):
+        if connection is not None:
+            sqlite_checkpoint = cursor_store.sqlite_cursor_write(connection, user_id, cursor)
+        if sqlite_checkpoint is None:
+            firestore_checkpoint = cursor_store.firestore_cursor_write(user_id, cursor)
+    checkpointed = False
+
+    # Stage the page locally first, so logs that fail to upload can be replayed later
+    if connection is not None:
+        with timed(SQLITE_WRITE_SECONDS):
+            insert_measurement_logs(connection, measurement_log_table_name, user_id, logs, in_transaction=sqlite_checkpoint)
+            update_light_exposure_aggregates(connection, measurement_log_table_name, user_id, timestamps)
+        checkpointed = sqlite_checkpoint is not None
+
+    with timed(FIRESTORE_WRITE_SECONDS):
+        if layout == LAYOUT_DAYS:
+            days_written = await write_measurement_days_firestore(db, user_id, logs, projection.channels, final_writes=firestore_checkpoint)
+            result = BatchWriteResult(written=len(logs), batches=days_written)
+        else:
+            documents_checkpoint = firestore_checkpoint if layout == LAYOUT_DOCUMENTS else None
+            result = await insert_measurement_logs_firestore_batched(db, user_id, logs, batch_size=batch_size, final_writes=documents_checkpoint)
+            # During migration both layouts are written; the checkpoint goes with the last of them
+            if layout == LAYOUT_BOTH:
+                await write_measurement_days_firestore(db, user_id, logs, projection.channels,
+                                                       final_writes=firestore_checkpoint if result.ok else None)
+        if firestore_checkpoint is not None:
+            checkpointed = result.ok
+    count(FIRESTORE_BATCHES, result.batches)
+    count(FIRESTORE_FAILED_LOGS, len(result.failed_timestamps))
+    for error in result.errors:
+        print(error)
+
+    if connection is not None:
+        failed = set(result.failed_timestamps)
+        with timed(SQLITE_WRITE_SECONDS):
+            mark_measurement_logs_uploaded(connection, measurement_log_table_name, user_id, (t for t in timestamps if t not in failed))
+
+    result.checkpointed = checkpointed
+    if checkpointed:
+        cursor_store.committed(user_id, *cursor)
+    return result
+
+
+class PageWriteError(Exception):
+    """Raised when some measurements of a page could not be written; its cursor only advances if they are staged for replay."""
+
+
+def page_cursor(starting_after: Optional[str], page: MeasurementPage, record_cursors: bool = False) -> Cursor:
+    """
+    The cursor to resume after a fully written page.
+
+    By default it is the page's own cursor and size, and the next run fetches that page again to
+    see what grew. With record_cursors (and record ids) it is right after the page's last record
+    ((its id, 0)), so the next run fetches only records that are new; that assumes the API accepts
+    a record id as starting_after, which the mock API does but the Condor API does not document.
+    """
+    last_id = page.last_id if record_cursors else None
+    if last_id is None:
+        return starting_after, page.size
+    return str(last_id), 0
+
+
+class PageCheckpoint:
+    """
+    Tracks the last page whose measurements are durably written.
+
+    Pages are numbered in fetch order. With several writers a page can finish before an earlier one,
+    so the checkpoint only moves forward over an unbroken run of completed pages.
+    """
+
+    def __init__(self, starting_after: str, data_size: int):
+        self.starting_after = starting_after
+        self.data_size = data_size
+        self._next_sequence = 0
+        self._completed = {}
+
+    def preview(self, sequence: int, starting_after: str, data_size: int) -> Cursor:
+        """The checkpoint as it will be once this page completes (pages completed so far included)."""
+        completed = {**self._completed, sequence: (starting_after, data_size)}
+        cursor = (self.starting_after, self.data_size)
+        next_sequence = self._next_sequence
+        while next_sequence in completed:
+            cursor = completed[next_sequence]
+            next_sequence += 1
+        return cursor
+
+    def complete(self, sequence: int, starting_after: str, data_size: int) -> None:
+        self._completed[sequence] = (starting_after, data_size)
+        while self._next_sequence in self._completed:
+            self.starting_after, self.data_size = self._completed.pop(self._next_sequence)
+            self._next_sequence += 1
+
+
+async def run_example(db: firestore.AsyncClient, client: CondorClient, connection: sqlite3.Connection, user_id: int, cursor_store: CursorStore, measurement_log_table_name: str, queue_size: int = 4, writers: int = 1, layout: str = LAYOUT_DOCUMENTS, projection: ChannelProjection = DEFAULT_PROJECTION, watermark: Optional[int] = None, record_cursors: bool = False, stop: Optional[asyncio.Event] = None) -> UserSyncSummary:
+    """
+    Sync one user's new actigraphy data into Firestore.
+
+    Pages are fetched by a producer and handed over a bounded queue (queue_size pages) to `writers`
+    writer tasks, so the next API request runs while the previous page is being written.
+
+    The (starting_after, data_size) cursor is checkpointed after every page, committed atomically
+    with the page's data where the cursor store allows it (see assemble_data), otherwise saved and
+    flushed right after the page. A restart resumes after the last committed page.
+
+    The cursor is the last written page's own cursor and size, so every sync fetches that page
+    again and skips the logs of it already written. With record_cursors it points right after the
+    last written record instead (see page_cursor): a user without new data costs one API request
+    that comes back empty. An optional `watermark` also drops logs by log time (see assemble_data).
+
+    Pages are reduced to `projection`'s channels while the API response is decoded and queued as
+    MeasurementPage arrays, so a queued page holds a few bytes per log instead of its JSON dicts.
+
+    Once `stop` is set no further page is requested: the pages already fetched are written and
+    checkpointed, and the next sync carries on from there.
+
+    API latency and size of every page, queue depth and write latencies are recorded into the
+    current Metrics (see utils.metrics), pages and logs into the user's summary as they happen, so
+    run_sync_pool still reports them when the sync fails later on.
+    """
+    summary = user_sync_summary(user_id)
+
+    latest_user_data = await cursor_store.get(user_id)
 
     if latest_user_data is not None:
         latest_block = latest_user_data[0]
-        latest_data_size = latest_user_data[1]
+        latest_data_size = max(0, latest_user_data[1] or 0)
     else:
         latest_block = None
         latest_data_size = 0
 
-    response = await get_user_actigraphy_data(session, user_id, limit, latest_block)
-    
-    data = response["data"]
-
-    next_block_name = response["starting_after"]
+    checkpoint = PageCheckpoint(latest_block, latest_data_size)
+    queue = asyncio.Queue(maxsize=queue_size)
+    user_document_written = False
 
-    if len(data) > latest_data_size:
-        starting_index = latest_data_size - len(data)
-        await assemble_data(db, connection, measurement_log_table_name, user_id, data[starting_index:])
-        latest_data_size = len(data)
-
-        while next_block_name is not None and len(data) > 0:
-            print(next_block_name)
-            print(len(data))
-
-            response = await get_user_actigraphy_data(user_id, limit, next_block_name)
-            data = response["data"]
-            if len(data) == 0:
+    async def fetch_pages():
+        # Logs of the first page that were already written by the previous run
+        already_written = latest_data_size
+        # Ask for at least one log more than last time so the first page can show new data
+        first_page_size = min(client.max_page_size, max(client.page_size, latest_data_size + 1))
+        sequence = 0
+        pages = client.iter_actigraphy_pages(user_id, latest_block, page_size=first_page_size, object_hook=projection.parse_log)
+        while stop is None or not stop.is_set():
+            start = time.perf_counter()
+            try:
+                block_name, data, _ = await pages.__anext__()
+            except StopAsyncIteration:
                 break
+            observe(API_PAGE_SECONDS, time.perf_counter() - start)
+            observe(RECORDS_PER_PAGE, len(data))
+            summary.pages_fetched += 1
+            new_logs = len(data) > already_written
+            # Only the page's arrays are queued: the parsed logs go before waiting for room in the queue
+            page = projection.page(data) if new_logs else None
+            del data
+            if new_logs:
+                await queue.put((sequence, block_name, page, already_written))
+                observe(QUEUE_DEPTH, queue.qsize())
+                sequence += 1
+            already_written = 0
+        await pages.aclose()
 
-            latest_block = next_block_name
-            latest_data_size = len(data)
-
-            next_block_name = response["starting_after"]
+        if sequence == 0:
+            count(USERS_UNCHANGED)
+        for _ in range(writers):
+            await queue.put(None)
 
-            await assemble_data(db, connection, measurement_log_table_name, user_id, data)
+    async def write_pages():
+        nonlocal user_document_written
+        while True:
+            page = await queue.get()
+            if page is None:
+                return
+            sequence, block_name, data, already_written = page
 
-    end_time = datetime.now()
-    elapsed_time = end_time - start_time
+            if not user_document_written:
+                user_document_written = True
+                await upsert_user_document_firestore(db, user_id)
 
-    print(f"api elapsed time: {elapsed_time}")
+            # Only the logs past those written before are new; an empty or shorter page was never queued
+            new_data = data[already_written:]
+            page_end = page_cursor(block_name, data, record_cursors)
+            cursor = checkpoint.preview(sequence, *page_end)
+            with timed(PAGE_WRITE_SECONDS):
+                result = await assemble_data(db, connection, measurement_log_table_name, user_id, new_data, layout=layout,
+                                             projection=projection, cursor_store=cursor_store, cursor=cursor, watermark=watermark)
+            summary.logs_written += result.written
+            if result.ok or result.checkpointed:
+                checkpoint.complete(sequence, *page_end)
+            if not result.ok:
+                raise PageWriteError(f"user {user_id}: {len(result.failed_timestamps)} logs of page {block_name} were not written")
+            if not result.checkpointed:
+                # The cursor store could not join the page's write: checkpoint it right after
+                await cursor_store.save(user_id, checkpoint.starting_after, checkpoint.data_size)
+                await cursor_store.flush()
 
-    start_time = datetime.now()
-    await insert_or_update_user_last_place_firestore(db, user_table_name, user_id, latest_block, latest_data_size)
+    tasks = [asyncio.create_task(fetch_pages())]
+    tasks.extend(asyncio.create_task(write_pages()) for _ in range(writers))
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        # Only pages that were fully written are checkpointed, also when the sync failed half way
+        await cursor_store.save(user_id, checkpoint.starting_after, checkpoint.data_size)
 
-    end_time = datetime.now()
-    elapsed_time = end_time - start_time
-    print(f"db elapsed time: {elapsed_time}")
+    return summary
@@ -1,98 +1,157 @@
 # main.py
+"""
+Command line entry point:
+
+    python main.py [sync] [options]   sync users from the Condor API into Firestore once (the default)
+    python main.py daemon [options]   keep syncing, polling every user on an adaptive interval
+    python main.py serve [options]    serve the local staging store over HTTP (server.py)
+    python main.py plot USER_ID       plot a user's double-plot actogram from the local staging store
+    python main.py export [options]   export staged logs to Parquet files per user and day for analytics
+    python main.py migrate-days USERS copy users' per-epoch Firestore documents into the packed day layout
+
+Every command imports only what it uses: serving never loads Firebase, numpy or pandas, syncing
+never loads pandas, plotly or the HTTP server, and --help loads none of them. Use
+`python main.py COMMAND --help` for a command's options.
+"""
 import os
-from get_patient_actigraphy_data import run_example
-from utils import database_utils
-from server import run
-from datetime import datetime
-import aiohttp
-import asyncio
-import firebase_admin
-from firebase_admin import firestore, credentials
+import sys
+import argparse
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend_data', 'backend.db')
+PARQUET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend_data', 'parquet')
+
+COMMANDS = ('sync', 'daemon', 'serve', 'plot', 'export', 'migrate-days')
+DEFAULT_COMMAND = 'sync'
+
+
+def sync(argv, prog: str) -> None:
+    import asyncio
+    import sync_cli
+    asyncio.run(sync_cli.main(argv, prog))
+
+
+def daemon(argv, prog: str) -> None:
+    sync(['--daemon', *argv], prog)
+
+
+def serve(argv, prog: str) -> None:
+    import server
+    server.main(argv, prog)
+
+
+def plot(argv, prog: str) -> None:
+    parser = argparse.ArgumentParser(prog=prog, description="Plot a user's double-plot actogram from the local staging store.")
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('--channel', default='pim', help="Measurement channel to plot.")
+    parser.add_argument('--start', help="First time to plot (ISO 8601, wall time in --tz; default: the first log).")
+    parser.add_argument('--end', help="Plot up to this time (exclusive; default: the last log).")
+    parser.add_argument('--tz', default='UTC', help="Timezone the days are laid out in.")
+    parser.add_argument('--db', default=DB_PATH, help="Backend SQLite database.")
+    parser.add_argument('--parquet', nargs='?', const=PARQUET_DIR, metavar='DIR',
+                        help=f"Read the Parquet export (see the export command) instead of the database (default DIR: {PARQUET_DIR}).")
+    parser.add_argument('--out', help="Write the figure to this HTML file instead of opening it.")
+    args = parser.parse_args(argv)
+
+    from utils.actigraphy_utils import (
+        actigraphy_double_plot_actogram,
+        create_dataframe,
+        create_dataframe_from_parquet,
+        load_user_actigraphy,
+    )
+
+    if args.parquet:
+        # Only the plotted channel of the days in the period is read
+        df = create_dataframe_from_parquet(args.parquet, args.user_id, [args.channel], args.start, args.end, args.tz)
+        source = args.parquet
+    else:
+        from utils.database_utils import MEASUREMENT_LOGS_TABLE, close_connection, connect_to_db
+        from utils.timestamps import timestamp_to_millis
+
+        start_ms, end_ms = (None if value is None else timestamp_to_millis(value, args.tz) for value in (args.start, args.end))
+        connection = connect_to_db(args.db, tune=False)
+        try:
+            act_data = load_user_actigraphy(connection, MEASUREMENT_LOGS_TABLE, args.user_id, [args.channel], start_ms, end_ms)
+        finally:
+            close_connection(connection)
+        df = create_dataframe(act_data, args.tz)
+        source = args.db
+    if df.empty:
+        parser.error(f"no {args.channel} logs of user {args.user_id} in {source}")
+
+    figure = actigraphy_double_plot_actogram(df, args.channel)
+    if args.out:
+        figure.write_html(args.out)
+        print(f"Actogram written to {args.out}")
+    else:
+        figure.show()
+
+
+def export(argv, prog: str) -> None:
+    parser = argparse.ArgumentParser(prog=prog, description="Export staged logs to Parquet, one file per user and UTC day. "
+                                                            "Only new days (and the last exported one) are written.")
+    parser.add_argument('--users', type=int, nargs='+', help="User ids to export (default: every user with staged logs).")
+    parser.add_argument('--db', default=DB_PATH, help="Backend SQLite database.")
+    parser.add_argument('--out', default=PARQUET_DIR, help="Root directory of the export.")
+    parser.add_argument('--full', action='store_true', help="Rewrite every day, e.g. after older logs were staged late.")
+    args = parser.parse_args(argv)
+
+    import time
+    from utils.database_utils import MEASUREMENT_LOGS_TABLE, close_connection, connect_to_db, get_measurement_log_user_ids
+    from utils.parquet_export import export_user_parquet
+
+    start_time = time.perf_counter()
+    connection = connect_to_db(args.db, tune=False)
+    try:
+        user_ids = args.users or get_measurement_log_user_ids(connection, MEASUREMENT_LOGS_TABLE)
+        days = sum(export_user_parquet(connection, args.out, user_id, full=args.full) for user_id in user_ids)
+    finally:
+        close_connection(connection)
+    print(f"Exported {days} days of {len(user_ids)} users to {args.out} in {time.perf_counter() - start_time:.2f}s")
+
+
+def migrate_days(argv, prog: str) -> None:
+    parser = argparse.ArgumentParser(prog=prog, description="Copy users' per-epoch measurement documents in Firestore into "
+                                                            "the packed day layout, before a deployment syncs with "
+                                                            "--storage-layout days. Safe to run again.")
+    parser.add_argument('users', type=int, nargs='*', help="User ids to migrate.")
+    parser.add_argument('--user-range', type=int, nargs=2, action='append', default=[], metavar=('START', 'STOP'),
+                        help="Migrate user ids START..STOP-1 (repeatable).")
+    parser.add_argument('--concurrency', type=int, default=4, help="Users migrated at the same time.")
+    args = parser.parse_args(argv)
+
+    from utils.sync_scheduler import unique_user_ids, user_ids_from_range
+    user_ids = unique_user_ids(args.users, *(user_ids_from_range(start, stop) for start, stop in args.user_range))
+    if not user_ids:
+        parser.error("no users given")
+
+    import asyncio
+    import sync_cli
+    from utils.chunked_storage import migrate_user_to_days_firestore
+    from utils.sync_scheduler import UserSyncSummary, print_sync_report, run_sync_pool
+
+    async def run():
+        db = sync_cli.connect_firestore()
+
+        async def migrate_user(user_id: int) -> UserSyncSummary:
+            return UserSyncSummary(user_id, logs_written=await migrate_user_to_days_firestore(db, user_id))
+
+        return await run_sync_pool(user_ids, migrate_user, concurrency=args.concurrency)
+
+    summaries = asyncio.run(run())
+    print_sync_report(summaries)
+    if not all(summary.ok for summary in summaries):
+        raise SystemExit(1)
+
+
+def main(argv=None) -> None:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] in (['-h'], ['--help']):
+        print(__doc__.strip())
+        return
+    command = argv.pop(0) if argv[:1] and argv[0] in COMMANDS else DEFAULT_COMMAND
+    handlers = {'sync': sync, 'daemon': daemon, 'serve': serve, 'plot': plot, 'export': export, 'migrate-days': migrate_days}
+    handlers[command](argv, f"{os.path.basename(sys.argv[0])} {command}")
 
-BACKEND_DIR_NAME = 'backend_data'
-DATABASE_NAME = 'backend.db'
-main_directory = os.path.dirname(os.path.abspath(__file__))
-backend_dir = os.path.join(main_directory, BACKEND_DIR_NAME)
 
-credentials_path = 'lightspan-513da-ceeca0168093.json'
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
-
-DB_PATH = os.path.join(backend_dir, DATABASE_NAME)
-
-def get_main_directory() -> str:
-    """Get the directory where the main.py file is located."""
-    return os.path.dirname(os.path.abspath(__file__))
-
-def create_directory(directory_name: str) -> str:
-    """Create a new directory at the same level as the main.py file."""
-    main_directory = get_main_directory()
-    new_directory_path = os.path.join(main_directory, directory_name)
-    if not os.path.exists(new_directory_path):
-        os.makedirs(new_directory_path)
-    return new_directory_path
-
-
-def create_backend_directory():
-    new_dir_path = create_directory(BACKEND_DIR_NAME)
-    print(f"Directory created at: {new_dir_path}")
-
-def get_db_path(db_name: str, directory_name: str) -> str:
-    """Get the full path for the database file in the specified directory."""
-    new_directory_path = create_directory(directory_name)
-    return os.path.join(new_directory_path, db_name)
-
-def create_backend_db():
-    db_path = get_db_path(DATABASE_NAME, BACKEND_DIR_NAME)
-    connection = database_utils.connect_to_db(db_path)
-
-
-async def main():
-    print("main")
-    #run()
-
-    create_backend_directory()
-    create_backend_db()
-
-    cred = credentials.Certificate('lightspan-513da-ceeca0168093.json')
-
-    app = firebase_admin.initialize_app(cred)
-    db = firestore.AsyncClient()
-
-    base_name = 'last_place_table'
-    connection = database_utils.connect_to_db(DB_PATH)
-    last_place_table = database_utils.create_table(connection, base_name)
-    measurement_logs_table = database_utils.create_measurement_logs_table(connection, 'sensor_logs', last_place_table)
-    print(f"Table created: {last_place_table}")
-
-    start_time = datetime.now()
-    print(start_time)
-
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-
-        task1 = asyncio.create_task(run_example(db, session, connection, 1723, last_place_table, measurement_logs_table))
-        task2 = asyncio.create_task(run_example(db, session, connection, 1724, last_place_table, measurement_logs_table))
-        tasks.append(task1)
-        tasks.append(task2)
-        # for i in range(1720, 1870):
-        #     task = asyncio.create_task(run_example(db, session, connection, i, last_place_table, measurement_logs_table))
-        #     tasks.append(task)
-
-        # for i in range(1887, 2136):
-        #     task = asyncio.create_task(run_example(db, session, connection, i, last_place_table, measurement_logs_table))
-        #     tasks.append(task)
-
-        await asyncio.gather(*tasks)
-
-    end_time = datetime.now()
-
-    elapsed_time = end_time - start_time
-    print(end_time)
-    print(f"total elapsed_time {elapsed_time}")
-
-    #run_example(connection, 1638, last_place_table, measurement_logs_table)
-    #run_example(connection, 1637, last_place_table, measurement_logs_table)
-    
 if __name__ == "__main__":
-    asyncio.run(main())
-
+    main()
@@ -1,7 +1,36 @@
+import os
+import argparse
 import json
 import sqlite3
+import asyncio
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import urllib.parse
+from typing import List, Optional
+import aiosqlite
+from aiohttp import web
+
+from utils.cache import TTLCache, on_user_updated, remove_user_update_listener
+from utils.database_utils import (
+    LIGHT_EXPOSURE_CHANGES_QUERY,
+    LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS,
+    LIGHT_EXPOSURE_USER_QUERY,
+    LIGHT_EXPOSURE_WINDOWS_DAYS,
+    MEASUREMENT_LOGS_TABLE,
+    get_light_exposure,
+    light_exposure_from_row,
+)
+from utils.measurement_queries import DEFAULT_QUERY_PAGE_SIZE, build_measurement_query, measurement_columns, parse_time
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend_data', 'backend.db')
+
+# Most users one /measurements request may ask for
+MAX_QUERY_USERS = 500
+
+
+def connect_read_only(db_path: str) -> sqlite3.Connection:
+    """Open the backend database read-only; one connection is shared by all requests."""
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+
 
 class RequestHandler(BaseHTTPRequestHandler):
     def _set_response(self, response_code=200, content_type='application/json'):
@@ -12,42 +41,270 @@ class RequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         parsed_path = urllib.parse.urlparse(self.path)
         path_parts = parsed_path.path.split('/')
-        
+
         if len(path_parts) >= 3 and path_parts[1] == 'get_value':
             try:
                 user_id = int(path_parts[2])
-                value = self.get_value_from_db(user_id)
-                if value is not None:
-                    self._set_response()
-                    self.wfile.write(json.dumps({'light_exposure': value}).encode('utf-8'))
-                else:
-                    self._set_response(404)
-                    self.wfile.write(json.dumps({'error': 'Value not found'}).encode('utf-8'))
+                query = urllib.parse.parse_qs(parsed_path.query)
+                window_days = int(query.get('window', [LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS])[0])
+                if window_days not in LIGHT_EXPOSURE_WINDOWS_DAYS:
+                    raise ValueError(window_days)
             except ValueError:
                 self._set_response(400)
-                self.wfile.write(json.dumps({'error': 'Invalid user_id'}).encode('utf-8'))
+                self.wfile.write(json.dumps({'error': 'Invalid user_id or window'}).encode('utf-8'))
+                return
+
+            value = self.get_value_from_db(user_id, window_days)
+            if value is not None:
+                self._set_response()
+                self.wfile.write(json.dumps(value).encode('utf-8'))
+            else:
+                self._set_response(404)
+                self.wfile.write(json.dumps({'error': 'Value not found'}).encode('utf-8'))
         else:
             self._set_response(404)
             self.wfile.write(json.dumps({'error': 'Endpoint not found'}).encode('utf-8'))
 
-    def get_value_from_db(self, user_id):
-        # conn = sqlite3.connect('data.db')
-        # cursor = conn.cursor()
-        # cursor.execute('SELECT value FROM my_table WHERE user_id = ?', (user_id,))
-        # result = cursor.fetchone()
-        # conn.close()
-
-        value = None
+    def get_value_from_db(self, user_id, window_days=LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS):
+        """Melanopic light exposure of the user over the window, read from the precomputed summary table."""
+        try:
+            return get_light_exposure(self.server.connection, user_id, window_days)
+        except sqlite3.OperationalError:
+            # The aggregate tables don't exist until the first sync has run
+            return None
 
-        if user_id == 1638:
-            value = 7.8
-        elif user_id == 1637:
-            value = 3.1
-        
-        return value #result[0] if result else None
 
-def run(server_class=HTTPServer, handler_class=RequestHandler, port=8080):
+def run(server_class=HTTPServer, handler_class=RequestHandler, port=8080, db_path=DB_PATH):
     server_address = ('0.0.0.0', port)
     httpd = server_class(server_address, handler_class)
+    httpd.connection = connect_read_only(db_path)
     print(f'Starting httpd server on port {port}')
-    httpd.serve_forever()
\ No newline at end of file
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.connection.close()
+
+
+class ReadConnectionPool:
+    """A fixed set of read-only aiosqlite connections shared by all requests of the async server."""
+
+    def __init__(self, db_path: str, size: int = 4):
+        self.db_path = db_path
+        self.size = size
+        self._connections = []
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    async def open(self) -> None:
+        for _ in range(self.size):
+            connection = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+
+    async def close(self) -> None:
+        for connection in self._connections:
+            await connection.close()
+        self._connections.clear()
+
+    async def fetchall(self, sql: str, parameters: tuple) -> list:
+        connection = await self._idle.get()
+        try:
+            async with connection.execute(sql, parameters) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._idle.put_nowait(connection)
+
+
+class LightExposureChanges:
+    """
+    The `changes` hook of the response cache: the users whose light exposure summary changed since
+    the last call, read from the summary's revisions on the read pool.
+
+    Returns None (drop everything) on the first call and whenever the summary cannot be queried: the
+    first sync has not created it yet, or it has no revision column (not yet opened by a sync).
+    """
+
+    def __init__(self, pool: ReadConnectionPool):
+        self.pool = pool
+        self.revision = None
+
+    async def __call__(self) -> Optional[List[int]]:
+        try:
+            rows = await self.pool.fetchall(LIGHT_EXPOSURE_CHANGES_QUERY, (self.revision or 0,))
+        except sqlite3.OperationalError:
+            self.revision = None
+            return None
+        known = self.revision is not None
+        self.revision = max([self.revision or 0, *(revision for _, revision in rows)])
+        return [user_id for user_id, _ in rows] if known else None
+
+
+def json_response(payload: dict, status: int = 200) -> web.Response:
+    # Serialized exactly once, straight into the response body
+    return web.Response(body=json.dumps(payload).encode('utf-8'), status=status, content_type='application/json')
+
+
+async def get_value(request: web.Request) -> web.Response:
+    try:
+        user_id = int(request.match_info['user_id'])
+        window_days = int(request.query.get('window', LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS))
+        if window_days not in LIGHT_EXPOSURE_WINDOWS_DAYS:
+            raise ValueError(window_days)
+    except ValueError:
+        return json_response({'error': 'Invalid user_id or window'}, 400)
+
+    async def load_user():
+        try:
+            rows = await request.app['pool'].fetchall(LIGHT_EXPOSURE_USER_QUERY, (user_id,))
+        except sqlite3.OperationalError:
+            # The aggregate tables don't exist until the first sync has run
+            rows = []
+        return {row[0]: light_exposure_from_row(row[1:], row[0]) for row in rows}
+
+    # All windows of a user are cached together, so a sync of that user (in this process) invalidates one entry
+    values = await request.app['cache'].get_or_load(user_id, load_user)
+    value = values.get(window_days)
+    if value is None:
+        return json_response({'error': 'Value not found'}, 404)
+    return json_response(value)
+
+
+async def cache_stats(request: web.Request) -> web.Response:
+    cache = request.app['cache']
+    return json_response({**cache.stats.to_dict(), 'size': len(cache), 'maxsize': cache.maxsize, 'ttl': cache.ttl})
+
+
+async def get_measurements(request: web.Request) -> web.Response:
+    """
+    Stream measurements of one user (/measurements/{user_id}) or many (/measurements?user_ids=1,2,3).
+
+    Query parameters: start and end (epoch ms or ISO time, end exclusive), every (average per N minutes),
+    columns (comma separated, default all), format ('ndjson': one JSON object per row, or 'columns':
+    one JSON object of column arrays per page). Pages are read one keyset query at a time and written
+    out as they arrive, so the whole result is never held in memory.
+    """
+    query = request.query
+    try:
+        if 'user_id' in request.match_info:
+            user_ids = [int(request.match_info['user_id'])]
+        else:
+            user_ids = [int(part) for part in query.get('user_ids', '').split(',') if part]
+        if not 0 < len(user_ids) <= MAX_QUERY_USERS:
+            raise ValueError(f"between 1 and {MAX_QUERY_USERS} user ids are required")
+        start_ms = parse_time(query.get('start'))
+        end_ms = parse_time(query.get('end'))
+        every = int(query['every']) if query.get('every') else None
+        if every is not None and every < 1:
+            raise ValueError("every must be a positive number of minutes")
+        output = query.get('format', 'ndjson')
+        if output not in ('ndjson', 'columns'):
+            raise ValueError("format must be 'ndjson' or 'columns'")
+        requested = [name for name in query.get('columns', '').split(',') if name]
+        pool = request.app['pool']
+        try:
+            available = [row[1] for row in await pool.fetchall(f"PRAGMA table_info({MEASUREMENT_LOGS_TABLE})", ())]
+        except sqlite3.OperationalError:
+            available = []
+        columns = measurement_columns(available, requested)
+    except ValueError as error:
+        return json_response({'error': str(error)}, 400)
+    if not available:
+        return json_response({'error': 'No measurements stored'}, 404)
+
+    names = ['user_id', 'timestamp', *columns]
+    bucket_ms = every * 60_000 if every else None
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    after = None
+    while True:
+        sql, parameters = build_measurement_query(
+            MEASUREMENT_LOGS_TABLE, user_ids, columns, start_ms, end_ms, bucket_ms, after, DEFAULT_QUERY_PAGE_SIZE)
+        rows = await pool.fetchall(sql, tuple(parameters))
+        if not rows:
+            break
+        if output == 'ndjson':
+            body = ''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+        else:
+            body = json.dumps(dict(zip(names, map(list, zip(*rows))))) + '\n'
+        await response.write(body.encode('utf-8'))
+        # Bucket pages can be short before the end (see build_measurement_query)
+        if len(rows) < DEFAULT_QUERY_PAGE_SIZE and not bucket_ms:
+            break
+        after = (rows[-1][0], rows[-1][1])
+
+    await response.write_eof()
+    return response
+
+
+async def endpoint_not_found(request: web.Request) -> web.Response:
+    return json_response({'error': 'Endpoint not found'}, 404)
+
+
+def create_app(db_path: str = DB_PATH, pool_size: int = 4, cache_size: int = 10000, cache_ttl: float = 60.0,
+               cache_check_interval: float = 1.0) -> web.Application:
+    """
+    The async API: same /get_value/{user_id} contract as RequestHandler, served from a shared read pool.
+
+    Per-user results are cached (LRU, cache_ttl seconds). The sync runs in its own process, so at
+    most once every cache_check_interval seconds a lookup first asks the pool which users' summary
+    rows got a new revision (see LightExposureChanges) and drops only those users. A sync running in
+    this process also drops a user's entry as soon as it advances that user's cursor. Cache counters
+    are served at /cache_stats.
+    """
+    app = web.Application()
+    app['pool'] = ReadConnectionPool(db_path, pool_size)
+    app['cache'] = TTLCache(cache_size, cache_ttl, changes=LightExposureChanges(app['pool']), check_interval=cache_check_interval)
+
+    async def open_pool(app):
+        await app['pool'].open()
+        on_user_updated(app['cache'].invalidate)
+
+    async def close_pool(app):
+        remove_user_update_listener(app['cache'].invalidate)
+        await app['pool'].close()
+
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+    app.router.add_get('/get_value/{user_id}', get_value)
+    app.router.add_get('/cache_stats', cache_stats)
+    app.router.add_get('/measurements', get_measurements)
+    app.router.add_get('/measurements/{user_id}', get_measurements)
+    app.router.add_route('*', '/{tail:.*}', endpoint_not_found)
+    return app
+
+
+def run_async(port=8080, db_path=DB_PATH, pool_size=4, cache_size=10000, cache_ttl=60.0, cache_check_interval=1.0,
+              keepalive_timeout=75, shutdown_timeout=10):
+    """Serve the async API until SIGINT/SIGTERM, then let in-flight requests finish and close the pool."""
+    print(f'Starting async server on port {port}')
+    web.run_app(
+        create_app(db_path, pool_size, cache_size, cache_ttl, cache_check_interval),
+        host='0.0.0.0',
+        port=port,
+        keepalive_timeout=keepalive_timeout,
+        shutdown_timeout=shutdown_timeout,
+        access_log=None,
+        print=None,
+    )
+
+
+def main(argv=None, prog=None):
+    """The `serve` command of main.py."""
+    parser = argparse.ArgumentParser(prog=prog, description="Serve light exposure and measurements from the local staging store.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--db', default=DB_PATH, help="Backend SQLite database, opened read-only.")
+    parser.add_argument('--pool-size', type=int, default=4, help="Read-only database connections.")
+    parser.add_argument('--cache-size', type=int, default=10000, help="Responses kept in the in-memory cache.")
+    parser.add_argument('--cache-ttl', type=float, default=60.0, help="Seconds a cached response stays valid.")
+    parser.add_argument('--cache-check-interval', type=float, default=1.0,
+                        help="Seconds between checks for users whose data another process changed.")
+    parser.add_argument('--legacy', action='store_true', help="Run the blocking http.server implementation instead.")
+    args = parser.parse_args(argv)
+    if args.legacy:
+        run(port=args.port, db_path=args.db)
+    else:
+        run_async(args.port, args.db, args.pool_size, args.cache_size, args.cache_ttl, args.cache_check_interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+# sync_cli.py
+"""
+The `sync` and `daemon` commands of main.py: ingest actigraphy from the Condor API into the local
+staging store and Firestore, once or continuously.
+"""
+import os
+import argparse
+from typing import Optional
+from get_patient_actigraphy_data import run_example
+from utils import database_utils
+from utils.api_requests import CREDENTIALS_FILE, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, URL, CondorClient, CredentialsProvider
+from utils.channels import CHANNEL_PROFILES, DEFAULT_CHANNEL_PROFILE, ChannelConfig, ChannelProjection, load_channel_config, projection_from_profile
+from utils.chunked_storage import LAYOUT_DOCUMENTS, MEASUREMENT_LAYOUTS
+from utils.cursor_store import CursorStore, FirestoreCursorStore, SQLiteCursorStore
+from utils.sync_scheduler import (
+    PollPolicy,
+    RateLimiter,
+    SyncDaemon,
+    UserSyncSummary,
+    print_sync_report,
+    run_sharded,
+    run_sync_pool,
+    unique_user_ids,
+    user_ids_from_file,
+    user_ids_from_firestore,
+    user_ids_from_range,
+)
+from utils.metrics import CURSOR_FLUSH_SECONDS, FIRESTORE_BATCHES, Metrics, print_metrics_report, profile_run, write_metrics
+import signal
+import time
+import asyncio
+import firebase_admin
+from firebase_admin import firestore, credentials
+
+BACKEND_DIR_NAME = 'backend_data'
+DATABASE_NAME = 'backend.db'
+main_directory = os.path.dirname(os.path.abspath(__file__))
+backend_dir = os.path.join(main_directory, BACKEND_DIR_NAME)
+
+credentials_path = 'lightspan-513da-ceeca0168093.json'
+os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
+
+DB_PATH = os.path.join(backend_dir, DATABASE_NAME)
+
+DEFAULT_USER_IDS = [1723, 1724]
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_MIN_INTERVAL = 60.0
+DEFAULT_MAX_INTERVAL = 3600.0
+
+def get_main_directory() -> str:
+    """Get the directory where the main.py file is located (the repository root)."""
+    return os.path.dirname(os.path.abspath(__file__))
+
+def create_directory(directory_name: str) -> str:
+    """Create a new directory at the same level as the main.py file."""
+    main_directory = get_main_directory()
+    new_directory_path = os.path.join(main_directory, directory_name)
+    if not os.path.exists(new_directory_path):
+        os.makedirs(new_directory_path)
+    return new_directory_path
+
+
+def create_backend_directory():
+    new_dir_path = create_directory(BACKEND_DIR_NAME)
+    print(f"Directory created at: {new_dir_path}")
+
+def get_db_path(db_name: str, directory_name: str) -> str:
+    """Get the full path for the database file in the specified directory."""
+    new_directory_path = create_directory(directory_name)
+    return os.path.join(new_directory_path, db_name)
+
+def create_backend_db():
+    db_path = get_db_path(DATABASE_NAME, BACKEND_DIR_NAME)
+    connection = database_utils.connect_to_db(db_path)
+
+
+def parse_args(argv=None, prog=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog=prog, description="Sync actigraphy data from the Condor API into Firestore.")
+    parser.add_argument('--users', type=int, nargs='+', default=[], help="User ids to sync.")
+    parser.add_argument('--user-range', type=int, nargs=2, action='append', default=[], metavar=('START', 'STOP'),
+                        help="Sync user ids START (inclusive) to STOP (exclusive); can be repeated.")
+    parser.add_argument('--users-file', help="File with user ids, one per line or comma separated.")
+    parser.add_argument('--users-from-firestore', action='store_true',
+                        help="Sync every user that already has a document in the last place collection.")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Users synced at the same time (per process with --shards).")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Worker processes to split the users over, each with its own event loop and clients; "
+                             "the rate limit is shared between them.")
+    parser.add_argument('--api-url', default=URL,
+                        help="Condor API base URL (default: $CONDOR_API_URL or the production API).")
+    parser.add_argument('--credentials-file', default=CREDENTIALS_FILE,
+                        help="File with the Condor API key and token, relative to the repository root.")
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help="Maximum Condor API requests per second.")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help="Initial actigraphy page size.")
+    parser.add_argument('--max-page-size', type=int, default=MAX_PAGE_SIZE,
+                        help="Largest page size the API accepts; pages grow up to it.")
+    parser.add_argument('--record-cursors', dest='record_cursors', action='store_true', default=False,
+                        help="Resume right after the last record's id instead of from the last page's cursor and size "
+                             "(saves re-fetching the last page every run). Assumes the API accepts a record id as "
+                             "starting_after, which is not confirmed for the Condor API.")
+    parser.add_argument('--page-cursors', dest='record_cursors', action='store_false',
+                        help="Resume from the last page's cursor and size (the default). The API has no cheaper way "
+                             "to tell whether that page grew, so a run without new data still fetches it once per user; "
+                             "the logs of it already written are skipped by position.")
+    parser.add_argument('--log-time-watermark', action='store_true',
+                        help="Also drop fetched logs at or before the newest one already staged for the user. Only "
+                             "safe if a user's records arrive in log time order: late uploads, a second device or "
+                             "corrected records would be dropped and never retried. Dropped logs are counted "
+                             "(watermark_skipped_logs) and reported per page.")
+    parser.add_argument('--cursor-store', choices=('firestore', 'sqlite'), default='firestore',
+                        help="Where the per-user sync cursors are kept.")
+    parser.add_argument('--storage-layout', choices=MEASUREMENT_LAYOUTS, default=LAYOUT_DOCUMENTS,
+                        help="Firestore layout for measurements: a document per epoch, a packed document per "
+                             "user-day, or both while migrating.")
+    parser.add_argument('--channel-profile', choices=sorted(CHANNEL_PROFILES), default=None,
+                        help=f"Named set of measurement channels to ingest (default: {DEFAULT_CHANNEL_PROFILE}).")
+    parser.add_argument('--channels', help="Comma separated measurement channels to ingest; overrides --channel-profile.")
+    parser.add_argument('--channel-config', help="JSON file with per-cohort channel projections (see utils.channels).")
+    parser.add_argument('--metrics-out', help="Write per-user and run metrics to this file: Prometheus text if it "
+                                               "ends in .prom, JSON lines otherwise.")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="Run under cProfile and dump the stats to PATH (PATH.shardN per shard with --shards).")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Trace allocations with tracemalloc and report the peak and top allocation sites.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running and poll every user on an adaptive interval until SIGINT/SIGTERM.")
+    parser.add_argument('--min-interval', type=float, default=DEFAULT_MIN_INTERVAL,
+                        help="Daemon: seconds between polls of a user whose last poll found new data.")
+    parser.add_argument('--max-interval', type=float, default=DEFAULT_MAX_INTERVAL,
+                        help="Daemon: longest interval a dormant user is backed off to.")
+    parser.add_argument('--backoff', type=float, default=2.0,
+                        help="Daemon: factor the interval grows by after every poll without new data.")
+    parser.add_argument('--report-interval', type=float, default=300.0,
+                        help="Daemon: seconds between status lines (and --metrics-out rewrites).")
+    parser.add_argument('--shutdown-grace', type=float, default=60.0,
+                        help="Daemon: seconds the syncs in flight get on SIGINT/SIGTERM to write the pages they "
+                             "fetched before they are cancelled (a second signal cancels them right away).")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.daemon and args.shards > 1:
+        parser.error("--daemon runs in a single process; drop --shards")
+    if not 0 < args.min_interval <= args.max_interval or args.backoff < 1:
+        parser.error("need 0 < --min-interval <= --max-interval and --backoff >= 1")
+    return args
+
+
+def build_channel_config(args: argparse.Namespace) -> ChannelConfig:
+    """Deployment default from --channels/--channel-profile, cohort overrides from --channel-config."""
+    default = None
+    if args.channels:
+        default = ChannelProjection([name.strip() for name in args.channels.split(',') if name.strip()])
+    elif args.channel_profile:
+        default = projection_from_profile(args.channel_profile)
+    if args.channel_config:
+        return load_channel_config(args.channel_config, default)
+    return ChannelConfig(default) if default is not None else ChannelConfig()
+
+
+async def collect_user_ids(args: argparse.Namespace, db: firestore.AsyncClient, collection_name: str) -> list:
+    sources = [args.users]
+    sources.extend(user_ids_from_range(start, stop) for start, stop in args.user_range)
+    if args.users_file:
+        sources.append(user_ids_from_file(args.users_file))
+    if args.users_from_firestore:
+        sources.append(await user_ids_from_firestore(db, collection_name))
+    user_ids = unique_user_ids(*sources)
+    return user_ids if user_ids else list(DEFAULT_USER_IDS)
+
+
+def create_cursor_store(args: argparse.Namespace, db: firestore.AsyncClient, connection) -> CursorStore:
+    if args.cursor_store == 'sqlite':
+        return SQLiteCursorStore(connection, database_utils.LAST_PLACE_TABLE)
+    return FirestoreCursorStore(db, database_utils.LAST_PLACE_TABLE)
+
+
+def create_client(args: argparse.Namespace, rate_limit: float) -> CondorClient:
+    return CondorClient(args.api_url, CredentialsProvider(args.credentials_file), rate_limiter=RateLimiter(rate_limit),
+                        page_size=args.page_size, max_page_size=args.max_page_size, connection_limit_per_host=args.concurrency)
+
+
+def user_syncer(args: argparse.Namespace, db: firestore.AsyncClient, connection, client: CondorClient, cursor_store: CursorStore,
+                stop: Optional[asyncio.Event] = None):
+    """
+    The coroutine function syncing one user with the given (shared, already open) clients; once
+    `stop` is set, syncs end after the page they are on.
+    """
+    channel_config = build_channel_config(args)
+    measurement_logs_table = database_utils.MEASUREMENT_LOGS_TABLE
+
+    async def sync_user(user_id: int):
+        projection = channel_config.projection_for(user_id)
+        # Upload whatever an earlier, interrupted run left in the staging store, in the layout the pages are written in
+        await database_utils.upload_pending_measurement_logs_firestore(db, connection, measurement_logs_table, user_id,
+                                                                       layout=args.storage_layout, channels=projection.channels)
+        watermark = None
+        if args.log_time_watermark:
+            watermark = database_utils.get_latest_measurement_timestamps(connection, measurement_logs_table, [user_id]).get(user_id)
+        return await run_example(db, client, connection, user_id, cursor_store, measurement_logs_table,
+                                 layout=args.storage_layout, projection=projection,
+                                 watermark=watermark, record_cursors=args.record_cursors, stop=stop)
+    return sync_user
+
+
+async def sync_users(args: argparse.Namespace, db: firestore.AsyncClient, connection, user_ids: list, rate_limit: float,
+                     run_metrics: Metrics, profile_path: str = None) -> list:
+    """Sync users in this process: one API client, one cursor store and a pool of args.concurrency workers."""
+    cursor_store = create_cursor_store(args, db, connection)
+    await cursor_store.load(user_ids)
+
+    with profile_run(profile_path, args.trace_memory, run_metrics):
+        async with create_client(args, rate_limit) as client:
+            try:
+                return await run_sync_pool(user_ids, user_syncer(args, db, connection, client, cursor_store),
+                                           concurrency=args.concurrency)
+            finally:
+                with run_metrics.timer(CURSOR_FLUSH_SECONDS):
+                    await cursor_store.flush()
+
+
+async def run_daemon(args: argparse.Namespace, db: firestore.AsyncClient, connection, user_ids: list) -> Metrics:
+    """
+    Poll the users until SIGINT or SIGTERM, each on its adaptive interval (see PollPolicy).
+
+    The API client, Firestore client, SQLite connection and cursor store stay open across polls.
+    Every --report-interval seconds a status line is printed (and --metrics-out rewritten with that
+    window's metrics). On shutdown no new page is requested: the syncs in flight write and checkpoint
+    the pages they already fetched, the cursors are flushed and the last window's metrics are
+    returned. Syncs still running after --shutdown-grace seconds, or when a second signal arrives,
+    are cancelled; they lose at most the page they were on, which the next run fetches again.
+    """
+    cursor_store = create_cursor_store(args, db, connection)
+    await cursor_store.load(user_ids)
+    policy = PollPolicy(args.min_interval, args.max_interval, args.backoff)
+    window = Metrics()
+    window_start = time.perf_counter()
+    failures = 0
+
+    def on_summary(summary: UserSyncSummary) -> None:
+        nonlocal failures
+        window.merge(summary.metrics)
+        window.inc('polls')
+        if summary.logs_written:
+            window.inc('polls_with_data')
+        if not summary.ok:
+            failures += 1
+            window.inc('poll_errors')
+            print(f"user {summary.user_id}: {summary.error}")
+
+    def report() -> None:
+        nonlocal window, window_start
+        elapsed = time.perf_counter() - window_start
+        counters = window.counters
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} daemon: {len(user_ids)} users, {int(counters.get('polls', 0))} polls "
+              f"({int(counters.get('polls_with_data', 0))} with new data, {int(counters.get('poll_errors', 0))} failed), "
+              f"{int(counters.get(FIRESTORE_BATCHES, 0))} batches, {daemon.in_flight} in flight in the last {elapsed:.0f}s")
+        if args.metrics_out:
+            write_metrics(args.metrics_out, [], window, {'users': len(user_ids), 'elapsed': elapsed, 'daemon': True})
+        window, window_start = Metrics(), time.perf_counter()
+
+    stopping = asyncio.Event()
+    async with create_client(args, args.rate_limit) as client:
+        sync_user = user_syncer(args, db, connection, client, cursor_store, stop=stopping)
+
+        async def sync_and_flush(user_id: int):
+            try:
+                return await sync_user(user_id)
+            finally:
+                # Cursors that could not be committed with their pages are written right away
+                await cursor_store.flush()
+
+        daemon = SyncDaemon(sync_and_flush, args.concurrency, policy, on_summary, stopping=stopping)
+        daemon.add_users(user_ids)
+
+        def on_signal() -> None:
+            if stopping.is_set():
+                print(f"Cancelling {daemon.in_flight} syncs in flight")
+            elif daemon.in_flight:
+                print(f"Stopping: waiting up to {args.shutdown_grace:g}s for {daemon.in_flight} syncs to finish their "
+                      f"current page; signal again to cancel them")
+            daemon.stop()
+
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, on_signal)
+
+        async def report_periodically():
+            while True:
+                await asyncio.sleep(args.report_interval)
+                report()
+
+        reporter = asyncio.create_task(report_periodically())
+        print(f"Polling {len(user_ids)} users every {policy.min_interval:g}s to {policy.max_interval:g}s; Ctrl-C to stop")
+        try:
+            await daemon.run(grace=args.shutdown_grace)
+        finally:
+            reporter.cancel()
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signal_number)
+            with window.timer(CURSOR_FLUSH_SECONDS):
+                await cursor_store.flush()
+    print(f"Stopped after {daemon.polls} polls ({failures} failed)")
+    last_window = window
+    report()
+    return last_window
+
+
+def connect_firestore() -> firestore.AsyncClient:
+    """Firestore client with the service account, or for the emulator when FIRESTORE_EMULATOR_HOST is set."""
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        firebase_admin.initialize_app(credentials.Certificate(credentials_path))
+    return firestore.AsyncClient()
+
+
+def run_shard(shard: int, user_ids: list, args: argparse.Namespace):
+    """
+    Entry point of a shard process (see run_sharded): its own Firebase app, Firestore client, SQLite
+    connection, event loop and API client. The API rate limit is split evenly between the shards.
+    """
+    connection = database_utils.connect_to_db(DB_PATH)
+    run_metrics = Metrics()
+    profile_path = f"{args.profile}.shard{shard}" if args.profile else None
+
+    async def sync_shard():
+        return await sync_users(args, connect_firestore(), connection, user_ids, args.rate_limit / args.shards,
+                                run_metrics, profile_path)
+
+    try:
+        summaries = asyncio.run(sync_shard())
+    finally:
+        database_utils.close_connection(connection)
+    return summaries, run_metrics
+
+
+async def main(argv=None, prog=None):
+    args = parse_args(argv, prog)
+    channel_config = build_channel_config(args)
+    print(f"Ingesting channels: {', '.join(channel_config.channels)}")
+
+    create_backend_directory()
+    create_backend_db()
+
+    db = connect_firestore()
+
+    connection = database_utils.connect_to_db(DB_PATH)
+    last_place_table = database_utils.create_table(connection, database_utils.LAST_PLACE_TABLE)
+    database_utils.create_measurement_logs_table(connection, database_utils.MEASUREMENT_LOGS_TABLE, last_place_table)
+    database_utils.create_light_exposure_tables(connection)
+    print(f"Table created: {last_place_table}")
+
+    user_ids = await collect_user_ids(args, db, last_place_table)
+
+    if args.daemon:
+        try:
+            await run_daemon(args, db, connection, user_ids)
+        finally:
+            database_utils.close_connection(connection)
+        return
+
+    start_time = time.perf_counter()
+    if args.shards > 1:
+        print(f"Syncing {len(user_ids)} users in {args.shards} processes")
+        summaries, run_metrics = await run_sharded(user_ids, args.shards, run_shard, args)
+    else:
+        run_metrics = Metrics()
+        summaries = await sync_users(args, db, connection, user_ids, args.rate_limit, run_metrics, args.profile)
+
+    elapsed_time = time.perf_counter() - start_time
+    run_metrics.merge(Metrics.merged(summary.metrics for summary in summaries))
+    print_sync_report(summaries)
+    print_metrics_report(run_metrics)
+    print(f"total elapsed time {elapsed_time:.2f}s")
+    if args.metrics_out:
+        write_metrics(args.metrics_out, summaries, run_metrics,
+                      {'users': len(summaries), 'shards': args.shards, 'elapsed': elapsed_time})
+        print(f"Metrics written to {args.metrics_out}")
+
@@ -1,12 +1,18 @@
+import sqlite3
+from typing import Optional, Sequence
+
 import numpy as np
 import pandas as pd
-import plotly.graph_objs as go
+
+from utils.measurement_queries import query_measurements_sqlite
+from utils.timestamps import LOG_TIME_TIMEZONE, log_times_to_millis, millis_to_datetimes, timestamp_to_millis
 
 
-def create_dataframe(act_data: dict):
+def create_dataframe(act_data: dict, tz: str = LOG_TIME_TIMEZONE):
     df = pd.DataFrame.from_dict(act_data)
 
-    df["log_time"] = pd.to_datetime(df["log_time"], format="%Y-%m-%d %H:%M:%S")
+    # Same page-level conversion as the sync; the index holds wall times in tz
+    df["log_time"] = millis_to_datetimes(log_times_to_millis(df["log_time"].to_numpy(), tz), tz)
 
     df.sort_values(by=["log_time"], inplace=True)
 
@@ -15,36 +21,174 @@ def create_dataframe(act_data: dict):
     return df
 
 
-def actigraphy_load_data(filename):
-    f = open(filename, "r")
+def load_user_actigraphy(
+    connection: sqlite3.Connection,
+    logs_table_name: str,
+    user_id: int,
+    columns: Optional[Sequence[str]] = None,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+) -> dict:
+    """A user's staged logs in [start_ms, end_ms) as create_dataframe input: log_time (epoch ms) and one list per column."""
+    names, pages = query_measurements_sqlite(connection, logs_table_name, [user_id], start_ms, end_ms, columns)
+    rows = [row for page in pages for row in page]
+    act_data = {'log_time': [row[1] for row in rows]}
+    for position, name in enumerate(names[2:], start=2):
+        act_data[name] = [row[position] for row in rows]
+    return act_data
+
+
+def create_dataframe_from_parquet(root, user_id, columns=None, start_date=None, end_date=None, tz=LOG_TIME_TIMEZONE):
+    """
+    Fast path of create_dataframe (and actigraphy_select_period) for users exported by utils.parquet_export.
+
+    Returns the same frame: a log_time column and index of wall times in tz, sorted, with the
+    requested channels (all by default) as float32. Only [start_date, end_date) (wall times in tz)
+    is read: the days outside it are never opened, and neither are the other channels' column
+    chunks or the row groups before and after the period.
+    """
+    from utils.parquet_export import TIMESTAMP_COLUMN, read_user_parquet
+
+    start_ms = None if start_date is None else timestamp_to_millis(pd.Timestamp(start_date), tz)
+    end_ms = None if end_date is None else timestamp_to_millis(pd.Timestamp(end_date), tz)
+    table = read_user_parquet(root, user_id, columns, start_ms, end_ms)
+
+    millis = table.column(TIMESTAMP_COLUMN).to_numpy().view(np.int64)
+    log_time = millis_to_datetimes(millis, tz)
+    data = {"log_time": log_time}
+    data.update((name, table.column(name).to_numpy()) for name in table.column_names if name != TIMESTAMP_COLUMN)
+    df = pd.DataFrame(data, index=pd.Index(log_time, name="log_time"), copy=False)
+    if not df.index.is_monotonic_increasing:
+        df.sort_index(inplace=True)
+    return df
+
+
+ACTIGRAPHY_DATE_COLUMN = "DATE/TIME"
+ACTIGRAPHY_DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+ACTIGRAPHY_HEADER_SEPARATOR = "+-------------------------------------------------------+"
+ACTIGRAPHY_CHUNK_SIZE = 200_000
+
+
+def _skip_actigraphy_header(f):
+    # Device exports start with a free-form block closed by a separator line; the CSV header follows it
     count = 0
     while count < 50:
         count += 1
 
         # Get next line from file
         line = f.readline()
-        if "+-------------------------------------------------------+" in line:
+        if ACTIGRAPHY_HEADER_SEPARATOR in line:
             break
-    df = pd.read_csv(filename, delimiter=";", header=count, parse_dates=False)
-    df["DATE/TIME"] = pd.to_datetime(df["DATE/TIME"], format="%d/%m/%Y %H:%M:%S")
-    df.set_index(df["DATE/TIME"], inplace=True)
+
+
+def _actigraphy_usecols(columns):
+    if columns is None:
+        return None
+    return [ACTIGRAPHY_DATE_COLUMN] + [c for c in columns if c != ACTIGRAPHY_DATE_COLUMN]
+
+
+def _compact_dtypes(df, exclude):
+    int32 = np.iinfo(np.int32)
+    for name, dtype in df.dtypes.items():
+        if name in exclude:
+            continue
+        if dtype == np.float64:
+            df[name] = df[name].astype(np.float32)
+        elif dtype == np.int64 and len(df) and int32.min <= df[name].min() and df[name].max() <= int32.max:
+            df[name] = df[name].astype(np.int32)
+    return df
+
+
+def actigraphy_iter_chunks(
+    filename,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    chunksize=ACTIGRAPHY_CHUNK_SIZE,
+    dtype=np.float32,
+):
+    """
+    Stream a device CSV export as DataFrame chunks indexed by DATE/TIME, in a single pass over the file.
+
+    Only the requested columns are parsed, straight into `dtype`; when columns is None every column
+    is read and numeric ones are downcast to float32/int32. With start_date/end_date, rows outside
+    [start_date, end_date) are dropped chunk by chunk, like actigraphy_select_period, and reading
+    stops at the first chunk past end_date.
+    """
+    with open(filename, "r") as f:
+        _skip_actigraphy_header(f)
+
+        usecols = _actigraphy_usecols(columns)
+        dtypes = None
+        if usecols is not None:
+            dtypes = {c: dtype for c in usecols if c != ACTIGRAPHY_DATE_COLUMN}
+
+        reader = pd.read_csv(
+            f,
+            delimiter=";",
+            header=0,
+            usecols=usecols,
+            dtype=dtypes,
+            parse_dates=False,
+            chunksize=chunksize,
+        )
+        for chunk in reader:
+            dates = pd.to_datetime(chunk[ACTIGRAPHY_DATE_COLUMN], format=ACTIGRAPHY_DATE_FORMAT)
+            chunk[ACTIGRAPHY_DATE_COLUMN] = dates
+            chunk.set_index(dates, inplace=True)
+
+            # Exports are chronological, so nothing after a chunk reaching end_date can be in the period
+            last_chunk = (
+                end_date is not None
+                and chunk.index[-1] >= end_date
+                and chunk.index.is_monotonic_increasing
+            )
+            if start_date is not None or end_date is not None:
+                chunk = actigraphy_select_period(chunk, start_date, end_date)
+
+            if len(chunk) > 0:
+                if columns is None:
+                    chunk = _compact_dtypes(chunk, exclude={ACTIGRAPHY_DATE_COLUMN})
+                yield chunk
+            if last_chunk:
+                break
+
+
+def actigraphy_load_data(filename, columns=None, start_date=None, end_date=None, chunksize=ACTIGRAPHY_CHUNK_SIZE):
+    chunks = list(actigraphy_iter_chunks(filename, columns, start_date, end_date, chunksize))
+    if not chunks:
+        # Nothing in the period: return an empty frame with the file's columns
+        with open(filename, "r") as f:
+            _skip_actigraphy_header(f)
+            df = pd.read_csv(f, delimiter=";", header=0, usecols=_actigraphy_usecols(columns), nrows=0)
+        df[ACTIGRAPHY_DATE_COLUMN] = pd.to_datetime(df[ACTIGRAPHY_DATE_COLUMN], format=ACTIGRAPHY_DATE_FORMAT)
+        df.set_index(df[ACTIGRAPHY_DATE_COLUMN], inplace=True)
+        return df
+    df = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
     return df
 
 
 def actigraphy_select_period(
     df: pd.DataFrame, start_date: pd.Timestamp, end_date: pd.Timestamp
 ):
-    index = np.logical_and(df.index >= start_date, df.index < end_date)
+    if df.index.is_monotonic_increasing:
+        # Sorted index: the period is one positional slice, found by binary search
+        start = 0 if start_date is None else df.index.searchsorted(start_date, side="left")
+        stop = len(df) if end_date is None else df.index.searchsorted(end_date, side="left")
+        return df.iloc[start:max(start, stop)]
+
+    index = np.ones(len(df), dtype=bool)
+    if start_date is not None:
+        index &= df.index >= start_date
+    if end_date is not None:
+        index &= df.index < end_date
 
     filtered_df = df[index]
 
     return filtered_df
 
 
-def actigraphy_split_by_day(df, start_hour=0):
-    ldays = []
-    ldays_ref = []
-
+def actigraphy_first_day_start(df, start_hour=0):
     # First day is the start of the day of the first Epoch
     sdate = pd.Timestamp(
         year=df.index[0].year, month=df.index[0].month, day=df.index[0].day
@@ -53,16 +197,37 @@ def actigraphy_split_by_day(df, start_hour=0):
         sdate = sdate - pd.Timedelta(hours=start_hour)
     else:
         sdate = sdate + pd.Timedelta(hours=start_hour)
+    return sdate
 
-    while sdate < df.index[-1]:
-        day = np.logical_and(
-            df.index >= sdate, df.index < sdate + pd.Timedelta(hours=24)
-        )
-        ldays.append(df[day])
-        ldays_ref.append(
-            pd.Timestamp(year=sdate.year, month=sdate.month, day=sdate.day)
-        )
-        sdate += pd.Timedelta(hours=24)
+
+def actigraphy_day_bounds(df, start_hour=0):
+    """
+    Row positions delimiting each 24h window of a time-indexed DataFrame.
+
+    Returns (bounds, day_starts): day i holds rows bounds[i]:bounds[i + 1] and starts at day_starts[i].
+    Found with one searchsorted over the sorted index instead of a boolean mask per day.
+    """
+    sdate = actigraphy_first_day_start(df, start_hour)
+    last = df.index[-1]
+    day = pd.Timedelta(hours=24)
+    n_days = int(np.ceil((last - sdate) / day)) if last > sdate else 0
+    day_starts = pd.date_range(sdate, periods=n_days + 1, freq=day)
+    bounds = df.index.searchsorted(day_starts, side="left")
+    return bounds, day_starts[:-1]
+
+
+def actigraphy_split_by_day(df, start_hour=0):
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    bounds, day_starts = actigraphy_day_bounds(df, start_hour)
+
+    # Positional slices are views on df, no per-day copy
+    ldays = [df.iloc[bounds[i]:bounds[i + 1]] for i in range(len(day_starts))]
+    ldays_ref = [
+        pd.Timestamp(year=sdate.year, month=sdate.month, day=sdate.day)
+        for sdate in day_starts
+    ]
 
     return ldays, ldays_ref
 
@@ -72,38 +237,70 @@ def rescale(x, min_val, max_val):
     return resc
 
 
-def actigraphy_double_plot_actogram(df, column):
-    max_val = max(df[column]) * 1.1
-    min_val = min(df[column])
+def actigraphy_actogram_data(df, column, start_hour=0):
+    """
+    Double-plot actogram as plain arrays, so it can be built without Plotly (e.g. served as JSON).
+
+    Row i shows day i at hours 0-24 followed by day i + 1 at hours 24-48 (the last row only its own day),
+    its values rescaled into the band (i, i + 1] with the y axis pointing down. All rows are packed into
+    single x/y arrays, separated by NaN.
+
+    Returns:
+        dict: 'x' and 'y' (float64 arrays), 'days' (start of each row's day) and 'n_rows'.
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    values = df[column].to_numpy(dtype=np.float64)
+    max_val = np.nanmax(values) * 1.1
+    min_val = np.nanmin(values)
     if min_val > 0:
         min_val = min_val * 0.9
 
-    # First day is the start of the day of the first Epoch
-    ldays, ldays_ref = actigraphy_split_by_day(df)
+    bounds, day_starts = actigraphy_day_bounds(df, start_hour)
+    n_rows = len(day_starts)
+
+    # Hour of day and rescaled value of every epoch, computed once for the whole recording
+    index = df.index
+    hours = index.hour.to_numpy() + index.minute.to_numpy() / 60.0 + index.second.to_numpy() / 3600.0
+    scaled = rescale(values, min_val, max_val)
+
+    x_parts = []
+    y_parts = []
+    separator = np.array([np.nan])
+    for i in range(n_rows):
+        start, middle = bounds[i], bounds[i + 1]
+        end = bounds[i + 2] if i + 1 < n_rows else middle
+        x = hours[start:end].copy()
+        x[middle - start:] += 24.0
+        x_parts.extend((x, separator))
+        y_parts.extend(((i + 1) - scaled[start:end], separator))
+
+    if x_parts:
+        x = np.concatenate(x_parts[:-1])
+        y = np.concatenate(y_parts[:-1])
+    else:
+        x = np.empty(0)
+        y = np.empty(0)
+
+    days = [pd.Timestamp(year=sdate.year, month=sdate.month, day=sdate.day) for sdate in day_starts]
+    return {"x": x, "y": y, "days": days, "n_rows": n_rows}
+
+
+def actigraphy_double_plot_actogram(df, column):
+    import plotly.graph_objs as go
+
+    data = actigraphy_actogram_data(df, column)
+    n_rows = data["n_rows"]
+
+    # One trace for all rows; NaN gaps break the line between rows
     fig = go.Figure()
-    i = 0
-    for i in range(len(ldays) - 1):
-        d1 = ldays[i]
-        d2 = ldays[i + 1]
-        x1 = d1.index.hour + d1.index.minute / 60.0 + d1.index.second / 3600.0
-        x2 = d2.index.hour + d2.index.minute / 60.0 + d2.index.second / 3600.0 + 24.0
-        x = np.append(x1, x2)
-        y = np.append(d1[column], d2[column])
-        y = (i + 1) - rescale(y, min_val, max_val)
-        fig.add_trace(go.Scatter(x=x, y=y, line=dict(color="royalblue")))
-        i += 1
-
-    if len(ldays) > 0:
-        d1 = ldays[-1]
-        x = d1.index.hour + d1.index.minute / 60.0 + d1.index.second / 3600.0
-        y = d1[column]
-        y = (i + 1) - rescale(y, min_val, max_val)
-        fig.add_trace(go.Scatter(x=x, y=y, line=dict(color="royalblue")))
-
-    fig.update_yaxes(range=[len(ldays), 0])
+    fig.add_trace(go.Scattergl(x=data["x"], y=data["y"], line=dict(color="royalblue"), connectgaps=False))
+
+    fig.update_yaxes(range=[n_rows, 0])
     fig.update_layout(showlegend=False)
     fig.update_xaxes(tick0=0, dtick=2)
-    fig.update_layout(height=len(ldays) * 70)
+    fig.update_layout(height=n_rows * 70)
 
     return fig
 
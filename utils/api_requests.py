@@ -1,12 +1,20 @@
 import os
 import aiohttp
 import asyncio
-from typing import List
-from requests import get, post
+import email.utils
+import json as jsonlib
+import time
+from functools import partial
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from tenacity.wait import wait_base
+
+from utils.metrics import API_RETRIES, retry_counter
 
 CREDENTIALS_FILE = 'credentials.txt'
 
-URL = "https://condorcloudapi.condorapps.net"
+# CONDOR_API_URL points the clients at another deployment, e.g. benchmarks/mock_condor_api.py
+URL = os.environ.get('CONDOR_API_URL', "https://condorcloudapi.condorapps.net").rstrip('/')
 
 def read_api_credentials(credentials):
     file_path = os.path.join(os.path.dirname(__file__), '..', credentials)
@@ -15,34 +23,58 @@ def read_api_credentials(credentials):
         token = file.readline().strip()
     return api_key, token
 
+class CredentialsProvider:
+    """
+    Loads the Condor API key and token once and hands out the cached request headers.
+
+    Call refresh() (or refresh_async() from the event loop) after the token was rotated,
+    e.g. when the API answers 401.
+    """
+
+    def __init__(self, credentials: str = CREDENTIALS_FILE):
+        self.credentials = credentials
+        self._headers = None
+
+    @property
+    def headers(self) -> dict:
+        if self._headers is None:
+            self.refresh()
+        return self._headers
+
+    def refresh(self) -> dict:
+        api_key, token = read_api_credentials(self.credentials)
+        self._headers = {"x-api-key": api_key, "Authorization": f"Bearer {token}"}
+        return self._headers
+
+    async def refresh_async(self) -> dict:
+        return await asyncio.to_thread(self.refresh)
+
+    def create_session(self, **kwargs) -> aiohttp.ClientSession:
+        """Create a ClientSession that sends the credentials as default headers."""
+        return aiohttp.ClientSession(headers=self.headers, **kwargs)
+
+
+default_credentials = CredentialsProvider()
+
+
 def get_headers():
-    api_key, token = read_api_credentials(CREDENTIALS_FILE)
-    headers = {"x-api-key": api_key, "Authorization": f"Bearer {token}"}
-    return headers
+    return default_credentials.headers
+
 
+# The blocking helpers below use requests, imported on first call: the sync only needs aiohttp
 
 def get_user_by_id(user_id: int):
+    from requests import get
     return get(f"{URL}/v1/users/{user_id}", headers=get_headers()).json()
 
 
-async def get_user_actigraphy_data(session: aiohttp.ClientSession, user_id: int, limit: int = 10, starting_after: str = None):
-    parameters = {
-            "limit": limit,
-            "starting_after": starting_after,
-        }
-    async with session.get(
-        f"{URL}/v1/users/{user_id}/actigraphy_data",
-        headers=get_headers(),
-        params={k: v for k, v in parameters.items() if v is not None},
-    ) as response:
-        return await response.json()
-
-
 def create_patient(payload: dict) -> dict:
+    from requests import post
     return post(f"{URL}/v1/users", headers=get_headers(), json=payload).json()
 
 
 def associate_devices(user_id: int, devices: List[dict]) -> dict:
+    from requests import post
     return post(
         f"{URL}/v1/users/{user_id}/associate_devices",
         headers=get_headers(),
@@ -51,8 +83,249 @@ def associate_devices(user_id: int, devices: List[dict]) -> dict:
 
 
 def disassociate_devices(user_id: int, devices_ids: list[int]) -> dict:
+    from requests import post
     return post(
         f"{URL}/v1/users/{user_id}/disassociate_devices",
         headers=get_headers(),
         json={"devices_ids": devices_ids},
-    ).json()
\ No newline at end of file
+    ).json()
+
+
+# Statuses worth retrying; everything else is returned to (or raised at) the caller straight away.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Methods that can be sent twice without changing the outcome; others (POST) are only retried when
+# the server cannot have acted on them: no connection was made, or it refused them (429, or 503
+# with Retry-After).
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class CondorAPIError(Exception):
+    """An error response from the Condor API, carrying its status and the Retry-After delay if sent."""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(error: BaseException, idempotent: bool = True) -> bool:
+    if isinstance(error, CondorAPIError):
+        if idempotent:
+            return error.status in RETRYABLE_STATUSES
+        return error.status == 429 or (error.status == 503 and error.retry_after is not None)
+    if idempotent:
+        return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+    # A timeout or dropped connection may come after the server committed the request
+    return isinstance(error, aiohttp.ClientConnectorError)
+
+
+class wait_retry_after(wait_base):
+    """Wait as long as the server's Retry-After asks for (capped), otherwise fall back to another wait strategy."""
+
+    def __init__(self, fallback: wait_base, max_wait: float = 60):
+        self.fallback = fallback
+        self.max_wait = max_wait
+
+    def __call__(self, retry_state) -> float:
+        error = retry_state.outcome.exception()
+        if isinstance(error, CondorAPIError) and error.retry_after is not None:
+            return min(error.retry_after, self.max_wait)
+        return self.fallback(retry_state)
+
+
+class CondorClient:
+    """
+    Async Condor API client.
+
+    Keeps one keep-alive connection pool per client, retries transient failures with jittered
+    exponential backoff (honouring Retry-After; non-idempotent requests only when they cannot have
+    been processed, see request), and pages through actigraphy data with a page size
+    that doubles while pages come back full, up to max_page_size.
+
+    Use as an async context manager:
+
+        async with CondorClient() as client:
+            async for record in client.iter_actigraphy(user_id):
+                ...
+    """
+
+    def __init__(
+        self,
+        base_url: str = URL,
+        credentials: CredentialsProvider = None,
+        rate_limiter=None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_page_size: int = MAX_PAGE_SIZE,
+        max_attempts: int = 5,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        request_timeout: float = 60,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.credentials = credentials if credentials is not None else default_credentials
+        self.rate_limiter = rate_limiter
+        self.page_size = min(page_size, max_page_size)
+        self.max_page_size = max_page_size
+        self.max_attempts = max_attempts
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> 'CondorClient':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            self.session = self.credentials.create_session(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request_once(self, method: str, path: str, params: dict = None, json: dict = None, object_hook: Callable[[dict], Any] = None) -> dict:
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(self.base_url)
+        async with self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            headers=self.credentials.headers,
+            params=params,
+            json=json,
+        ) as response:
+            if response.status == 401:
+                # The token may have been rotated on disk; reload it and let the retry pick it up
+                await self.credentials.refresh_async()
+                raise CondorAPIError(401, await response.text())
+            if response.status >= 400:
+                raise CondorAPIError(
+                    response.status,
+                    await response.text(),
+                    retry_after=parse_retry_after(response.headers.get('Retry-After')),
+                )
+            if object_hook is None:
+                return await response.json()
+            return await response.json(loads=partial(jsonlib.loads, object_hook=object_hook))
+
+    async def request(self, method: str, path: str, params: dict = None, json: dict = None, object_hook: Callable[[dict], Any] = None,
+                      idempotent: Optional[bool] = None) -> dict:
+        """
+        Send a request, retrying connection errors, timeouts and retryable statuses (and a single 401).
+
+        That is only safe for idempotent requests (by default: IDEMPOTENT_METHODS). Others are only
+        retried when they were never sent (the connection could not be made) or were refused (429, or
+        503 with Retry-After), so e.g. a timed out POST is not sent again after the server may have
+        acted on it. Pass idempotent=True for a POST the API deduplicates.
+
+        object_hook is passed on to json.loads: it gets every JSON object of the response as it is decoded.
+        """
+        if self.session is None:
+            await self.open()
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        refreshed = False
+
+        def should_retry(error: BaseException) -> bool:
+            nonlocal refreshed
+            if isinstance(error, CondorAPIError) and error.status == 401 and not refreshed:
+                refreshed = True
+                return True
+            return _is_retryable(error, idempotent)
+
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception(should_retry),
+            stop=stop_after_attempt(self.max_attempts),
+            wait=wait_retry_after(wait_random_exponential(multiplier=0.5, max=30)),
+            before_sleep=retry_counter(API_RETRIES),
+            reraise=True,
+        ):
+            with attempt:
+                return await self._request_once(method, path, params=params, json=json, object_hook=object_hook)
+
+    async def get_user_by_id(self, user_id: int) -> dict:
+        return await self.request('GET', f"/v1/users/{user_id}")
+
+    async def create_patient(self, payload: dict) -> dict:
+        return await self.request('POST', "/v1/users", json=payload)
+
+    async def associate_devices(self, user_id: int, devices: List[dict]) -> dict:
+        return await self.request('POST', f"/v1/users/{user_id}/associate_devices", json={"devices": devices})
+
+    async def disassociate_devices(self, user_id: int, devices_ids: List[int]) -> dict:
+        return await self.request('POST', f"/v1/users/{user_id}/disassociate_devices", json={"devices_ids": devices_ids})
+
+    async def get_user_actigraphy_data(self, user_id: int, limit: int = None, starting_after: str = None, object_hook: Callable[[dict], Any] = None) -> dict:
+        parameters = {
+            "limit": limit if limit is not None else self.page_size,
+            "starting_after": starting_after,
+        }
+        return await self.request(
+            'GET',
+            f"/v1/users/{user_id}/actigraphy_data",
+            params={k: v for k, v in parameters.items() if v is not None},
+            object_hook=object_hook,
+        )
+
+    async def iter_actigraphy_pages(self, user_id: int, starting_after: str = None, page_size: int = None, object_hook: Callable[[dict], Any] = None) -> AsyncIterator[Tuple[Optional[str], list, Optional[str]]]:
+        """
+        Yield (starting_after, data, next_starting_after) for every page of a user's actigraphy data.
+
+        starting_after is the cursor the page was requested with, so it can be stored to fetch the
+        same page again later. The page size doubles after every full page, up to max_page_size.
+
+        With an object_hook (e.g. ChannelProjection.parse_log) the records in data are whatever it
+        made of them while the response was decoded, so the full JSON dicts are never kept.
+        """
+        limit = min(page_size or self.page_size, self.max_page_size)
+        block_name = starting_after
+        while True:
+            response = await self.get_user_actigraphy_data(user_id, limit, block_name, object_hook)
+            next_block_name = response.get("starting_after")
+            size = len(response["data"])
+            # Popped instead of kept in a local, so the suspended generator does not keep the page alive
+            yield block_name, response.pop("data"), next_block_name
+
+            if next_block_name is None or size == 0:
+                return
+            if size >= limit:
+                limit = min(limit * 2, self.max_page_size)
+            block_name = next_block_name
+
+    async def iter_actigraphy(self, user_id: int, starting_after: str = None) -> AsyncIterator[dict]:
+        """Yield every actigraphy record of a user after the given cursor."""
+        async for _, data, _ in self.iter_actigraphy_pages(user_id, starting_after):
+            for record in data:
+                yield record
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class TTLCache:
+    """
+    In-process read-through cache with LRU eviction and a per-entry time to live.
+
+    get_or_load() coalesces concurrent misses: while a key is being loaded, further callers for
+    the same key wait for that load instead of starting their own. The load runs in its own task,
+    so a caller that is cancelled (e.g. its client went away) does not cancel it for the others.
+    invalidate() drops a key and makes a load already in flight for it skip storing its (possibly
+    stale) result.
+
+    `changes`, if given, lets changes made by other processes reach the cache: get_or_load awaits
+    it at most once every check_interval seconds (concurrent callers share one call) and invalidates
+    the keys it returns, or every entry if it returns None (changes unknown).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic,
+                 changes: Optional[Callable[[], Awaitable[Optional[Iterable[Hashable]]]]] = None,
+                 check_interval: float = 1.0):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.changes = changes
+        self.check_interval = check_interval
+        self._next_check = float('-inf')
+        self._checking: Optional[asyncio.Task] = None
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.stats.expirations += 1
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (value, self.clock() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        if self._entries.pop(key, None) is not None or key in self._loading:
+            self.stats.invalidations += 1
+        self._loading.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._loading.clear()
+
+    async def _check_changes(self) -> None:
+        if self._checking is None:
+            now = self.clock()
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            self._checking = asyncio.ensure_future(self._apply_changes())
+            self._checking.add_done_callback(lambda done: done.cancelled() or done.exception())
+        await asyncio.shield(self._checking)
+
+    async def _apply_changes(self) -> None:
+        try:
+            keys = await self.changes()
+        finally:
+            self._checking = None
+        if keys is None:
+            self.stats.invalidations += len(self._entries) + len(self._loading)
+            self.clear()
+        else:
+            for key in keys:
+                self.invalidate(key)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        if self.changes is not None:
+            await self._check_changes()
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            self.stats.hits += 1
+            return value
+
+        task = self._loading.get(key)
+        if task is not None:
+            self.stats.coalesced += 1
+        else:
+            self.stats.misses += 1
+            task = asyncio.ensure_future(self._load(key, loader))
+            # Mark the exception as retrieved in case every caller was cancelled before it came
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._loading[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await loader()
+        except BaseException:
+            if self._loading.get(key) is asyncio.current_task():
+                del self._loading[key]
+            raise
+        if self._loading.get(key) is asyncio.current_task():
+            del self._loading[key]
+            self.set(key, value)
+        return value
+
+
+# Callbacks run when the sync pipeline has new data for a user, so caches in this process can drop it
+_user_update_listeners: List[Callable[[int], None]] = []
+
+
+def on_user_updated(listener: Callable[[int], None]) -> None:
+    """Register a callback receiving the user id whenever that user's sync cursor advances."""
+    _user_update_listeners.append(listener)
+
+
+def remove_user_update_listener(listener: Callable[[int], None]) -> None:
+    if listener in _user_update_listeners:
+        _user_update_listeners.remove(listener)
+
+
+def notify_user_updated(user_id: int) -> None:
+    for listener in list(_user_update_listeners):
+        listener(user_id)
@@ -0,0 +1,159 @@
+import json
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+from utils.database_utils import LIGHT_EXPOSURE_CHANNEL, NON_MEASUREMENT_COLUMNS
+from utils.measurement_page import MeasurementPage
+from utils.timestamps import LOG_TIME_TIMEZONE, log_times_to_millis
+
+# Fields of a Condor actigraphy log that describe the log rather than measure something
+METADATA_KEYS = frozenset({'id', 'company_id', 'user_id', 'device_id', 'log_type', 'log_time', 'body_part', 'from_service', 'state'})
+
+# Named channel sets; a deployment picks one, a cohort config can override it per user
+CHANNEL_PROFILES: Dict[str, Tuple[str, ...]] = {
+    'melanopic': (LIGHT_EXPOSURE_CHANNEL,),
+    'light': (LIGHT_EXPOSURE_CHANNEL, 'lux', 'lux_photopic', 'lux_rhodopic', 'lux_cyanopic', 'lux_chloropic', 'lux_erythropic'),
+    'activity': (LIGHT_EXPOSURE_CHANNEL, 'pim', 'tat', 'zcm'),
+    'full': (LIGHT_EXPOSURE_CHANNEL, 'lux', 'lux_photopic', 'pim', 'tat', 'zcm', 'temperature', 'ext_temperature'),
+}
+DEFAULT_CHANNEL_PROFILE = 'melanopic'
+
+
+class ChannelProjection:
+    """
+    Turns a page of raw Condor logs into a MeasurementPage (or (timestamp_ms, {channel: value}) pairs) for a fixed set of channels.
+
+    The channel list is compiled once into an itemgetter. parse_log reduces one log to a tuple of
+    its log time, id and channel values; it is meant as the json object_hook of the API client, so
+    a page never exists as full dicts. page() then converts the whole page in bulk: one numpy
+    conversion of the values to `dtype` (float32 by default; None becomes NaN) and one call for the
+    log times, naive ones in `timezone`.
+    """
+
+    def __init__(self, channels: Sequence[str], dtype=np.float32, timezone: str = LOG_TIME_TIMEZONE):
+        channels = tuple(dict.fromkeys(channels))
+        if not channels:
+            raise ValueError("a channel projection needs at least one channel")
+        # Channel names become SQLite column names (case-insensitive there) next to the staging
+        # store's own columns, and fields next to 'timestamp' in Firestore measurement documents
+        invalid = [name for name in channels
+                   if not name.isidentifier() or name in METADATA_KEYS or name.lower() in NON_MEASUREMENT_COLUMNS]
+        if invalid:
+            raise ValueError(f"invalid channel names: {', '.join(invalid)}")
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.timezone = timezone
+        self._getter = itemgetter('log_time', 'id', *channels)
+
+    def __repr__(self) -> str:
+        return f"ChannelProjection({list(self.channels)!r}, dtype={self.dtype.name}, timezone={self.timezone!r})"
+
+    def parse_log(self, log: dict):
+        """(log_time, id, *channel values) of a log; any other JSON object (no log_time) is returned as is."""
+        if 'log_time' not in log:
+            return log
+        try:
+            return self._getter(log)
+        except KeyError:
+            # The log lacks a channel (or its id) altogether
+            return (log['log_time'], log.get('id'), *map(log.get, self.channels))
+
+    def page(self, data: Sequence) -> MeasurementPage:
+        """A page of logs, either raw dicts or already reduced by parse_log, as a MeasurementPage."""
+        if data and isinstance(data[0], dict):
+            data = list(map(self.parse_log, data))
+        if not data:
+            return MeasurementPage(self.channels, np.empty(0, dtype=np.int64), np.empty((0, len(self.channels)), dtype=self.dtype), 0)
+        timestamps = log_times_to_millis([row[0] for row in data], self.timezone)
+        values = np.array([row[2:] for row in data], dtype=self.dtype)
+        return MeasurementPage(self.channels, timestamps, values, len(data), data[-1][1])
+
+    def __call__(self, data: Sequence[dict]) -> List[Tuple[int, dict]]:
+        return list(self.page(data).measurements())
+
+
+def projection_from_profile(profile: str) -> ChannelProjection:
+    try:
+        return ChannelProjection(CHANNEL_PROFILES[profile])
+    except KeyError:
+        raise ValueError(f"unknown channel profile {profile!r}, expected one of {', '.join(CHANNEL_PROFILES)}") from None
+
+
+DEFAULT_PROJECTION = projection_from_profile(DEFAULT_CHANNEL_PROFILE)
+
+
+class ChannelConfig:
+    """
+    Which channels to ingest for which user: a deployment default plus optional per-cohort overrides.
+
+    A projection is compiled once per distinct channel set and shared by every user that uses it.
+    """
+
+    def __init__(self, default: ChannelProjection = DEFAULT_PROJECTION):
+        self.default = default
+        self._by_user: Dict[int, ChannelProjection] = {}
+        self._by_range: List[Tuple[int, int, ChannelProjection]] = []
+        self._compiled: Dict[Tuple[str, ...], ChannelProjection] = {default.channels: default}
+
+    def compile(self, channels: Sequence[str]) -> ChannelProjection:
+        projection = ChannelProjection(channels)
+        return self._compiled.setdefault(projection.channels, projection)
+
+    def add_cohort(self, channels: Sequence[str], user_ids: Iterable[int] = (), user_ranges: Iterable[Tuple[int, int]] = ()) -> None:
+        """Use `channels` for the given users and [start, stop) user id ranges; later cohorts take precedence."""
+        projection = self.compile(channels)
+        for user_id in user_ids:
+            self._by_user[int(user_id)] = projection
+        for start, stop in user_ranges:
+            self._by_range.insert(0, (int(start), int(stop), projection))
+
+    def projection_for(self, user_id: int) -> ChannelProjection:
+        projection = self._by_user.get(user_id)
+        if projection is not None:
+            return projection
+        for start, stop, projection in self._by_range:
+            if start <= user_id < stop:
+                return projection
+        return self.default
+
+    @property
+    def channels(self) -> List[str]:
+        """Every channel some user of this config ingests."""
+        return sorted({name for projection in self._compiled.values() for name in projection.channels})
+
+
+def _resolve_channels(entry: dict, profiles: Dict[str, Sequence[str]]) -> Sequence[str]:
+    if 'channels' in entry:
+        return entry['channels']
+    profile = entry.get('profile', DEFAULT_CHANNEL_PROFILE)
+    if profile not in profiles:
+        raise ValueError(f"unknown channel profile {profile!r}")
+    return profiles[profile]
+
+
+def load_channel_config(path: str, default: Optional[ChannelProjection] = None) -> ChannelConfig:
+    """
+    Read a channel config from a JSON file:
+
+        {
+            "profiles": {"sleep": ["lux_melanopic", "pim", "temperature"]},
+            "default": {"profile": "melanopic"},
+            "cohorts": [
+                {"profile": "sleep", "users": [1723, 1724]},
+                {"channels": ["lux_melanopic", "lux"], "user_ranges": [[2000, 3000]]}
+            ]
+        }
+
+    "profiles" adds to CHANNEL_PROFILES; every key is optional. `default`, if given, replaces the
+    file's default (command line options win over the file).
+    """
+    with open(path) as f:
+        raw = json.load(f)
+    profiles = {**CHANNEL_PROFILES, **raw.get('profiles', {})}
+    if default is None:
+        default = ChannelProjection(_resolve_channels(raw.get('default', {}), profiles))
+    config = ChannelConfig(default)
+    for cohort in raw.get('cohorts', []):
+        config.add_cohort(_resolve_channels(cohort, profiles), cohort.get('users', ()), cohort.get('user_ranges', ()))
+    return config
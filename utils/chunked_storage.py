@@ -0,0 +1,202 @@
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from firebase_admin import firestore
+
+from utils.database_utils import FIRESTORE_MAX_BATCH_SIZE, commit_firestore_batch, count_final_writes
+from utils.measurement_page import MeasurementPage
+from utils.timestamps import log_times_to_millis
+
+# Measurement storage layouts: one document per epoch, one packed document per user-day, or both during migration
+LAYOUT_DOCUMENTS = 'documents'
+LAYOUT_DAYS = 'days'
+LAYOUT_BOTH = 'both'
+MEASUREMENT_LAYOUTS = (LAYOUT_DOCUMENTS, LAYOUT_DAYS, LAYOUT_BOTH)
+
+DAYS_COLLECTION = 'actigraphy_days'
+DAY_MILLIS = 24 * 60 * 60 * 1000
+DAY_ENCODING = 'zlib-int32-float32-v1'
+# Firestore rejects documents larger than 1 MiB (name, field names and values counted)
+FIRESTORE_MAX_DOCUMENT_BYTES = 1024 * 1024
+
+
+def day_id(day_start_ms: int) -> str:
+    """Document id of the UTC day starting at day_start_ms, e.g. '2024-03-01'."""
+    return np.datetime64(day_start_ms, 'ms').astype('datetime64[D]').astype(str)
+
+
+def encode_day(offsets: np.ndarray, channels: Dict[str, np.ndarray]) -> dict:
+    """Pack a day of epochs: int32 millisecond offsets from midnight and one float32 array per channel, zlib compressed."""
+    return {
+        'encoding': DAY_ENCODING,
+        'count': int(len(offsets)),
+        'offsets': zlib.compress(offsets.astype('<i4').tobytes()),
+        'channels': {name: zlib.compress(values.astype('<f4').tobytes()) for name, values in channels.items()},
+    }
+
+
+def firestore_document_size(path: str, data: dict) -> int:
+    """Storage size of a document as Firestore counts it (see its storage size reference), for the types encode_day uses."""
+    def value_size(value) -> int:
+        if isinstance(value, dict):
+            return sum(len(key.encode()) + 1 + value_size(item) for key, item in value.items())
+        if isinstance(value, str):
+            return len(value.encode()) + 1
+        if isinstance(value, bytes):
+            return len(value)
+        return 8
+    # The document name: every path segment plus 16 bytes
+    return sum(len(segment.encode()) + 1 for segment in path.split('/')) + 16 + value_size(data) + 32
+
+
+def decode_day(data: dict) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Inverse of encode_day: (offsets, {channel: values}); missing values are NaN."""
+    if data.get('encoding') != DAY_ENCODING:
+        raise ValueError(f"unsupported day encoding {data.get('encoding')!r}")
+    offsets = np.frombuffer(zlib.decompress(data['offsets']), dtype='<i4')
+    channels = {
+        name: np.frombuffer(zlib.decompress(packed), dtype='<f4')
+        for name, packed in data.get('channels', {}).items()
+    }
+    return offsets, channels
+
+
+def merge_day(existing: Optional[dict], offsets: np.ndarray, channels: Dict[str, np.ndarray]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Merge new epochs into a stored day; on equal offsets the new values win. Result is sorted by offset."""
+    if existing is None:
+        old_offsets, old_channels = np.empty(0, dtype=np.int32), {}
+    else:
+        old_offsets, old_channels = decode_day(existing)
+
+    names = sorted(set(old_channels) | set(channels))
+    all_offsets = np.concatenate([old_offsets, offsets])
+    merged = {}
+    for name in names:
+        old = old_channels.get(name, np.full(len(old_offsets), np.nan, dtype=np.float32))
+        new = channels.get(name, np.full(len(offsets), np.nan, dtype=np.float32))
+        merged[name] = np.concatenate([old, new])
+
+    # Stable sort on the reversed arrays, then keep the first of each offset: the newest value
+    order = np.argsort(all_offsets[::-1], kind='stable')
+    reversed_offsets = all_offsets[::-1][order]
+    keep = np.ones(len(reversed_offsets), dtype=bool)
+    keep[1:] = reversed_offsets[1:] != reversed_offsets[:-1]
+    index = (len(all_offsets) - 1 - order)[keep]
+    return all_offsets[index], {name: values[index] for name, values in merged.items()}
+
+
+def _group_page_by_day(page: MeasurementPage, channels: Optional[Sequence[str]] = None) -> Dict[int, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    columns = {name: page.values[:, index] for index, name in enumerate(page.channels)}
+    day_starts = page.timestamps // DAY_MILLIS * DAY_MILLIS
+    days = {}
+    for day_start in np.unique(day_starts).tolist():
+        in_day = day_starts == day_start
+        offsets = (page.timestamps[in_day] - day_start).astype(np.int32)
+        days[day_start] = (offsets, {
+            name: columns[name][in_day].astype(np.float32) if name in columns else np.full(len(offsets), np.nan, dtype=np.float32)
+            for name in sorted(channels if channels is not None else page.channels)
+        })
+    return days
+
+
+def group_by_day(logs: Union[MeasurementPage, Iterable[Tuple[int, dict]]], channels: Optional[Sequence[str]] = None) -> Dict[int, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """Group a MeasurementPage or (timestamp, measurements) pairs per UTC day into offset and channel arrays."""
+    if isinstance(logs, MeasurementPage):
+        # Straight from the page's arrays
+        return _group_page_by_day(logs, channels)
+    logs = list(logs)
+    rows: Dict[int, List[Tuple[int, dict]]] = defaultdict(list)
+    names = set(channels) if channels is not None else set()
+    timestamps = log_times_to_millis([timestamp for timestamp, _ in logs]).tolist()
+    for timestamp_mil, (_, measurements) in zip(timestamps, logs):
+        rows[timestamp_mil // DAY_MILLIS * DAY_MILLIS].append((timestamp_mil, measurements))
+        if channels is None:
+            names.update(measurements)
+
+    days = {}
+    for day_start, day_rows in rows.items():
+        offsets = np.fromiter((timestamp_mil - day_start for timestamp_mil, _ in day_rows), dtype=np.int32, count=len(day_rows))
+        days[day_start] = (offsets, {
+            name: np.fromiter(
+                (np.nan if measurements.get(name) is None else measurements[name] for _, measurements in day_rows),
+                dtype=np.float32,
+                count=len(day_rows),
+            )
+            for name in sorted(names)
+        })
+    return days
+
+
+async def write_measurement_days_firestore(
+    db: firestore.AsyncClient,
+    user_id: int,
+    logs: Union[MeasurementPage, Iterable[Tuple[int, dict]]],
+    channels: Optional[Sequence[str]] = None,
+    final_writes: Optional[Callable] = None,
+) -> int:
+    """
+    Store measurements in the packed layout: one '{DAYS_COLLECTION}/{user_id}/days/{YYYY-MM-DD}' document per UTC day.
+
+    The days touched are read in one get_all, merged with the new epochs and written back in one
+    batch, so a page costs one read and one commit instead of one write per epoch. Writes for the
+    same user must not run concurrently (the sync has one writer per user), otherwise a day could
+    lose the other writer's epochs. final_writes(batch) adds more writes (e.g. a sync checkpoint)
+    to the last batch, so they commit together with the last days (batches leave room for them
+    under FIRESTORE_MAX_BATCH_SIZE). Transient errors are retried like the per-epoch batches (see
+    commit_firestore_batch); a batch that still fails raises. A day that would not fit in a
+    Firestore document raises ValueError before anything is written.
+
+    Returns:
+        int: The number of day documents written.
+    """
+    days = group_by_day(logs, channels)
+    if not days:
+        return 0
+
+    days_collection = db.collection(DAYS_COLLECTION).document(str(user_id)).collection('days')
+    refs = {day_start: days_collection.document(day_id(day_start)) for day_start in days}
+    existing = {}
+    async for doc in db.get_all(list(refs.values())):
+        if doc.exists:
+            existing[doc.id] = doc.to_dict()
+
+    documents = []
+    for day_start, (offsets, values) in sorted(days.items()):
+        ref = refs[day_start]
+        merged_offsets, merged_values = merge_day(existing.get(ref.id), offsets, values)
+        document = {'day': ref.id, 'day_start': day_start, 'userId': user_id, **encode_day(merged_offsets, merged_values)}
+        size = firestore_document_size(ref.path, document)
+        if size > FIRESTORE_MAX_DOCUMENT_BYTES:
+            raise ValueError(f"day document {ref.path} would take {size} bytes ({len(merged_offsets)} epochs), "
+                             f"over Firestore's {FIRESTORE_MAX_DOCUMENT_BYTES} byte limit")
+        documents.append((ref, document))
+
+    batch_size = FIRESTORE_MAX_BATCH_SIZE - count_final_writes(db, final_writes)
+    for start in range(0, len(documents), batch_size):
+        chunk = documents[start:start + batch_size]
+        is_last = start + batch_size >= len(documents)
+
+        def add_writes(batch, chunk=chunk, is_last=is_last) -> None:
+            for ref, document in chunk:
+                batch.set(ref, document)
+            if final_writes is not None and is_last:
+                final_writes(batch)
+
+        await commit_firestore_batch(db, add_writes)
+    return len(days)
+
+
+async def migrate_user_to_days_firestore(db: firestore.AsyncClient, user_id: int, channels: Optional[Sequence[str]] = None) -> int:
+    """
+    Copy a user's per-epoch measurement documents into the packed day layout (main.py migrate-days);
+    returns the epochs copied. Days already packed are merged with, so running it again is harmless.
+    """
+    from utils.measurement_queries import query_measurements_firestore
+
+    copied = 0
+    async for page in query_measurements_firestore(db, user_id):
+        logs = [(doc['timestamp'], {k: v for k, v in doc.items() if k != 'timestamp'}) for doc in page]
+        await write_measurement_days_firestore(db, user_id, logs, channels)
+        copied += len(logs)
+    return copied
@@ -0,0 +1,167 @@
+import sqlite3
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+from firebase_admin import firestore
+
+from utils.cache import notify_user_updated
+from utils.database_utils import FIRESTORE_MAX_BATCH_SIZE
+
+Cursor = Tuple[Optional[str], int]
+
+
+class CursorStore:
+    """
+    Per-user sync cursors ('starting_after', 'data_size') kept in memory for the length of a run.
+
+    load() reads the cursors of all users of the run in one go, get() is then served from memory,
+    save() only marks a cursor dirty and flush() writes every dirty cursor back in one round trip,
+    then notifies the user update listeners (see utils.cache) of every user it advanced.
+    Subclasses implement the bulk read and write for their backend.
+
+    For per-page checkpoints a store can also hand out its cursor write as a hook into the page's own
+    data write (firestore_cursor_write / sqlite_cursor_write), so the cursor commits atomically with
+    the data; committed() then records it as written.
+    """
+
+    def __init__(self, flush_threshold: int = FIRESTORE_MAX_BATCH_SIZE):
+        self.flush_threshold = flush_threshold
+        self._cursors: Dict[int, Cursor] = {}
+        self._dirty: Set[int] = set()
+        self._loaded: Set[int] = set()
+
+    async def load(self, user_ids: Iterable[int]) -> None:
+        """Bulk-load the cursors of the given users that are not cached yet."""
+        missing = [user_id for user_id in user_ids if user_id not in self._loaded]
+        if missing:
+            self._cursors.update(await self._read_many(missing))
+            self._loaded.update(missing)
+
+    async def get(self, user_id: int) -> Optional[Cursor]:
+        """Return the user's cursor, reading it from the backend only if it was not loaded before."""
+        if user_id not in self._loaded:
+            await self.load([user_id])
+        return self._cursors.get(user_id)
+
+    async def save(self, user_id: int, starting_after: Optional[str], data_size: int) -> None:
+        """Remember the user's new cursor; it is written on the next flush (automatic once flush_threshold are pending)."""
+        cursor = (starting_after, data_size)
+        self._loaded.add(user_id)
+        if self._cursors.get(user_id) == cursor:
+            return
+        self._cursors[user_id] = cursor
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.flush_threshold:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write every changed cursor back to the backend."""
+        if not self._dirty:
+            return
+        dirty = {user_id: self._cursors[user_id] for user_id in self._dirty}
+        self._dirty.clear()
+        try:
+            await self._write_many(dirty)
+        except BaseException:
+            self._dirty.update(dirty)
+            raise
+        for user_id in dirty:
+            notify_user_updated(user_id)
+
+    def firestore_cursor_write(self, user_id: int, cursor: Cursor) -> Optional[Callable]:
+        """A function adding the cursor write to a Firestore batch, or None if this store does not live in Firestore."""
+        return None
+
+    def sqlite_cursor_write(self, connection: sqlite3.Connection, user_id: int, cursor: Cursor) -> Optional[Callable[[sqlite3.Connection], None]]:
+        """A function writing the cursor inside an open transaction of `connection`, or None if the store is elsewhere."""
+        return None
+
+    def committed(self, user_id: int, starting_after: Optional[str], data_size: int) -> None:
+        """Record a cursor that was already written together with its page's data."""
+        cursor = (starting_after, data_size)
+        self._loaded.add(user_id)
+        self._dirty.discard(user_id)
+        if self._cursors.get(user_id) != cursor:
+            self._cursors[user_id] = cursor
+            notify_user_updated(user_id)
+
+    async def _read_many(self, user_ids: Iterable[int]) -> Dict[int, Cursor]:
+        raise NotImplementedError
+
+    async def _write_many(self, cursors: Dict[int, Cursor]) -> None:
+        raise NotImplementedError
+
+
+class FirestoreCursorStore(CursorStore):
+    """Cursors stored as '{collection_name}/{user_id}' documents, read with get_all and written with merge-set batches."""
+
+    def __init__(self, db: firestore.AsyncClient, collection_name: str, flush_threshold: int = FIRESTORE_MAX_BATCH_SIZE):
+        super().__init__(flush_threshold)
+        self.db = db
+        self.collection_name = collection_name
+
+    async def _read_many(self, user_ids: Iterable[int]) -> Dict[int, Cursor]:
+        collection = self.db.collection(self.collection_name)
+        cursors = {}
+        async for doc in self.db.get_all([collection.document(str(user_id)) for user_id in user_ids]):
+            if doc.exists:
+                data = doc.to_dict()
+                cursors[int(doc.id)] = (data.get('starting_after'), data.get('data_size'))
+        return cursors
+
+    def _set_cursor(self, batch, user_id: int, cursor: Cursor) -> None:
+        starting_after, data_size = cursor
+        batch.set(self.db.collection(self.collection_name).document(str(user_id)), {
+            'starting_after': starting_after,
+            'data_size': data_size
+        }, merge=True)
+
+    async def _write_many(self, cursors: Dict[int, Cursor]) -> None:
+        items = list(cursors.items())
+        for start in range(0, len(items), FIRESTORE_MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for user_id, cursor in items[start:start + FIRESTORE_MAX_BATCH_SIZE]:
+                self._set_cursor(batch, user_id, cursor)
+            await batch.commit()
+
+    def firestore_cursor_write(self, user_id: int, cursor: Cursor) -> Optional[Callable]:
+        return lambda batch: self._set_cursor(batch, user_id, cursor)
+
+
+class SQLiteCursorStore(CursorStore):
+    """Cursors stored in the local last place table, read with one indexed SELECT and written with an upsert."""
+
+    def __init__(self, connection: sqlite3.Connection, table_name: str, flush_threshold: int = FIRESTORE_MAX_BATCH_SIZE):
+        super().__init__(flush_threshold)
+        self.connection = connection
+        self.table_name = table_name
+
+    async def _read_many(self, user_ids: Iterable[int]) -> Dict[int, Cursor]:
+        user_ids = list(user_ids)
+        cursors = {}
+        cursor = self.connection.cursor()
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(user_ids), 900):
+            chunk = user_ids[start:start + 900]
+            cursor.execute(f'''
+            SELECT user_id, starting_after, data_size
+            FROM {self.table_name}
+            WHERE user_id IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+            for user_id, starting_after, data_size in cursor.fetchall():
+                cursors[user_id] = (starting_after, data_size)
+        return cursors
+
+    def _upsert(self, connection: sqlite3.Connection, cursors: Dict[int, Cursor]) -> None:
+        connection.executemany(f'''
+        INSERT INTO {self.table_name} (user_id, starting_after, data_size)
+        VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET starting_after = excluded.starting_after, data_size = excluded.data_size
+        ''', [(user_id, starting_after, data_size) for user_id, (starting_after, data_size) in cursors.items()])
+
+    async def _write_many(self, cursors: Dict[int, Cursor]) -> None:
+        with self.connection:
+            self._upsert(self.connection, cursors)
+
+    def sqlite_cursor_write(self, connection: sqlite3.Connection, user_id: int, cursor: Cursor) -> Optional[Callable[[sqlite3.Connection], None]]:
+        if connection is not self.connection:
+            return None
+        return lambda connection: self._upsert(connection, {user_id: cursor})
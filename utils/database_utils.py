@@ -1,12 +1,103 @@
+from __future__ import annotations
+
 import sqlite3
 import datetime
-from typing import Optional, Tuple
-from firebase_admin import firestore
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Type, Union
+
+from utils.cache import notify_user_updated
+from utils.measurement_page import MeasurementPage
+from utils.metrics import FIRESTORE_RETRIES, retry_counter
+from utils.timestamps import log_times_to_millis, timestamp_to_millis
+
+# The SQLite helpers are also used by server.py, which never talks to Firestore: the Firebase,
+# google-api-core and tenacity imports are deferred to the functions that write to it.
+if TYPE_CHECKING:
+    from firebase_admin import firestore
+
+# Firestore rejects commits with more than 500 writes.
+FIRESTORE_MAX_BATCH_SIZE = 500
+# Staged logs read, uploaded and flagged at a time when replaying a backlog
+REPLAY_CHUNK_SIZE = 10 * FIRESTORE_MAX_BATCH_SIZE
+
+
+@lru_cache(maxsize=None)
+def firestore_transient_errors() -> Tuple[Type[Exception], ...]:
+    """Errors worth retrying a batch commit for; anything else is reported as a failed batch."""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+    )
+
+
+@dataclass
+class BatchWriteResult:
+    """Outcome of a batched measurement write: how much landed, which timestamps did not and whether the sync checkpoint was committed with it."""
+    written: int = 0
+    batches: int = 0
+    failed_timestamps: List[int] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    checkpointed: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed_timestamps
 
+    def merge(self, other: 'BatchWriteResult') -> None:
+        self.written += other.written
+        self.batches += other.batches
+        self.failed_timestamps.extend(other.failed_timestamps)
+        self.errors.extend(other.errors)
 
-def connect_to_db(db_name: str) -> sqlite3.Connection:
+
+# Pragmas for the local staging store: WAL lets readers run next to the writer and, with
+# synchronous=NORMAL, a commit no longer waits for an fsync of the main database file.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Local staging store tables, as created by main.py
+LAST_PLACE_TABLE = 'last_place_table'
+MEASUREMENT_LOGS_TABLE = 'sensor_logs'
+# Columns of the logs table that are bookkeeping, not measurements; 'timestamp' is also a field of
+# every measurement document in Firestore
+NON_MEASUREMENT_COLUMNS = frozenset({'log_id', 'user_id', 'timestamp', 'uploaded'})
+
+# Light exposure aggregates kept up to date during ingestion and served by server.py
+LIGHT_EXPOSURE_CHANNEL = 'lux_melanopic'
+LIGHT_EXPOSURE_WINDOWS_DAYS = (1, 7, 30)
+LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS = 7
+LIGHT_EXPOSURE_DAILY_TABLE = 'light_exposure_daily'
+LIGHT_EXPOSURE_SUMMARY_TABLE = 'light_exposure_summary'
+DAY_MILLIS = 24 * 60 * 60 * 1000
+
+# Measurement columns known per (connection, table), so inserts don't run PRAGMA table_info every time.
+_measurement_columns: Dict[Tuple[int, str], Set[str]] = {}
+
+
+def connect_to_db(db_name: str, tune: bool = True) -> sqlite3.Connection:
     """Connect to the SQLite database and return the connection object."""
-    return sqlite3.connect(db_name)
+    connection = sqlite3.connect(db_name)
+    if tune:
+        configure_connection(connection)
+    return connection
+
+
+def configure_connection(connection: sqlite3.Connection) -> None:
+    """Apply the staging store pragmas (WAL journal, relaxed fsync, in-memory temp tables, bigger cache)."""
+    cursor = connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
 
 
 def create_table_with_timestamp(connection: sqlite3.Connection, base_name: str) -> str:
@@ -36,6 +127,10 @@ def create_table(connection: sqlite3.Connection, table_name: str) -> str:
         data_size INTEGER NOT NULL
     )
     ''')
+    # One cursor per user; lets lookups use the index and upserts use ON CONFLICT
+    cursor.execute(f'''
+    CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_user_id ON {table_name} (user_id)
+    ''')
     connection.commit()
     return table_name
 
@@ -53,25 +148,15 @@ def insert_or_update_user_last_place(connection: sqlite3.Connection, table_name:
     """Insert a new user or update the existing user's starting_after and data_size."""
     cursor = connection.cursor()
 
-    # Check if the user_id exists
-    cursor.execute(f"SELECT 1 FROM {table_name} WHERE user_id = ?", (user_id,))
-    exists = cursor.fetchone()
-
-    if exists:
-        # Update the existing user's starting_after and data_size
-        cursor.execute(f'''
-        UPDATE {table_name}
-        SET starting_after = ?, data_size = ?
-        WHERE user_id = ?
-        ''', (starting_after, data_size, user_id))
-    else:
-        # Insert a new user with the provided user_id, starting_after, and data_size
-        cursor.execute(f'''
-        INSERT INTO {table_name} (user_id, starting_after, data_size)
-        VALUES (?, ?, ?)
-        ''', (user_id, starting_after, data_size))
+    # Single statement upsert on the unique user_id index
+    cursor.execute(f'''
+    INSERT INTO {table_name} (user_id, starting_after, data_size)
+    VALUES (?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET starting_after = excluded.starting_after, data_size = excluded.data_size
+    ''', (user_id, starting_after, data_size))
     
     connection.commit()
+    notify_user_updated(user_id)
 
 def get_user_data(connection: sqlite3.Connection, table_name: str, user_id: int) -> Optional[Tuple[Optional[str], Optional[int]]]:
     """Retrieve 'starting_after' and 'data_size' values for a given user_id."""
@@ -95,49 +180,303 @@ def create_measurement_logs_table(connection: sqlite3.Connection, logs_table_nam
     """Create a table for measurement logs associated with users."""
     cursor = connection.cursor()
     
-    # Create the measurement logs table with a foreign key reference to the users table
+    # Create the measurement logs table with a foreign key reference to the users table.
+    # timestamp holds epoch milliseconds, the same value used as Firestore document id.
     cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS {logs_table_name} (
         log_id INTEGER PRIMARY KEY,
         user_id INTEGER,
         timestamp TIMESTAMP,
+        uploaded INTEGER NOT NULL DEFAULT 0,
         FOREIGN KEY (user_id) REFERENCES {users_table_name} (user_id)
     )
     ''')
+    _measurement_columns.pop((id(connection), logs_table_name), None)
+    if 'uploaded' not in get_measurement_columns(connection, logs_table_name):
+        cursor.execute(f"ALTER TABLE {logs_table_name} ADD COLUMN uploaded INTEGER NOT NULL DEFAULT 0")
+        _measurement_columns.pop((id(connection), logs_table_name), None)
+
+    # One row per user and epoch, so syncing the same page twice is a no-op
+    cursor.execute(f'''
+    CREATE UNIQUE INDEX IF NOT EXISTS {logs_table_name}_user_timestamp
+    ON {logs_table_name} (user_id, timestamp)
+    ''')
+    cursor.execute(f'''
+    CREATE INDEX IF NOT EXISTS {logs_table_name}_pending
+    ON {logs_table_name} (uploaded, user_id)
+    ''')
     
     connection.commit()
     return logs_table_name
 
+def get_measurement_columns(connection: sqlite3.Connection, logs_table_name: str) -> Set[str]:
+    """Return the columns of the logs table, read once per connection and then cached."""
+    key = (id(connection), logs_table_name)
+    columns = _measurement_columns.get(key)
+    if columns is None:
+        cursor = connection.cursor()
+        cursor.execute(f"PRAGMA table_info({logs_table_name})")
+        columns = {info[1] for info in cursor.fetchall()}
+        _measurement_columns[key] = columns
+    return columns
+
 def add_measurement_column(connection: sqlite3.Connection, logs_table_name: str, column_name: str) -> None:
     """Dynamically add a new measurement column to the logs table if it does not exist."""
-    cursor = connection.cursor()
-    cursor.execute(f"PRAGMA table_info({logs_table_name})")
-    columns = [info[1] for info in cursor.fetchall()]
+    columns = get_measurement_columns(connection, logs_table_name)
     if column_name not in columns:
+        cursor = connection.cursor()
         cursor.execute(f"ALTER TABLE {logs_table_name} ADD COLUMN {column_name} REAL")
         connection.commit()
+        columns.add(column_name)
+
+def _millis_entries(logs: Iterable[Tuple[Union[int, str, datetime.datetime], dict]]) -> List[Tuple[int, dict]]:
+    """(timestamp, measurements) pairs with every timestamp converted to epoch ms in one page-level call."""
+    logs = list(logs)
+    timestamps = log_times_to_millis([timestamp for timestamp, _ in logs]).tolist()
+    return [(timestamp_mil, measurements) for timestamp_mil, (_, measurements) in zip(timestamps, logs)]
+
+
+def insert_measurement_logs(
+    connection: sqlite3.Connection,
+    logs_table_name: str,
+    user_id: int,
+    logs: Union[MeasurementPage, Iterable[Tuple[Union[int, str, datetime.datetime], dict]]],
+    in_transaction: Optional[Callable[[sqlite3.Connection], None]] = None,
+) -> int:
+    """
+    Insert many measurement logs for a user with one executemany in a single transaction.
+
+    logs is a MeasurementPage, whose rows are fed to SQLite straight from its arrays, or
+    (timestamp, measurements) pairs.
+
+    Logs already stored for the same (user_id, timestamp) are updated in place, so re-syncing a page
+    does not duplicate rows; they are marked as not uploaded again. `in_transaction` is called inside
+    the same transaction, so e.g. a sync checkpoint commits together with the logs or not at all
+    (it is not called without logs).
+
+    Returns:
+        int: The number of rows inserted or updated.
+    """
+    if isinstance(logs, MeasurementPage):
+        if not len(logs):
+            return 0
+        measurement_names, rows = logs.staging_rows(user_id)
+    else:
+        entries = _millis_entries(logs)
+        if not entries:
+            return 0
+        measurement_names = sorted({name for _, measurements in entries for name in measurements})
+        rows = [
+            (user_id, timestamp_mil, *(measurements.get(name) for name in measurement_names))
+            for timestamp_mil, measurements in entries
+        ]
+    for measurement_name in measurement_names:
+        add_measurement_column(connection, logs_table_name, measurement_name)
+
+    columns = "".join(f", {name}" for name in measurement_names)
+    placeholders = "".join(", ?" for _ in measurement_names)
+    updates = "".join(f", {name} = excluded.{name}" for name in measurement_names)
+
+    with connection:
+        cursor = connection.executemany(f'''
+        INSERT INTO {logs_table_name} (user_id, timestamp{columns})
+        VALUES (?, ?{placeholders})
+        ON CONFLICT (user_id, timestamp) DO UPDATE SET uploaded = 0{updates}
+        ''', rows)
+        if in_transaction is not None:
+            in_transaction(connection)
+    return cursor.rowcount
 
 def insert_measurement_log(connection: sqlite3.Connection, logs_table_name: str,  measurements: dict, user_id: int, timestamp: datetime) -> None:
     """Insert a new measurement log entry for a user."""
-    for measurement_name, measurement_value in measurements.items():
-        add_measurement_column(connection, logs_table_name, measurement_name)
+    insert_measurement_logs(connection, logs_table_name, user_id, [(timestamp, measurements)])
 
+def get_pending_measurement_logs(connection: sqlite3.Connection, logs_table_name: str, user_id: int, limit: Optional[int] = None, after: Optional[int] = None) -> List[Tuple[int, dict]]:
+    """
+    Return (timestamp, measurements) for a user's logs that are not uploaded to Firestore yet, oldest first.
+
+    With `after` (a timestamp) only later logs are returned, so a backlog can be read in chunks of
+    `limit` that skip logs left pending by an earlier chunk.
+    """
+    measurement_names = sorted(get_measurement_columns(connection, logs_table_name) - NON_MEASUREMENT_COLUMNS)
+    columns = "".join(f", {name}" for name in measurement_names)
+    parameters = [user_id]
+    if after is not None:
+        parameters.append(after)
+    if limit is not None:
+        parameters.append(limit)
     cursor = connection.cursor()
+    cursor.execute(f'''
+    SELECT timestamp{columns}
+    FROM {logs_table_name}
+    WHERE uploaded = 0 AND user_id = ?{" AND timestamp > ?" if after is not None else ""}
+    ORDER BY timestamp
+    {"LIMIT ?" if limit is not None else ""}
+    ''', parameters)
+    return [
+        (row[0], {name: value for name, value in zip(measurement_names, row[1:]) if value is not None})
+        for row in cursor.fetchall()
+    ]
 
-    # Prepare the columns and their corresponding values
-    columns = ", ".join(measurements.keys())
-    placeholders = ", ".join(["?"] * len(measurements))
-    values = list(measurements.values())
-    
+def get_latest_measurement_timestamps(connection: sqlite3.Connection, logs_table_name: str, user_ids: Iterable[int]) -> Dict[int, int]:
+    """Return the newest staged log timestamp (epoch ms) of each given user that has any, read off the (user_id, timestamp) index."""
+    user_ids = list(user_ids)
+    latest = {}
+    cursor = connection.cursor()
+    # Stay below SQLite's bound parameter limit
+    for start in range(0, len(user_ids), 900):
+        chunk = user_ids[start:start + 900]
+        cursor.execute(f'''
+        SELECT user_id, MAX(timestamp)
+        FROM {logs_table_name}
+        WHERE user_id IN ({", ".join("?" * len(chunk))})
+        GROUP BY user_id
+        ''', chunk)
+        latest.update(cursor.fetchall())
+    return latest
+
+def get_measurement_log_user_ids(connection: sqlite3.Connection, logs_table_name: str) -> List[int]:
+    """Return every user with staged logs."""
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT DISTINCT user_id FROM {logs_table_name} ORDER BY user_id")
+    return [row[0] for row in cursor.fetchall()]
+
+def get_users_with_pending_measurement_logs(connection: sqlite3.Connection, logs_table_name: str) -> List[int]:
+    """Return the users that still have logs waiting for upload."""
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT DISTINCT user_id FROM {logs_table_name} WHERE uploaded = 0 ORDER BY user_id")
+    return [row[0] for row in cursor.fetchall()]
+
+def mark_measurement_logs_uploaded(connection: sqlite3.Connection, logs_table_name: str, user_id: int, timestamps: Iterable[int]) -> None:
+    """Flag a user's logs as uploaded to Firestore."""
+    with connection:
+        connection.executemany(
+            f"UPDATE {logs_table_name} SET uploaded = 1 WHERE user_id = ? AND timestamp = ?",
+            ((user_id, timestamp_mil) for timestamp_mil in timestamps),
+        )
+
+def create_light_exposure_tables(connection: sqlite3.Connection) -> None:
+    """Create the daily and per-window light exposure aggregate tables."""
+    cursor = connection.cursor()
+    # Per user and UTC day: sum and number of light exposure values
     cursor.execute(f'''
-    INSERT INTO {logs_table_name} (user_id, timestamp, {columns})
-    VALUES (?, ?, {placeholders})
-    ''', (user_id, timestamp, *values))
-    
+    CREATE TABLE IF NOT EXISTS {LIGHT_EXPOSURE_DAILY_TABLE} (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        lux_sum REAL NOT NULL,
+        lux_count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID
+    ''')
+    # Per user and window: mean and cumulative light exposure over the window_days ending at last_day.
+    # revision grows with every update, so readers can ask which users changed since they last looked.
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {LIGHT_EXPOSURE_SUMMARY_TABLE} (
+        user_id INTEGER NOT NULL,
+        window_days INTEGER NOT NULL,
+        mean_lux REAL,
+        cumulative_lux REAL NOT NULL,
+        sample_count INTEGER NOT NULL,
+        last_day TEXT NOT NULL,
+        revision INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, window_days)
+    ) WITHOUT ROWID
+    ''')
+    # Tables created before revisions existed
+    if 'revision' not in {row[1] for row in cursor.execute(f"PRAGMA table_info({LIGHT_EXPOSURE_SUMMARY_TABLE})")}:
+        cursor.execute(f"ALTER TABLE {LIGHT_EXPOSURE_SUMMARY_TABLE} ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(f'''
+    CREATE INDEX IF NOT EXISTS {LIGHT_EXPOSURE_SUMMARY_TABLE}_revision
+    ON {LIGHT_EXPOSURE_SUMMARY_TABLE} (revision)
+    ''')
     connection.commit()
 
+def update_light_exposure_aggregates(connection: sqlite3.Connection, logs_table_name: str, user_id: int, timestamps: Iterable[int], windows: Iterable[int] = LIGHT_EXPOSURE_WINDOWS_DAYS) -> None:
+    """
+    Refresh a user's light exposure aggregates after new logs were staged.
+
+    Only the days spanned by the new timestamps are recomputed from the logs table (an indexed range
+    scan), then the per-window rows are rebuilt from the daily table. Recomputing instead of adding
+    keeps the aggregates right when the same page is ingested twice. The rebuilt rows get a new
+    revision (see LIGHT_EXPOSURE_CHANGES_QUERY).
+    """
+    timestamps = list(timestamps)
+    if not timestamps or LIGHT_EXPOSURE_CHANNEL not in get_measurement_columns(connection, logs_table_name):
+        return
+
+    first_day = min(timestamps) // DAY_MILLIS * DAY_MILLIS
+    end_day = max(timestamps) // DAY_MILLIS * DAY_MILLIS + DAY_MILLIS
+
+    with connection:
+        connection.execute(f'''
+        INSERT INTO {LIGHT_EXPOSURE_DAILY_TABLE} (user_id, day, lux_sum, lux_count)
+        SELECT user_id, date(timestamp / 1000, 'unixepoch'), TOTAL({LIGHT_EXPOSURE_CHANNEL}), COUNT({LIGHT_EXPOSURE_CHANNEL})
+        FROM {logs_table_name}
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+        GROUP BY user_id, date(timestamp / 1000, 'unixepoch')
+        ON CONFLICT (user_id, day) DO UPDATE SET lux_sum = excluded.lux_sum, lux_count = excluded.lux_count
+        ''', (user_id, first_day, end_day))
+
+        for window_days in windows:
+            connection.execute(f'''
+            INSERT INTO {LIGHT_EXPOSURE_SUMMARY_TABLE} (user_id, window_days, mean_lux, cumulative_lux, sample_count, last_day, revision)
+            SELECT ?, ?, TOTAL(lux_sum) / NULLIF(SUM(lux_count), 0), TOTAL(lux_sum), SUM(lux_count), latest.day,
+                   (SELECT IFNULL(MAX(revision), 0) + 1 FROM {LIGHT_EXPOSURE_SUMMARY_TABLE})
+            FROM {LIGHT_EXPOSURE_DAILY_TABLE},
+                 (SELECT MAX(day) AS day FROM {LIGHT_EXPOSURE_DAILY_TABLE} WHERE user_id = ?) AS latest
+            WHERE user_id = ? AND {LIGHT_EXPOSURE_DAILY_TABLE}.day > date(latest.day, ?)
+            GROUP BY latest.day
+            ON CONFLICT (user_id, window_days) DO UPDATE SET
+                mean_lux = excluded.mean_lux,
+                cumulative_lux = excluded.cumulative_lux,
+                sample_count = excluded.sample_count,
+                last_day = excluded.last_day,
+                revision = excluded.revision
+            ''', (user_id, window_days, user_id, user_id, f"-{window_days} days"))
+
+LIGHT_EXPOSURE_QUERY = f'''
+    SELECT mean_lux, cumulative_lux, sample_count, last_day
+    FROM {LIGHT_EXPOSURE_SUMMARY_TABLE}
+    WHERE user_id = ? AND window_days = ?
+    '''
+
+LIGHT_EXPOSURE_USER_QUERY = f'''
+    SELECT window_days, mean_lux, cumulative_lux, sample_count, last_day
+    FROM {LIGHT_EXPOSURE_SUMMARY_TABLE}
+    WHERE user_id = ?
+    '''
+
+# Users whose summary rows changed after a revision, with the newest revision of each (an index range scan)
+LIGHT_EXPOSURE_CHANGES_QUERY = f'''
+    SELECT user_id, MAX(revision)
+    FROM {LIGHT_EXPOSURE_SUMMARY_TABLE}
+    WHERE revision > ?
+    GROUP BY user_id
+    '''
+
+def light_exposure_from_row(row: Optional[tuple], window_days: int) -> Optional[dict]:
+    """Turn a LIGHT_EXPOSURE_QUERY row into the response served for /get_value."""
+    if row is None:
+        return None
+    mean_lux, cumulative_lux, sample_count, last_day = row
+    return {
+        'light_exposure': mean_lux,
+        'cumulative_light_exposure': cumulative_lux,
+        'sample_count': sample_count,
+        'window_days': window_days,
+        'last_day': last_day,
+    }
+
+def get_light_exposure(connection: sqlite3.Connection, user_id: int, window_days: int = LIGHT_EXPOSURE_DEFAULT_WINDOW_DAYS) -> Optional[dict]:
+    """Look up a user's precomputed light exposure for a window (primary key lookup), or None if there is none."""
+    cursor = connection.cursor()
+    cursor.execute(LIGHT_EXPOSURE_QUERY, (user_id, window_days))
+    return light_exposure_from_row(cursor.fetchone(), window_days)
+
 def close_connection(connection: sqlite3.Connection) -> None:
     """Close the connection to the database."""
+    for key in [key for key in _measurement_columns if key[0] == id(connection)]:
+        del _measurement_columns[key]
     connection.close()
 
 
@@ -182,22 +521,15 @@ async def insert_or_update_user_last_place_firestore(db: firestore.AsyncClient,
     """
     # Reference to the user's document within the collection
     user_doc_ref = db.collection(collection_name).document(str(user_id))
-    
-    # Check if the document exists
-    doc = await user_doc_ref.get()
-    
-    if doc.exists:
-        # Update the existing user's 'starting_after' and 'data_size'
-        await user_doc_ref.update({
-            'starting_after': starting_after,
-            'data_size': data_size
-        })
-    else:
-        # Insert a new document for the user
-        await user_doc_ref.set({
-            'starting_after': starting_after,
-            'data_size': data_size
-        })
+
+    # A merge-set creates the document or updates the two fields in a single round trip
+    await user_doc_ref.set({
+        'starting_after': starting_after,
+        'data_size': data_size
+    }, merge=True)
+
+    # The user has new data: let in-process caches drop what they hold for it
+    notify_user_updated(user_id)
 
 
 async def insert_measurement_log_firestore(db: firestore.AsyncClient, measurements: dict, user_id: int, timestamp: datetime) -> None:
@@ -211,13 +543,8 @@ async def insert_measurement_log_firestore(db: firestore.AsyncClient, measuremen
         timestamp (datetime): The timestamp of the log entry.
     """
 
-    # Check if timestamp is a string, convert it to datetime if necessary
-    if isinstance(timestamp, str):
-        # Parse the timestamp string into a datetime object
-        timestamp = datetime.datetime.fromisoformat(timestamp)
-
     # Format the timestamp as a string to use as a document ID (Firestore doesn't support datetime directly as IDs)
-    timestamp_mil = int(timestamp.timestamp() * 1000)
+    timestamp_mil = timestamp_to_millis(timestamp)
 
     # Structure: actigraphy_data -> user_id -> measurements -> timestamp
     user_doc_ref = db.collection('actigraphy_data').document(str(user_id))
@@ -233,4 +560,194 @@ async def insert_measurement_log_firestore(db: firestore.AsyncClient, measuremen
     await measurement_doc_ref.set(log_data)
 
     # Add or update the 'userId' field in the user's document
-    await user_doc_ref.set({'userId': user_id}, merge=True)  # merge=True to avoid overwriting existing fields
\ No newline at end of file
+    await user_doc_ref.set({'userId': user_id}, merge=True)  # merge=True to avoid overwriting existing fields
+
+
+async def upsert_user_document_firestore(db: firestore.AsyncClient, user_id: int) -> None:
+    """
+    Make sure the parent 'actigraphy_data/{user_id}' document exists.
+
+    Only needs to run once per user per sync, before the user's measurements are written in batches.
+
+    Args:
+        db (firestore.Client): The Firestore client.
+        user_id (int): The user's ID.
+    """
+    user_doc_ref = db.collection('actigraphy_data').document(str(user_id))
+    await user_doc_ref.set({'userId': user_id}, merge=True)
+
+
+def count_final_writes(db: firestore.AsyncClient, final_writes: Optional[Callable]) -> int:
+    """How many writes final_writes(batch) adds, counted on a batch that is never committed (no round trip)."""
+    if final_writes is None:
+        return 0
+    probe = db.batch()
+    final_writes(probe)
+    return len(probe)
+
+
+async def commit_firestore_batch(db: firestore.AsyncClient, add_writes: Callable, max_attempts: int = 3) -> None:
+    """
+    Commit the writes add_writes(batch) adds, retrying transient errors (see firestore_transient_errors).
+
+    The batch is rebuilt on every attempt, as a committed batch cannot be reused; the last error is
+    raised once max_attempts are used up.
+    """
+    from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(firestore_transient_errors()),
+        stop=stop_after_attempt(max_attempts),
+        wait=wait_exponential_jitter(initial=0.5, max=10),
+        before_sleep=retry_counter(FIRESTORE_RETRIES),
+        reraise=True,
+    ):
+        with attempt:
+            batch = db.batch()
+            add_writes(batch)
+            await batch.commit()
+
+
+async def _commit_measurement_batch(db: firestore.AsyncClient, user_doc_ref, chunk: List[Tuple[int, dict]], max_attempts: int, extra_writes: Optional[Callable] = None) -> None:
+    """Commit one chunk of (timestamp, document) pairs, plus extra_writes(batch) if given."""
+    def add_writes(batch) -> None:
+        for timestamp_mil, document in chunk:
+            measurement_doc_ref = user_doc_ref.collection('measurements').document(str(timestamp_mil))
+            batch.set(measurement_doc_ref, document)
+        if extra_writes is not None:
+            extra_writes(batch)
+
+    await commit_firestore_batch(db, add_writes, max_attempts)
+
+
+async def insert_measurement_logs_firestore_batched(
+    db: firestore.AsyncClient,
+    user_id: int,
+    logs: Union[MeasurementPage, Iterable[Tuple[Union[str, datetime.datetime], dict]]],
+    batch_size: int = FIRESTORE_MAX_BATCH_SIZE,
+    max_attempts: int = 3,
+    final_writes: Optional[Callable] = None,
+) -> BatchWriteResult:
+    """
+    Write many measurement log entries for a user using Firestore write batches.
+
+    Measurements land in the same 'actigraphy_data/{user_id}/measurements/{timestamp}' documents as
+    insert_measurement_log_firestore, but up to batch_size of them are committed per round trip.
+    The parent user document is not touched here; call upsert_user_document_firestore once per run.
+    Transient errors are retried per batch; a batch that still fails is reported in the result and
+    the remaining batches are still attempted. Documents are only built for the batch being
+    committed.
+
+    final_writes(batch) adds more writes to the last batch, but only if every batch before it was
+    committed: they land together with the last measurements, after all the others, or not at all.
+    With at least one log, the result is ok exactly when they were committed. Batches are made
+    smaller by as many writes, so the last one stays within FIRESTORE_MAX_BATCH_SIZE.
+
+    Args:
+        db (firestore.Client): The Firestore client.
+        user_id (int): The user's ID.
+        logs (MeasurementPage | Iterable[Tuple[str | datetime, dict]]): A page, or (timestamp, measurements) pairs.
+        batch_size (int): Writes per commit, at most FIRESTORE_MAX_BATCH_SIZE.
+        max_attempts (int): Commit attempts per batch before it is reported as failed.
+        final_writes (Callable): Adds writes (e.g. a sync checkpoint) to the last batch.
+
+    Returns:
+        BatchWriteResult: Counts of written documents and batches, plus failed timestamps and errors.
+    """
+    if not 0 < batch_size <= FIRESTORE_MAX_BATCH_SIZE:
+        raise ValueError(f"batch_size must be between 1 and {FIRESTORE_MAX_BATCH_SIZE}, got {batch_size}")
+    from google.api_core import exceptions as google_exceptions
+
+    batch_size = min(batch_size, FIRESTORE_MAX_BATCH_SIZE - count_final_writes(db, final_writes))
+    user_doc_ref = db.collection('actigraphy_data').document(str(user_id))
+    if not isinstance(logs, MeasurementPage):
+        logs = _millis_entries(logs)
+    result = BatchWriteResult()
+
+    for start in range(0, len(logs), batch_size):
+        if isinstance(logs, MeasurementPage):
+            chunk = list(logs[start:start + batch_size].documents())
+        else:
+            chunk = [(timestamp_mil, {'timestamp': timestamp_mil, **measurements})
+                     for timestamp_mil, measurements in logs[start:start + batch_size]]
+        is_last = start + batch_size >= len(logs)
+        extra_writes = final_writes if is_last and result.ok else None
+        try:
+            await _commit_measurement_batch(db, user_doc_ref, chunk, max_attempts, extra_writes)
+        except google_exceptions.GoogleAPIError as error:
+            result.failed_timestamps.extend(timestamp_mil for timestamp_mil, _ in chunk)
+            result.errors.append(f"user {user_id}: batch of {len(chunk)} starting at {chunk[0][0]} failed: {error}")
+        else:
+            result.written += len(chunk)
+            result.batches += 1
+
+    return result
+
+
+async def upload_pending_measurement_logs_firestore(
+    db: firestore.AsyncClient,
+    connection: sqlite3.Connection,
+    logs_table_name: str,
+    user_id: int,
+    batch_size: int = FIRESTORE_MAX_BATCH_SIZE,
+    layout: str = 'documents',
+    channels: Optional[Sequence[str]] = None,
+    chunk_size: int = REPLAY_CHUNK_SIZE,
+) -> BatchWriteResult:
+    """
+    Replay a user's staged logs that never made it to Firestore (e.g. the sync ran offline or a batch failed).
+
+    They are written in the sync's storage layout (see utils.chunked_storage): per-epoch documents,
+    packed day documents of `channels`, or both. Only logs that reached every document the layout
+    needs are flagged as uploaded; the others stay pending for the next replay.
+
+    The backlog is read chunk_size logs at a time, oldest first, and each chunk is flagged before
+    the next one is read, so a large backlog is neither held in memory at once nor uploaded again
+    after an interruption half way.
+
+    Args:
+        db (firestore.Client): The Firestore client.
+        connection (sqlite3.Connection): Connection to the local staging store.
+        logs_table_name (str): The staging table.
+        user_id (int): The user's ID.
+        batch_size (int): Writes per Firestore commit (documents layout).
+        layout (str): 'documents', 'days' or 'both'.
+        channels (Sequence[str]): Channels of the day documents (default: every staged one).
+        chunk_size (int): Staged logs read and uploaded at a time.
+
+    Returns:
+        BatchWriteResult: The outcome of the upload; uploaded logs are flagged in the staging table.
+    """
+    from google.api_core import exceptions as google_exceptions
+    from utils.chunked_storage import LAYOUT_DAYS, LAYOUT_DOCUMENTS, write_measurement_days_firestore
+
+    result = BatchWriteResult()
+    after = None
+    while True:
+        # Logs still pending after a chunk are skipped by the keyset, not read again
+        pending = get_pending_measurement_logs(connection, logs_table_name, user_id, limit=chunk_size, after=after)
+        if not pending:
+            return result
+        if after is None:
+            await upsert_user_document_firestore(db, user_id)
+
+        chunk_result = BatchWriteResult()
+        if layout != LAYOUT_DAYS:
+            chunk_result = await insert_measurement_logs_firestore_batched(db, user_id, pending, batch_size=batch_size)
+        if layout != LAYOUT_DOCUMENTS:
+            try:
+                chunk_result.batches += await write_measurement_days_firestore(db, user_id, pending, channels)
+            except google_exceptions.GoogleAPIError as error:
+                # Days are written as a whole: none of the chunk's logs can be counted as uploaded
+                chunk_result.failed_timestamps = [timestamp_mil for timestamp_mil, _ in pending]
+                chunk_result.errors.append(f"user {user_id}: replay of {len(pending)} logs into the day documents failed: {error}")
+            else:
+                if layout == LAYOUT_DAYS:
+                    chunk_result.written = len(pending)
+        failed = set(chunk_result.failed_timestamps)
+        mark_measurement_logs_uploaded(connection, logs_table_name, user_id, (t for t, _ in pending if t not in failed))
+        result.merge(chunk_result)
+
+        if len(pending) < chunk_size:
+            return result
+        after = pending[-1][0]
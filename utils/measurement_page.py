@@ -0,0 +1,83 @@
+"""
+Compact in-memory form of one API page of measurement logs, as the sync passes it around.
+
+A page of 1000 Condor logs decoded as JSON dicts takes a couple of MB; the same logs projected
+onto their channels take 8 bytes of timestamp plus 4 bytes per channel each. Pages are built by
+ChannelProjection.page right after the response is decoded and are handed to the SQLite staging
+store and both Firestore layouts as they are; dicts are only created per Firestore batch.
+
+numpy is never imported here (server.py uses the staging helpers without it): the arrays come in
+ready-made and only their own methods are used.
+"""
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+
+class MeasurementPage:
+    """
+    Logs as a struct of arrays: `timestamps` (int64 epoch ms), `values` (logs x channels floats, NaN
+    where a log has no value for a channel) and the channel names of the columns.
+
+    `size` and `last_id` describe the API page the logs were parsed from (its record count and the
+    id of its last record) and are kept when the page is sliced, so the sync cursor can be taken
+    from any part of it. Slices (page[10:], page[mask]) share the page's channels.
+    """
+
+    __slots__ = ('channels', 'timestamps', 'values', 'size', 'last_id')
+
+    def __init__(self, channels: Sequence[str], timestamps, values, size: Optional[int] = None, last_id=None):
+        self.channels = tuple(channels)
+        self.timestamps = timestamps
+        self.values = values
+        self.size = len(timestamps) if size is None else size
+        self.last_id = last_id
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index) -> 'MeasurementPage':
+        return MeasurementPage(self.channels, self.timestamps[index], self.values[index], self.size, self.last_id)
+
+    def __repr__(self) -> str:
+        return f"MeasurementPage({len(self)} logs, channels={list(self.channels)!r}, size={self.size}, last_id={self.last_id!r})"
+
+    def after(self, watermark: int) -> 'MeasurementPage':
+        """The logs newer than watermark (epoch ms)."""
+        return self[self.timestamps > watermark]
+
+    def _incomplete_rows(self, values) -> set:
+        # NaN != NaN: indexes of the logs that lack at least one channel
+        return set((values != values).any(axis=1).nonzero()[0].tolist())
+
+    def measurements(self) -> Iterator[Tuple[int, dict]]:
+        """(timestamp, {channel: value}) pairs, without the channels a log has no value for."""
+        channels = self.channels
+        incomplete = self._incomplete_rows(self.values)
+        for index, (timestamp_mil, row) in enumerate(zip(self.timestamps.tolist(), self.values.tolist())):
+            if index in incomplete:
+                yield timestamp_mil, {name: value for name, value in zip(channels, row) if value == value}
+            else:
+                yield timestamp_mil, dict(zip(channels, row))
+
+    def documents(self) -> Iterator[Tuple[int, dict]]:
+        """(timestamp, Firestore measurement document) pairs: the measurements plus their 'timestamp'."""
+        for timestamp_mil, document in self.measurements():
+            document['timestamp'] = timestamp_mil
+            yield timestamp_mil, document
+
+    def staging_rows(self, user_id: int) -> Tuple[List[str], Iterator[tuple]]:
+        """
+        The channels that have a value in some log, and one (user_id, timestamp, *values) row per log
+        for them, None where a log has no value: what insert_measurement_logs writes.
+        """
+        present = (self.values == self.values).any(axis=0).tolist()
+        names = [name for name, keep in zip(self.channels, present) if keep]
+        values = self.values if all(present) else self.values[:, present]
+
+        def rows():
+            incomplete = self._incomplete_rows(values)
+            for index, (timestamp_mil, row) in enumerate(zip(self.timestamps.tolist(), values.tolist())):
+                if index in incomplete:
+                    row = [value if value == value else None for value in row]
+                yield (user_id, timestamp_mil, *row)
+
+        return names, rows()
@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import sqlite3
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from utils.database_utils import NON_MEASUREMENT_COLUMNS, get_measurement_columns
+from utils.timestamps import timestamp_to_millis
+
+# Only query_measurements_firestore needs the Firestore client library; server.py queries SQLite
+if TYPE_CHECKING:
+    from firebase_admin import firestore
+
+DEFAULT_QUERY_PAGE_SIZE = 5000
+
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """Query time bound as epoch milliseconds; accepts epoch milliseconds or an ISO date/time string."""
+    if value is None or value == '':
+        return None
+    if value.lstrip('-').isdigit():
+        return int(value)
+    return timestamp_to_millis(value)
+
+
+def measurement_columns(available: Iterable[str], requested: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Measurement columns to return: the requested ones, or all of them.
+
+    Column names end up in SQL, so only names that exist in the table are accepted.
+    """
+    available = sorted(set(available) - NON_MEASUREMENT_COLUMNS)
+    if not requested:
+        return available
+    unknown = [name for name in requested if name not in available]
+    if unknown:
+        raise ValueError(f"unknown measurement columns: {', '.join(unknown)}")
+    return list(requested)
+
+
+def build_measurement_query(
+    logs_table_name: str,
+    user_ids: Sequence[int],
+    columns: Sequence[str],
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    bucket_ms: Optional[int] = None,
+    after: Optional[Tuple[int, int]] = None,
+    page_size: int = DEFAULT_QUERY_PAGE_SIZE,
+) -> Tuple[str, list]:
+    """
+    SQL for one page of measurements of some users in [start_ms, end_ms), ordered by (user_id, timestamp).
+
+    Pages are chained by keyset: pass the (user_id, timestamp) of the last row of the previous page
+    as `after`, so every page is a range scan on the (user_id, timestamp) index that starts where
+    the previous one stopped. The user filter is kept off the index then (`+user_id`), otherwise
+    SQLite seeks each user separately and only checks the keyset bound row by row.
+
+    With bucket_ms the values are averaged per bucket, the timestamp being the bucket start. A page
+    is then up to page_size buckets of one user: the first row past the end of the `after` bucket
+    is found by an index seek, and only the rows of the page_size buckets from its bucket on are
+    grouped, so no page groups the rows of the pages before or after it. Bucket pages can be short
+    where the data has gaps; the last page is the first empty one.
+    """
+    user_filter = f"IN ({', '.join('?' * len(user_ids))})"
+    range_conditions = []
+    range_parameters: list = []
+    if start_ms is not None:
+        range_conditions.append("timestamp >= ?")
+        range_parameters.append(start_ms)
+    if end_ms is not None:
+        range_conditions.append("timestamp < ?")
+        range_parameters.append(end_ms)
+
+    conditions = [f"{'+' if after is not None else ''}user_id {user_filter}", *range_conditions]
+    parameters: list = [*user_ids, *range_parameters]
+    if after is not None:
+        if bucket_ms:
+            conditions.append("(user_id, timestamp) >= (?, ?)")
+            parameters.extend((after[0], after[1] + int(bucket_ms)))
+        else:
+            conditions.append("(user_id, timestamp) > (?, ?)")
+            parameters.extend(after)
+
+    if bucket_ms:
+        bucket_ms = int(bucket_ms)
+        values = "".join(f", AVG(logs.{name})" for name in columns)
+        window_conditions = "".join(f" AND logs.{condition}" for condition in range_conditions)
+        sql = f'''
+        WITH page_start AS (
+            SELECT user_id, (timestamp / {bucket_ms}) * {bucket_ms} AS first_bucket
+            FROM {logs_table_name}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY user_id, timestamp
+            LIMIT 1
+        )
+        SELECT logs.user_id, (logs.timestamp / {bucket_ms}) * {bucket_ms} AS bucket{values}
+        FROM page_start JOIN {logs_table_name} AS logs
+            ON logs.user_id = page_start.user_id
+            AND logs.timestamp >= page_start.first_bucket AND logs.timestamp < page_start.first_bucket + ?{window_conditions}
+        GROUP BY bucket
+        ORDER BY bucket
+        '''
+        return sql, [*parameters, page_size * bucket_ms, *range_parameters]
+
+    values = "".join(f", {name}" for name in columns)
+    sql = f'''
+    SELECT user_id, timestamp{values}
+    FROM {logs_table_name}
+    WHERE {" AND ".join(conditions)}
+    ORDER BY user_id, timestamp
+    LIMIT ?
+    '''
+    return sql, [*parameters, page_size]
+
+
+def query_measurements_sqlite(
+    connection: sqlite3.Connection,
+    logs_table_name: str,
+    user_ids: Sequence[int],
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    columns: Optional[Sequence[str]] = None,
+    downsample_minutes: Optional[int] = None,
+    page_size: int = DEFAULT_QUERY_PAGE_SIZE,
+) -> Tuple[List[str], Iterator[List[tuple]]]:
+    """
+    Measurements of one or many users in [start_ms, end_ms) from the local staging store.
+
+    Returns the column names and an iterator of pages of rows (user_id, timestamp, *columns).
+    """
+    columns = measurement_columns(get_measurement_columns(connection, logs_table_name), columns)
+    bucket_ms = downsample_minutes * 60_000 if downsample_minutes else None
+
+    def pages():
+        after = None
+        while True:
+            sql, parameters = build_measurement_query(
+                logs_table_name, user_ids, columns, start_ms, end_ms, bucket_ms, after, page_size)
+            rows = connection.execute(sql, parameters).fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size and not bucket_ms:
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+    return ['user_id', 'timestamp', *columns], pages()
+
+
+async def query_measurements_firestore(
+    db: firestore.AsyncClient,
+    user_id: int,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    page_size: int = DEFAULT_QUERY_PAGE_SIZE,
+) -> AsyncIterator[List[dict]]:
+    """
+    Pages of a user's 'actigraphy_data/{user_id}/measurements' documents in [start_ms, end_ms), by timestamp.
+
+    Uses a range filter on the documents' 'timestamp' field with cursor pagination, instead of
+    reading documents one at a time.
+    """
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    collection = db.collection('actigraphy_data').document(str(user_id)).collection('measurements')
+    query = collection
+    if start_ms is not None:
+        query = query.where(filter=FieldFilter('timestamp', '>=', start_ms))
+    if end_ms is not None:
+        query = query.where(filter=FieldFilter('timestamp', '<', end_ms))
+    query = query.order_by('timestamp').limit(page_size)
+
+    last_timestamp = None
+    while True:
+        page_query = query if last_timestamp is None else query.start_after({'timestamp': last_timestamp})
+        page = [doc.to_dict() async for doc in page_query.stream()]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_timestamp = page[-1]['timestamp']
@@ -0,0 +1,286 @@
+import cProfile
+import json
+import math
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# Metric names recorded by the sync pipeline
+API_PAGE_SECONDS = 'api_page_seconds'
+API_RETRIES = 'api_retries'
+RECORDS_PER_PAGE = 'records_per_page'
+QUEUE_DEPTH = 'queue_depth'
+PAGE_WRITE_SECONDS = 'page_write_seconds'
+SQLITE_WRITE_SECONDS = 'sqlite_write_seconds'
+FIRESTORE_WRITE_SECONDS = 'firestore_write_seconds'
+FIRESTORE_BATCHES = 'firestore_batches'
+FIRESTORE_RETRIES = 'firestore_retries'
+FIRESTORE_FAILED_LOGS = 'firestore_failed_logs'
+CURSOR_FLUSH_SECONDS = 'cursor_flush_seconds'
+USER_SYNC_SECONDS = 'user_sync_seconds'
+USERS_UNCHANGED = 'users_unchanged'
+WATERMARK_SKIPPED_LOGS = 'watermark_skipped_logs'
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _nearest_rank(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class Histogram:
+    """All observations of one metric; small enough per run to keep them and report exact quantiles."""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values: Iterable[float] = ()):
+        self.values: List[float] = list(values)
+
+    def observe(self, value: float) -> None:
+        self.values.append(value)
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    @property
+    def total(self) -> float:
+        return math.fsum(self.values)
+
+    def quantile(self, q: float) -> float:
+        """Nearest-rank quantile; NaN without observations."""
+        if not self.values:
+            return math.nan
+        return _nearest_rank(sorted(self.values), q)
+
+    def summary(self) -> dict:
+        if not self.values:
+            return {'count': 0, 'sum': 0.0}
+        ordered = sorted(self.values)
+        summary = {'count': len(ordered), 'sum': math.fsum(ordered), 'min': ordered[0], 'max': ordered[-1]}
+        for q in QUANTILES:
+            summary[f"p{round(q * 100)}"] = _nearest_rank(ordered, q)
+        return summary
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one user's sync, or of a whole run once merged.
+
+    Durations are measured with time.perf_counter and recorded in seconds.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def merge(self, other: 'Metrics') -> None:
+        """Add another Metrics into this one; gauges keep the maximum."""
+        for name, value in other.counters.items():
+            self.inc(name, value)
+        for name, value in other.gauges.items():
+            self.gauges[name] = max(value, self.gauges.get(name, value))
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).values.extend(histogram.values)
+
+    def to_dict(self) -> dict:
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+    @classmethod
+    def merged(cls, metrics: Iterable[Optional['Metrics']]) -> 'Metrics':
+        total = cls()
+        for item in metrics:
+            if item is not None:
+                total.merge(item)
+        return total
+
+
+# The Metrics of the user being synced in the current task; tasks it starts inherit it
+_current_metrics: ContextVar[Optional[Metrics]] = ContextVar('current_metrics', default=None)
+
+
+@contextmanager
+def use_metrics(metrics: Metrics) -> Iterator[Metrics]:
+    """Record into `metrics` everything instrumented below this point (including tasks created inside)."""
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+def current_metrics() -> Optional[Metrics]:
+    return _current_metrics.get()
+
+
+def count(name: str, value: float = 1) -> None:
+    """Increment a counter of the current Metrics, if any; usable as a hook from code that has no Metrics at hand."""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.inc(name, value)
+
+
+def observe(name: str, value: float) -> None:
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.observe(name, value)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Time the block into the current Metrics, if any."""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.timer(name):
+        yield
+
+
+def retry_counter(name: str):
+    """A tenacity before_sleep hook counting retries into the current Metrics."""
+    def before_sleep(retry_state) -> None:
+        count(name)
+    return before_sleep
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def print_metrics_report(metrics: Metrics) -> None:
+    """Print counters and the latency/size histograms of a run, one line each."""
+    for name, value in sorted({**metrics.counters, **metrics.gauges}.items()):
+        print(f"{name}: {_format_value(value)}")
+    for name, histogram in sorted(metrics.histograms.items()):
+        summary = histogram.summary()
+        if summary['count']:
+            print(f"{name}: count {summary['count']}, sum {summary['sum']:.3f}, "
+                  f"p50 {summary['p50']:.4g}, p95 {summary['p95']:.4g}, p99 {summary['p99']:.4g}, max {summary['max']:.4g}")
+
+
+def _prometheus_name(prefix: str, name: str) -> str:
+    return f"{prefix}_{name}" if prefix else name
+
+
+def _prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def to_prometheus(series: Iterable[tuple], prefix: str = 'lightspan_sync') -> str:
+    """
+    Prometheus text exposition of (labels, Metrics) pairs: counters as '_total' counters,
+    gauges as gauges and histograms as summaries with the QUANTILES.
+    """
+    series = list(series)
+    lines = []
+
+    def family(kind: str, names: Iterable[str], render):
+        for name in sorted(set(names)):
+            metric = _prometheus_name(prefix, name)
+            lines.append(f"# TYPE {metric}{'_total' if kind == 'counter' else ''} {kind}")
+            for labels, metrics in series:
+                render(metric, name, labels, metrics)
+
+    def counter(metric, name, labels, metrics):
+        if name in metrics.counters:
+            lines.append(f"{metric}_total{_prometheus_labels(labels)} {_format_value(metrics.counters[name])}")
+
+    def gauge(metric, name, labels, metrics):
+        if name in metrics.gauges:
+            lines.append(f"{metric}{_prometheus_labels(labels)} {_format_value(metrics.gauges[name])}")
+
+    def summary(metric, name, labels, metrics):
+        histogram = metrics.histograms.get(name)
+        if histogram is None:
+            return
+        for q in QUANTILES:
+            lines.append(f"{metric}{_prometheus_labels({**labels, 'quantile': q})} {_format_value(histogram.quantile(q))}")
+        lines.append(f"{metric}_sum{_prometheus_labels(labels)} {_format_value(histogram.total)}")
+        lines.append(f"{metric}_count{_prometheus_labels(labels)} {histogram.count}")
+
+    family('counter', (name for _, metrics in series for name in metrics.counters), counter)
+    family('gauge', (name for _, metrics in series for name in metrics.gauges), gauge)
+    family('summary', (name for _, metrics in series for name in metrics.histograms), summary)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: str, summaries: Iterable, run_metrics: Metrics, run_info: Optional[dict] = None) -> None:
+    """
+    Export per-user summaries and the run totals.
+
+    A path ending in '.prom' gets the Prometheus text format (per-user series labelled with user_id,
+    run totals without labels); anything else gets JSON lines: one {"type": "user", ...} line per
+    user, then one {"type": "run", ...} line.
+    """
+    summaries = list(summaries)
+    with open(path, 'w') as file:
+        if path.endswith('.prom'):
+            series = [({'user_id': summary.user_id}, summary.metrics) for summary in summaries if summary.metrics is not None]
+            series.append(({}, run_metrics))
+            file.write(to_prometheus(series))
+            return
+        for summary in summaries:
+            file.write(json.dumps({'type': 'user', **summary.to_dict()}) + '\n')
+        file.write(json.dumps({'type': 'run', **(run_info or {}), 'metrics': run_metrics.to_dict()}) + '\n')
+
+
+@contextmanager
+def profile_run(cprofile_path: Optional[str] = None, trace_memory: bool = False, metrics: Optional[Metrics] = None, top: int = 15) -> Iterator[None]:
+    """
+    Optionally profile the block: cProfile stats are dumped to cprofile_path (read them with pstats or
+    snakeviz), tracemalloc reports the peak traced memory (as the 'tracemalloc_peak_bytes' gauge of
+    `metrics`) and prints the `top` allocation sites. Both cost noticeable overhead; off by default.
+    """
+    profiler = cProfile.Profile() if cprofile_path else None
+    if trace_memory:
+        tracemalloc.start(10)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            print(f"cProfile stats written to {cprofile_path}")
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if metrics is not None:
+                metrics.set_gauge('tracemalloc_peak_bytes', peak)
+            print(f"tracemalloc peak: {peak / 2 ** 20:.1f} MiB")
+            for stat in snapshot.statistics('lineno')[:top]:
+                print(f"  {stat}")
@@ -0,0 +1,172 @@
+"""
+Columnar export of the staging store for offline analytics: one Parquet file per user and day.
+
+    {root}/user_id={user_id}/date={YYYY-MM-DD}/data.parquet
+
+Days are UTC days of the epoch-millisecond timestamps. Every file holds a `timestamp` column
+(timestamp[ms, UTC]) and one float32 column per measurement channel (null where a log lacks it),
+in row groups of a day of one-minute epochs, so readers skip whole days by path and, with
+finer epochs, parts of a day by the row groups' timestamp statistics. The hive-style directory names let pyarrow, pandas, DuckDB or
+Spark read the tree as a dataset partitioned by user_id and date.
+
+Exports are incremental: days before the last exported one are never rewritten; the last one
+(which may have been partial) is rewritten together with the days after it. pyarrow is only
+imported when exporting or reading.
+"""
+import datetime
+import os
+import sqlite3
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.database_utils import DAY_MILLIS, MEASUREMENT_LOGS_TABLE
+from utils.measurement_queries import query_measurements_sqlite
+
+PARQUET_FILE_NAME = 'data.parquet'
+# A day of one-minute epochs per row group: smaller groups cost more to decode than they save
+# (a year of one user loads ~3x slower with six-hour groups). Snappy without dictionaries
+# decodes fastest and, for float channels, is about as small as zstd with them.
+PARQUET_ROW_GROUP_SIZE = 1440
+PARQUET_COMPRESSION = 'snappy'
+TIMESTAMP_COLUMN = 'timestamp'
+
+
+def user_directory(root: str, user_id: int) -> str:
+    return os.path.join(root, f"user_id={user_id}")
+
+
+def day_of(timestamp_ms: int) -> str:
+    """UTC date of epoch milliseconds as 'YYYY-MM-DD', the date partition of the export."""
+    return datetime.datetime.fromtimestamp(timestamp_ms // 1000, datetime.timezone.utc).strftime('%Y-%m-%d')
+
+
+def day_start_ms(day: str) -> int:
+    date = datetime.datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp()) * 1000
+
+
+def exported_days(root: str, user_id: int) -> List[str]:
+    """Dates exported for a user, oldest first."""
+    try:
+        names = os.listdir(user_directory(root, user_id))
+    except FileNotFoundError:
+        return []
+    return sorted(name[len('date='):] for name in names if name.startswith('date='))
+
+
+def exported_users(root: str) -> List[int]:
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[len('user_id='):]) for name in names if name.startswith('user_id='))
+
+
+def day_files(root: str, user_id: int, start_ms: Optional[int] = None, end_ms: Optional[int] = None) -> List[str]:
+    """Files of a user's days overlapping [start_ms, end_ms), oldest first: the partition pruning of every read."""
+    first = day_of(start_ms) if start_ms is not None else None
+    last = day_of(end_ms - 1) if end_ms is not None else None
+    return [os.path.join(user_directory(root, user_id), f"date={day}", PARQUET_FILE_NAME)
+            for day in exported_days(root, user_id)
+            if (first is None or day >= first) and (last is None or day <= last)]
+
+
+def _iter_days(connection: sqlite3.Connection, logs_table_name: str, user_id: int, start_ms: Optional[int]
+               ) -> Tuple[List[str], Iterator[Tuple[str, np.ndarray, np.ndarray]]]:
+    """Measurement columns and (day, timestamps, values) per day of a user's staged logs, one day in memory at a time."""
+    names, pages = query_measurements_sqlite(connection, logs_table_name, [user_id], start_ms)
+    columns = names[2:]
+
+    def days():
+        pending = []
+        for page in pages:
+            # Pages come ordered by timestamp: cut them where the UTC day changes
+            timestamps = np.fromiter((row[1] for row in page), dtype=np.int64, count=len(page))
+            day_numbers = timestamps // DAY_MILLIS
+            cuts = [0, *(np.flatnonzero(np.diff(day_numbers)) + 1).tolist(), len(page)]
+            for start, stop in zip(cuts[:-1], cuts[1:]):
+                if pending and pending[0][1] // DAY_MILLIS != day_numbers[start]:
+                    yield _day_arrays(pending, len(columns))
+                    pending = []
+                pending.extend(page[start:stop])
+        if pending:
+            yield _day_arrays(pending, len(columns))
+
+    return columns, days()
+
+
+def _day_arrays(rows: List[tuple], n_columns: int) -> Tuple[str, np.ndarray, np.ndarray]:
+    timestamps = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    # None (a channel the log did not have) becomes NaN, written as null
+    values = np.array([row[2:] for row in rows], dtype=np.float64).reshape(len(rows), n_columns)
+    # One contiguous float32 row per channel
+    return day_of(int(timestamps[0])), timestamps, np.ascontiguousarray(values.T, dtype=np.float32)
+
+
+def _write_day(path: str, columns: Sequence[str], timestamps: np.ndarray, values: np.ndarray) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrays = [pa.array(timestamps, type=pa.int64()).cast(pa.timestamp('ms', tz='UTC'))]
+    arrays.extend(pa.array(channel, mask=np.isnan(channel)) for channel in values)
+    table = pa.Table.from_arrays(arrays, names=[TIMESTAMP_COLUMN, *columns])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and renamed, so an interrupted export never leaves a truncated day behind
+    temporary = f"{path}.tmp"
+    pq.write_table(table, temporary, row_group_size=PARQUET_ROW_GROUP_SIZE, compression=PARQUET_COMPRESSION,
+                   use_dictionary=False)
+    os.replace(temporary, path)
+
+
+def export_user_parquet(connection: sqlite3.Connection, root: str, user_id: int,
+                        logs_table_name: str = MEASUREMENT_LOGS_TABLE, full: bool = False) -> int:
+    """
+    Export a user's staged logs to {root}/user_id={user_id}/date=.../data.parquet.
+
+    Only the last exported day and the days after it are (re)written, unless full is set (e.g. after
+    logs of older days were staged late). Returns the number of day files written.
+    """
+    days = [] if full else exported_days(root, user_id)
+    start_ms = day_start_ms(days[-1]) if days else None
+    columns, user_days = _iter_days(connection, logs_table_name, user_id, start_ms)
+    written = 0
+    for day, timestamps, values in user_days:
+        _write_day(os.path.join(user_directory(root, user_id), f"date={day}", PARQUET_FILE_NAME), columns, timestamps, values)
+        written += 1
+    return written
+
+
+def read_user_parquet(root: str, user_id: int, columns: Optional[Sequence[str]] = None,
+                      start_ms: Optional[int] = None, end_ms: Optional[int] = None):
+    """
+    A user's exported logs in [start_ms, end_ms) as a pyarrow Table: timestamp plus the requested columns (all by default).
+
+    Only the files of the days in the period are opened, only the requested columns are decoded and
+    row groups outside the period are skipped using their timestamp statistics. Channels missing
+    from some days (added later) come back as nulls there.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    timestamp_type = pa.timestamp('ms', tz='UTC')
+    files = day_files(root, user_id, start_ms, end_ms)
+    if columns:
+        schema = pa.schema([(TIMESTAMP_COLUMN, timestamp_type), *((name, pa.float32()) for name in columns)])
+    elif files:
+        # Channels are only ever added to the staging table: the newest day has all of them
+        schema = pq.read_schema(files[-1])
+    else:
+        schema = pa.schema([(TIMESTAMP_COLUMN, timestamp_type)])
+    if not files:
+        return schema.empty_table()
+
+    condition = None
+    if start_ms is not None:
+        condition = ds.field(TIMESTAMP_COLUMN) >= pa.scalar(start_ms, type=timestamp_type)
+    if end_ms is not None:
+        before_end = ds.field(TIMESTAMP_COLUMN) < pa.scalar(end_ms, type=timestamp_type)
+        condition = before_end if condition is None else condition & before_end
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+    return dataset.to_table(columns=schema.names, filter=condition)
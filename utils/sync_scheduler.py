@@ -0,0 +1,392 @@
+import asyncio
+import heapq
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+from firebase_admin import firestore
+
+from utils.metrics import USER_SYNC_SECONDS, Metrics, use_metrics
+
+
+@dataclass
+class UserSyncSummary:
+    """What one user's sync did: pages fetched, logs written, time spent, the error if it failed and its metrics."""
+    user_id: int
+    pages_fetched: int = 0
+    logs_written: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    metrics: Optional[Metrics] = field(default=None, repr=False, compare=False)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> dict:
+        summary = {f.name: getattr(self, f.name) for f in fields(self) if f.name != 'metrics'}
+        if self.metrics is not None:
+            summary['metrics'] = self.metrics.to_dict()
+        return summary
+
+
+# The summary of the user _run_user_sync is running, so counts made before a failure are not lost
+_current_summary: ContextVar[Optional[UserSyncSummary]] = ContextVar('current_summary', default=None)
+
+
+def user_sync_summary(user_id: int) -> UserSyncSummary:
+    """
+    The summary a sync of `user_id` should count into: the one run_sync_pool reports for the user,
+    also when the sync raises half way, or a new one outside the pool.
+    """
+    summary = _current_summary.get()
+    if summary is None or summary.user_id != user_id:
+        summary = UserSyncSummary(user_id)
+    return summary
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter keyed by host.
+
+    Every host gets its own bucket refilled at `rate` requests per second, holding at most `burst` tokens.
+    Waiters on the same host are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._buckets: Dict[str, List[float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def acquire(self, url: str) -> None:
+        """Wait until a request to the host of `url` is allowed."""
+        host = urlsplit(url).netloc or url
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            tokens, updated = self._buckets.get(host, [float(self.burst), time.monotonic()])
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+                now = time.monotonic()
+                tokens = 1
+            self._buckets[host] = [tokens - 1, now]
+
+
+def user_ids_from_range(start: int, stop: int) -> List[int]:
+    """User ids from start (inclusive) to stop (exclusive), like range()."""
+    return list(range(start, stop))
+
+
+def user_ids_from_file(path: str) -> List[int]:
+    """Read user ids from a text file, one per line or comma separated; blank lines and '#' comments are ignored."""
+    user_ids = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.split('#', 1)[0]
+            user_ids.extend(int(part) for part in line.replace(',', ' ').split())
+    return user_ids
+
+
+async def user_ids_from_firestore(db: firestore.AsyncClient, collection_name: str) -> List[int]:
+    """List the user ids that have a document in the given Firestore collection (e.g. the last place collection)."""
+    user_ids = []
+    async for doc_ref in db.collection(collection_name).list_documents():
+        if doc_ref.id.isdigit():
+            user_ids.append(int(doc_ref.id))
+    return sorted(user_ids)
+
+
+def unique_user_ids(*sources: Iterable[int]) -> List[int]:
+    """Merge user id sources, keeping the first occurrence of every id so ordering stays fair."""
+    seen = set()
+    user_ids = []
+    for source in sources:
+        for user_id in source:
+            if user_id not in seen:
+                seen.add(user_id)
+                user_ids.append(user_id)
+    return user_ids
+
+
+async def _run_user_sync(sync_user: Callable[[int], Awaitable[Optional[UserSyncSummary]]], user_id: int) -> UserSyncSummary:
+    """
+    Run one user's sync into its own Metrics and summary (see user_sync_summary); an exception
+    becomes the summary's error, next to what the sync counted before it.
+    """
+    metrics = Metrics()
+    summary = UserSyncSummary(user_id)
+    token = _current_summary.set(summary)
+    start_time = time.perf_counter()
+    try:
+        with use_metrics(metrics):
+            summary = await sync_user(user_id) or summary
+    except Exception as error:
+        summary.error = f"{type(error).__name__}: {error}"
+    finally:
+        _current_summary.reset(token)
+    summary.elapsed = time.perf_counter() - start_time
+    metrics.observe(USER_SYNC_SECONDS, summary.elapsed)
+    summary.metrics = metrics
+    return summary
+
+
+async def run_sync_pool(
+    user_ids: Iterable[int],
+    sync_user: Callable[[int], Awaitable[Optional[UserSyncSummary]]],
+    concurrency: int = 8,
+) -> List[UserSyncSummary]:
+    """
+    Sync users through a pool of `concurrency` workers.
+
+    Users are handed out first-in first-out, so they start in the order given. A user whose sync raises
+    gets a summary carrying the error; the other users keep going. Every sync records into its own
+    Metrics (see utils.metrics.use_metrics), attached to the user's summary.
+
+    Args:
+        user_ids (Iterable[int]): Users to sync.
+        sync_user (Callable): Coroutine function syncing one user and returning its UserSyncSummary.
+        concurrency (int): Maximum number of users synced at the same time.
+
+    Returns:
+        List[UserSyncSummary]: One summary per user, in the order the users were given.
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+
+    user_ids = list(user_ids)
+    queue: asyncio.Queue = asyncio.Queue()
+    for index, user_id in enumerate(user_ids):
+        queue.put_nowait((index, user_id))
+    summaries: List[Optional[UserSyncSummary]] = [None] * len(user_ids)
+
+    async def worker():
+        while True:
+            try:
+                index, user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            summaries[index] = await _run_user_sync(sync_user, user_id)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(user_ids)))]
+    await asyncio.gather(*workers)
+    return summaries
+
+
+@dataclass
+class PollPolicy:
+    """
+    How often the daemon polls a user: right after a sync that found new data, the next poll is
+    min_interval away; every poll without new data (or failing) multiplies the interval by backoff,
+    up to max_interval. Intervals are spread by +-jitter (a fraction) so users polled together drift apart.
+    """
+    min_interval: float = 60.0
+    max_interval: float = 3600.0
+    backoff: float = 2.0
+    jitter: float = 0.1
+
+    def __post_init__(self):
+        if not 0 < self.min_interval <= self.max_interval:
+            raise ValueError(f"need 0 < min_interval <= max_interval, got {self.min_interval} and {self.max_interval}")
+        if self.backoff < 1:
+            raise ValueError(f"backoff must be at least 1, got {self.backoff}")
+
+    def next_interval(self, previous: Optional[float], summary: UserSyncSummary) -> float:
+        """Interval before the next poll, before jitter."""
+        if summary.ok and summary.logs_written:
+            return self.min_interval
+        if previous is None:
+            return self.min_interval
+        return min(self.max_interval, previous * self.backoff)
+
+
+class PollSchedule:
+    """Users ordered by next-due time (time.monotonic()) in a heap; a user being synced is not in it."""
+
+    def __init__(self, policy: PollPolicy, rng: Optional[random.Random] = None):
+        self.policy = policy
+        self.random = rng or random.Random()
+        self.intervals: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []
+        self._scheduled: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._scheduled
+
+    def add(self, user_id: int, due: float) -> None:
+        """Schedule (or reschedule) a user; a replaced entry stays in the heap and is skipped when it comes up."""
+        self._scheduled[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+
+    def next_due(self) -> Optional[float]:
+        """When the earliest user is due, or None if nobody is scheduled."""
+        while self._heap:
+            due, user_id = self._heap[0]
+            if self._scheduled.get(user_id) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop(self) -> int:
+        """Take the earliest user off the schedule."""
+        self.next_due()
+        _, user_id = heapq.heappop(self._heap)
+        del self._scheduled[user_id]
+        return user_id
+
+    def reschedule(self, summary: UserSyncSummary, now: float) -> float:
+        """Schedule the user's next poll after a sync; returns the interval chosen."""
+        interval = self.policy.next_interval(self.intervals.get(summary.user_id), summary)
+        self.intervals[summary.user_id] = interval
+        spread = interval * (1 + self.random.uniform(-self.policy.jitter, self.policy.jitter))
+        self.add(summary.user_id, now + spread)
+        return interval
+
+
+class SyncDaemon:
+    """
+    Polls users forever, each on its own adaptive interval (see PollPolicy), at most `concurrency` at a time.
+
+    The caller keeps its clients warm across polls by closing over them in sync_user; on_summary gets
+    every finished sync (metrics attached).
+
+    stop() sets `stopping`, which sync_user is expected to watch so a sync in flight ends after its
+    current page (see run_example); run() then returns once they have. Calling stop() again, or
+    `grace` seconds passing in run(), cancels the syncs still in flight: every page is checkpointed
+    as it is written, so a cancelled sync only loses the page it was on.
+    """
+
+    def __init__(self, sync_user: Callable[[int], Awaitable[Optional[UserSyncSummary]]], concurrency: int = 8,
+                 policy: Optional[PollPolicy] = None, on_summary: Optional[Callable[[UserSyncSummary], None]] = None,
+                 stopping: Optional[asyncio.Event] = None):
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+        self.sync_user = sync_user
+        self.concurrency = concurrency
+        self.schedule = PollSchedule(policy or PollPolicy())
+        self.on_summary = on_summary
+        self.polls = 0
+        self.stopping = stopping or asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._running: Dict[int, asyncio.Task] = {}
+
+    def add_users(self, user_ids: Iterable[int], due: Optional[float] = None) -> None:
+        """Poll these users from `due` on (now by default); users already known keep their schedule."""
+        due = time.monotonic() if due is None else due
+        for user_id in user_ids:
+            if user_id not in self.schedule and user_id not in self._running:
+                self.schedule.add(user_id, due)
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        if self.stopping.is_set():
+            self.cancel()
+        self.stopping.set()
+        self._wakeup.set()
+
+    def cancel(self) -> None:
+        """Cancel the syncs in flight."""
+        for task in list(self._running.values()):
+            task.cancel()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    async def _poll(self, user_id: int) -> None:
+        try:
+            summary = await _run_user_sync(self.sync_user, user_id)
+        finally:
+            del self._running[user_id]
+            self._wakeup.set()
+        self.polls += 1
+        self.schedule.reschedule(summary, time.monotonic())
+        if self.on_summary is not None:
+            self.on_summary(summary)
+
+    async def run(self, grace: Optional[float] = None) -> None:
+        while not self.stopping.is_set():
+            due = self.schedule.next_due()
+            now = time.monotonic()
+            if due is not None and due <= now and len(self._running) < self.concurrency:
+                user_id = self.schedule.pop()
+                self._running[user_id] = asyncio.create_task(self._poll(user_id))
+                continue
+            # Sleep until the next user is due, a slot frees up, users are added or stop() is called
+            timeout = None if due is None or len(self._running) >= self.concurrency else due - now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._running:
+            _, pending = await asyncio.wait(list(self._running.values()), timeout=grace)
+            if pending:
+                self.cancel()
+                await asyncio.wait(pending)
+
+
+def shard_user_ids(user_ids: Sequence[int], shards: int) -> List[List[int]]:
+    """Deal the users round-robin over `shards` shards, keeping their order within each shard."""
+    if shards < 1:
+        raise ValueError(f"shards must be at least 1, got {shards}")
+    return [list(user_ids[shard::shards]) for shard in range(shards) if user_ids[shard::shards]]
+
+
+async def run_sharded(
+    user_ids: Sequence[int],
+    shards: int,
+    run_shard: Callable[..., Tuple[List[UserSyncSummary], Metrics]],
+    *args: Any,
+) -> Tuple[List[UserSyncSummary], Metrics]:
+    """
+    Sync users in `shards` worker processes and merge their results.
+
+    run_shard(shard, user_ids, *args) runs in a fresh (spawned) process, so it must be a module-level
+    function with picklable arguments; it builds its own event loop and clients and returns one
+    UserSyncSummary per user (metrics included) plus the shard's own run-level Metrics.
+
+    Returns:
+        Tuple[List[UserSyncSummary], Metrics]: One summary per user, in the order the users were given
+        (a shard that crashed reports its users as failed), and the shards' run-level metrics merged.
+    """
+    user_ids = list(user_ids)
+    parts = shard_user_ids(user_ids, shards)
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=len(parts), mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [loop.run_in_executor(pool, run_shard, shard, part, *args) for shard, part in enumerate(parts)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+
+    by_user: Dict[int, UserSyncSummary] = {}
+    shard_metrics = Metrics()
+    for part, result in zip(parts, results):
+        if isinstance(result, BaseException):
+            error = f"shard failed: {type(result).__name__}: {result}"
+            result = ([UserSyncSummary(user_id, error=error) for user_id in part], Metrics())
+        summaries, metrics = result
+        shard_metrics.merge(metrics)
+        for summary in summaries:
+            by_user[summary.user_id] = summary
+    summaries = [by_user.get(user_id) or UserSyncSummary(user_id, error="no summary from shard") for user_id in user_ids]
+    return summaries, shard_metrics
+
+
+def print_sync_report(summaries: List[UserSyncSummary]) -> None:
+    """Print one line per user followed by run totals."""
+    for summary in summaries:
+        status = 'ok' if summary.ok else f"error: {summary.error}"
+        print(f"user {summary.user_id}: pages {summary.pages_fetched}, logs {summary.logs_written}, "
+              f"elapsed {summary.elapsed:.2f}s, {status}")
+    failed = sum(1 for summary in summaries if not summary.ok)
+    print(f"users {len(summaries)}, failed {failed}, "
+          f"pages {sum(s.pages_fetched for s in summaries)}, logs {sum(s.logs_written for s in summaries)}")
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import datetime
+import numbers
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Sequence, Union
+
+# numpy is only imported by the page converters, so parsing single timestamps (e.g. in server.py) stays light
+if TYPE_CHECKING:
+    import numpy as np
+
+# Timezone of log times that carry no UTC offset (the Condor API sends 'YYYY-MM-DD HH:MM:SS'). Every
+# sync has read them in the machine's local time (datetime.timestamp()), and the result is the
+# Firestore document id, so changing it would move every log already synced.
+LOCAL_TIMEZONE = 'local'
+LOG_TIME_TIMEZONE = LOCAL_TIMEZONE
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+_UTC_NAMES = frozenset({'UTC', 'utc', 'Z', 'Etc/UTC', 'Etc/UCT', 'UCT', 'Universal', 'Etc/Universal', 'Zulu', 'Etc/Zulu'})
+
+
+def _is_utc(tz: str) -> bool:
+    return _zone(tz) is datetime.timezone.utc
+
+
+@lru_cache(maxsize=None)
+def _zone(tz: str) -> datetime.tzinfo:
+    """The tzinfo of an IANA name, or of the machine's zone for LOCAL_TIMEZONE."""
+    if tz == LOCAL_TIMEZONE:
+        return _local_zone()
+    if tz in _UTC_NAMES:
+        return datetime.timezone.utc
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(tz)
+
+
+def _pandas_zone(tz: str):
+    """The zone to hand to pandas: its name where it has one, as pandas is much slower with a ZoneInfo."""
+    zone = _zone(tz)
+    return getattr(zone, 'key', None) or zone
+
+
+def _local_zone() -> datetime.tzinfo:
+    """
+    The machine's zone the way datetime.timestamp() reads naive times: TZ if set, else /etc/localtime.
+
+    Falls back to the current UTC offset where neither names a zone database entry (e.g. a POSIX TZ
+    rule), which is only right outside DST changes.
+    """
+    from zoneinfo import ZoneInfo
+
+    name = os.environ.get('TZ', '').lstrip(':')
+    if not name and os.path.exists('/etc/localtime'):
+        path = os.path.realpath('/etc/localtime')
+        name = path.split('/zoneinfo/', 1)[1] if '/zoneinfo/' in path else ''
+        if not name:
+            with open('/etc/localtime', 'rb') as file:
+                return ZoneInfo.from_file(file)
+    if name:
+        try:
+            return _zone(name)
+        except (KeyError, ValueError, OSError):
+            pass
+    offset = datetime.datetime.now().astimezone().utcoffset()
+    return datetime.timezone.utc if not offset else datetime.timezone(offset)
+
+
+def timestamp_to_millis(timestamp: Union[int, str, datetime.datetime], tz: str = LOG_TIME_TIMEZONE) -> int:
+    """
+    Convert one log timestamp (ISO string or datetime) to epoch milliseconds; integers are taken as milliseconds already.
+
+    Times with a UTC offset are converted with it, naive ones are read in `tz`. For a whole page use
+    log_times_to_millis.
+    """
+    if isinstance(timestamp, numbers.Integral):
+        return int(timestamp)
+
+    # Check if timestamp is a string, convert it to datetime if necessary
+    if isinstance(timestamp, str):
+        # Parse the timestamp string into a datetime object
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=_zone(tz))
+    return (timestamp - _EPOCH) // _MILLISECOND
+
+
+# Pages smaller than this are cheaper to convert one log at a time than to set up the array parse
+_VECTORIZE_MIN_SIZE = 32
+
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# pandas' zone tables list DST changes up to 2037 only; zoneinfo goes on with the zone's rule after that
+_PANDAS_ZONE_END_MILLIS = 2_145_916_800_000  # 2038-01-01
+
+
+def _days_from_civil(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """Days since 1970-01-01 of proleptic Gregorian dates (H. Hinnant's days_from_civil, vectorized)."""
+    import numpy as np
+
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _parse_fixed_layout(codes: np.ndarray, base_length: int, zone_length: int):
+    """
+    Parse rows of code points that all share one layout: 'YYYY-MM-DD[T ]HH:MM:SS[.fff...]' of
+    base_length characters followed by a zone of zone_length ('' / 'Z' / '±HH:MM' / '±HHMM').
+
+    Returns (millis, valid): epoch milliseconds (wall time for naive rows) and which rows are well formed.
+    """
+    import numpy as np
+
+    # One byte per character: digits become 0-9, everything else wraps around to a larger value
+    layout_length = base_length + zone_length
+    digits = codes[:, :layout_length].astype(np.uint8) - np.uint8(48)
+    zone = base_length
+
+    def number(first: int, last: int) -> np.ndarray:
+        value = digits[:, first].astype(np.int64)
+        for column in range(first + 1, last):
+            value = value * 10 + digits[:, column]
+        return value
+
+    separators = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':'}
+    if base_length > 19:
+        separators[19] = '.'
+    if zone_length == 6:
+        separators[zone + 3] = ':'
+    if zone_length >= 5:
+        separators[zone] = '+'
+    expected = np.zeros(layout_length, dtype=np.uint8)
+    is_separator = np.zeros(layout_length, dtype=bool)
+    for column, character in separators.items():
+        expected[column] = (ord(character) - 48) % 256
+        is_separator[column] = True
+    # Date/time separator may also be a space, the zone sign also '-': those two are checked below
+    matches = np.where(is_separator, digits == expected, digits <= 9)
+    matches[:, 10] = (digits[:, 10] == expected[10]) | (codes[:, 10] == ord(' '))
+    if zone_length >= 5:
+        matches[:, zone] = (codes[:, zone] == ord('+')) | (codes[:, zone] == ord('-'))
+    valid = matches.all(axis=1)
+
+    year, month, day = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = np.array(_DAYS_IN_MONTH, dtype=np.int64)[np.clip(month - 1, 0, 11)] + (leap & (month == 2))
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month)
+    valid &= (hour <= 23) & (minute <= 59) & (second <= 59)
+
+    millis = (((_days_from_civil(year, month, day) * 24 + hour) * 60 + minute) * 60 + second) * 1000
+    # Milliseconds are the first three digits of the fraction of a second
+    if base_length > 20:
+        fraction_end = min(base_length, 23)
+        millis += number(20, fraction_end) * 10 ** (23 - fraction_end)
+    if zone_length >= 5:
+        offset = number(zone + 1, zone + 3) * 60 + (number(zone + 4, zone + 6) if zone_length == 6 else number(zone + 3, zone + 5))
+        millis -= np.where(codes[:, zone] == ord('-'), -offset, offset) * 60_000
+    return millis, valid
+
+
+def _parse_iso_strings(array: np.ndarray):
+    """
+    Parse 'YYYY-MM-DD[T ]HH:MM:SS[.fff...][Z|±HH:MM|±HHMM]' strings with integer arithmetic on their code points.
+
+    Rows are grouped by length and zone so that every group has fixed columns (a page usually is a
+    single group). Returns (millis, valid, zoned): epoch milliseconds (wall time for naive rows),
+    which rows matched the layout and which carried a zone.
+    """
+    import numpy as np
+
+    n = len(array)
+    width = array.dtype.itemsize // 4
+    millis = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    zoned = np.zeros(n, dtype=bool)
+    if width < 19:
+        return millis, valid, zoned
+    codes = np.ascontiguousarray(array).view(np.uint32).reshape(n, width)
+    # Strings shorter than the widest one are padded with zeros
+    if codes[:, -1].all():
+        lengths, groups = None, (width,)
+    else:
+        lengths = np.count_nonzero(codes, axis=1)
+        groups = np.unique(lengths)
+
+    for length in groups:
+        if length < 19:
+            continue
+        rows = None if lengths is None else np.flatnonzero(lengths == length)
+        group = codes if rows is None else codes[rows]
+        zulu = group[:, length - 1] == ord('Z')
+        colon = compact = np.zeros(len(group), dtype=bool)
+        if length >= 25:
+            colon = np.isin(group[:, length - 6], (ord('+'), ord('-'))) & (group[:, length - 3] == ord(':'))
+        if length >= 24:
+            compact = np.isin(group[:, length - 5], (ord('+'), ord('-'))) & ~colon
+        naive = ~(zulu | colon | compact)
+        for zone_length, mask in ((0, naive), (1, zulu), (6, colon), (5, compact)):
+            base_length = length - zone_length
+            if not mask.any() or base_length == 20 or base_length < 19:
+                continue
+            subset = mask.all()
+            group_millis, group_valid = _parse_fixed_layout(group if subset else group[mask], base_length, zone_length)
+            target = (slice(None) if rows is None else rows) if subset else (np.flatnonzero(mask) if rows is None else rows[mask])
+            millis[target] = group_millis
+            valid[target] = group_valid
+            zoned[target] = zone_length > 0
+    return millis, valid, zoned
+
+
+def _localize_wall_millis(wall: np.ndarray, tz: str) -> np.ndarray:
+    """
+    Epoch milliseconds of wall times (milliseconds since 1970-01-01 on the clock of `tz`), by the
+    rules of timestamp_to_millis: on DST fall-back the first (summer time) reading wins, and a time
+    in a DST gap is read with the offset from before the gap (zoneinfo's fold=0).
+    """
+    import numpy as np
+    import pandas as pd
+
+    index = pd.DatetimeIndex(wall.astype('datetime64[ms]'))
+    local = index.tz_localize(_pandas_zone(tz), ambiguous=np.ones(len(index), dtype=bool), nonexistent='NaT')
+    millis = local.as_unit('ms').asi8.copy()
+    # Gaps are rare and not always an hour long (e.g. Lord Howe): let zoneinfo place them, and the
+    # times past pandas' tables
+    scalar = (local.isna() & ~index.isna()) | (wall >= _PANDAS_ZONE_END_MILLIS)
+    if scalar.any():
+        wall_start = _EPOCH.replace(tzinfo=None)
+        millis[scalar] = [timestamp_to_millis(wall_start + value * _MILLISECOND, tz) for value in wall[scalar].tolist()]
+    return millis
+
+
+def log_times_to_millis(values: Sequence, tz: str = LOG_TIME_TIMEZONE) -> np.ndarray:
+    """
+    Convert a whole page of log times to an int64 array of epoch milliseconds in one vectorized pass.
+
+    ISO 8601 strings with a UTC offset ('Z', '+02:00') are converted with it; naive strings and
+    datetime64 values are read in `tz` (IANA name, or 'local' for the machine's zone), the same way timestamp_to_millis reads them,
+    DST transitions included. Integers are taken as milliseconds already.
+    Strings are parsed straight from their code points; rows in another layout go through pandas,
+    and anything else (e.g. datetime objects) through timestamp_to_millis one by one.
+    """
+    import numpy as np
+
+    if isinstance(values, (list, tuple)) and len(values) < _VECTORIZE_MIN_SIZE:
+        return np.fromiter((timestamp_to_millis(value, tz) for value in values), dtype=np.int64, count=len(values))
+    array = np.asarray(values)
+    if array.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if array.dtype.kind in 'iu':
+        return array.astype(np.int64, copy=False)
+
+    if array.dtype.kind == 'M':
+        wall = array.ravel().astype('datetime64[ms]').astype(np.int64)
+        return wall if _is_utc(tz) else _localize_wall_millis(wall, tz)
+    if array.dtype.kind != 'U':
+        if array.dtype == object and all(isinstance(value, str) for value in array.flat):
+            array = array.astype(str)
+        else:
+            return np.fromiter((timestamp_to_millis(value, tz) for value in array.flat), dtype=np.int64, count=array.size)
+
+    array = array.ravel()
+    millis, valid, zoned = _parse_iso_strings(array)
+    if not valid.all():
+        # Other ISO 8601 layouts: let pandas parse those rows (naive ones come out as UTC wall time)
+        import pandas as pd
+        invalid = ~valid
+        others = array[invalid]
+        millis[invalid] = pd.to_datetime(others, format='ISO8601', utc=True).as_unit('ms').asi8
+        zoned[invalid] = pd.Series(others).str.contains(r'(?:Z|[+-]\d\d:?\d\d)$', regex=True).to_numpy()
+
+    naive = ~zoned
+    if not _is_utc(tz) and naive.any():
+        # Wall times of naive rows are read in tz
+        millis[naive] = _localize_wall_millis(millis[naive], tz)
+    return millis
+
+
+def millis_to_datetimes(millis: np.ndarray, tz: str = LOG_TIME_TIMEZONE):
+    """Epoch milliseconds as a naive DatetimeIndex of wall times in `tz`, the inverse of log_times_to_millis for naive times."""
+    import numpy as np
+    import pandas as pd
+
+    index = pd.to_datetime(np.asarray(millis, dtype=np.int64), unit='ms', utc=True)
+    if not _is_utc(tz):
+        index = index.tz_convert(_pandas_zone(tz))
+    return index.tz_localize(None)